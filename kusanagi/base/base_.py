@@ -8,7 +8,8 @@ def preprocess_angles(x_t, angle_dims=[]):
     return x_t_
 
 
-def apply_controller(env, policy, max_steps, preprocess=None, callback=None):
+def apply_controller(env, policy, max_steps, preprocess=None, callback=None,
+                     action_repeat=1):
     '''
         Starts the env and applies the current policy to the env for a duration
         specified by H (in seconds). If  H is not set, it will run for self.H
@@ -17,6 +18,9 @@ def apply_controller(env, policy, max_steps, preprocess=None, callback=None):
         @param policy Interface to the controller to be applied to the system
         @param max_steps Horizon for applying controller (in seconds)
         @param callback Callable object to be called after every time step
+        @param action_repeat number of steps each command is held for (i.e.
+                             the policy is only evaluated every action_repeat
+                             steps)
     '''
     fnname = 'apply_controller'
     # initialize policy if needed
@@ -40,23 +44,21 @@ def apply_controller(env, policy, max_steps, preprocess=None, callback=None):
     # applying action at time t
     data = []
 
-    scalar_costs = 0.
     # do rollout
-    #for t in range(200):
-    for t in range(35):
-        # preprocess state
-        x_t_ = preprocess(x_t) if callable(preprocess) else x_t
-
-        #  get command from policy
-        u_t = policy(x_t_, t=t)
-        if isinstance(u_t, list) or isinstance(u_t, tuple):
-            u_t = u_t[0].flatten()
-        else:
-            u_t = u_t.flatten()
+    for t in range(max_steps):
+        if t % action_repeat == 0:
+            # preprocess state
+            x_t_ = preprocess(x_t) if callable(preprocess) else x_t
+
+            #  get command from policy
+            u_t = policy(x_t_, t=t)
+            if isinstance(u_t, list) or isinstance(u_t, tuple):
+                u_t = u_t[0].flatten()
+            else:
+                u_t = u_t.flatten()
 
         # apply control and step the env
         x_next, c_t, done, info = env.step(u_t)
-        scalar_costs += c_t
         info['done'] = done
 
         # append to dataset
@@ -74,7 +76,6 @@ def apply_controller(env, policy, max_steps, preprocess=None, callback=None):
         x_t = x_next
 
     states, actions, costs, infos = zip(*data)
-    print ('Here is the scalar cost:', scalar_costs)
 
     msg = 'Done. Stopping robot.'
     if all([v is not None for v in costs]):
@@ -1,2 +1,3 @@
 from .pilco import *
-from .mc_pilco import *
\ No newline at end of file
+from .mc_pilco import *
+from .engine import *
@@ -0,0 +1,148 @@
+import theano
+import weakref
+
+from kusanagi import utils
+
+# compiled engines, per policy and configuration (the entries are released
+# with the policy)
+engines = weakref.WeakKeyDictionary()
+
+
+class RolloutEngine(object):
+    '''
+        Compiles a single theano function for the outputs of a learner's
+        get_loss function (e.g. mc_pilco.get_loss or pilco.get_loss): the
+        loss, the intermediate outputs of the rollout (costs, trajectories,
+        etc.) and, if requested by an optimizer (see compile), the gradients
+        of the loss with respect to the optimized parameters. The outputs to
+        be computed are selected when calling the engine, so the same
+        compiled function can be used for optimization and diagnostics.
+        The function is compiled on the first call (or via compile); asking
+        for gradients before the first call avoids compiling it twice.
+        Diagnostics that should not change the state used by the optimizer
+        (e.g. advancing the common random numbers, the random number
+        generators or writing the rollout reuse cache) can call the engine
+        with update=False, which evaluates the loss and intermediate outputs
+        with a second compiled function without any updates.
+        @param get_loss function with signature
+                        get_loss(pol, dyn, cost, angle_dims, **kwargs) that
+                        returns (outs, inps, updts), with outs = [loss] +
+                        intermediate outputs when called with
+                        intermediate_outs=True
+    '''
+    def __init__(self, get_loss, pol, dyn, cost, angle_dims=[],
+                 name='RolloutEngine', **kwargs):
+        self.name = name
+        kwargs['intermediate_outs'] = True
+        outs, inps, updts = get_loss(pol, dyn, cost, angle_dims, **kwargs)
+        self.loss, self.intermediate_outs = outs[0], outs[1:]
+        self.inps = inps
+        self.updts = updts
+        self.params = pol.get_params(symbolic=True)
+        self.grads = None
+        self.fn = None
+        self.diagnostics_fn = None
+
+    def compile(self, grads=False, params=None, compilation_mode=None):
+        '''
+            Compiles the rollout function, if it has not been compiled yet
+            (or if gradients are requested and the current function does not
+            compute them).
+            @param grads whether the function should also compute the
+                         gradients of the loss
+            @param params parameters for the gradients. Defaults to the
+                          policy parameters
+        '''
+        if params is not None and\
+                [id(p) for p in params] != [id(p) for p in self.params]:
+            self.params = params
+            self.grads = None
+        if grads and self.grads is None:
+            utils.print_with_stamp(
+                'Building computation graph for gradients', self.name)
+            # some parameters may not affect the loss (e.g. dropout
+            # parameters with deterministic predictions)
+            self.grads = theano.grad(self.loss, self.params,
+                                     disconnected_inputs='ignore')
+            self.fn = None
+        if self.fn is not None:
+            return self.fn
+
+        utils.print_with_stamp('Compiling rollout function', self.name)
+        grads = self.grads if self.grads is not None else []
+        all_outs = [self.loss] + self.intermediate_outs + grads
+        # some of the inputs may be unused (e.g. the initial state
+        # covariance for mean only rollouts)
+        self.fn = theano.function(self.inps, all_outs, updates=self.updts,
+                                  allow_input_downcast=True,
+                                  on_unused_input='ignore',
+                                  mode=compilation_mode)
+        # the loss and intermediate outputs are at the same positions as in
+        # the diagnostics function
+        n_int = len(self.intermediate_outs)
+        self.grads_idx = list(range(1 + n_int, len(all_outs)))
+        return self.fn
+
+    def compile_diagnostics(self, compilation_mode=None):
+        '''
+            Compiles a function for the loss and intermediate outputs that
+            does not apply the updates of the rollout graph (neither the
+            explicit ones nor the default updates of the random number
+            generators); i.e. evaluating it does not have side effects.
+        '''
+        if self.diagnostics_fn is not None:
+            return self.diagnostics_fn
+        utils.print_with_stamp('Compiling diagnostics function', self.name)
+        self.diagnostics_fn = theano.function(
+            self.inps, [self.loss] + self.intermediate_outs,
+            allow_input_downcast=True, on_unused_input='ignore',
+            no_default_updates=True, mode=compilation_mode)
+        return self.diagnostics_fn
+
+    def __call__(self, *inputs, **kwargs):
+        '''
+            Evaluates the rollout for the given inputs. Only the selected
+            outputs are computed.
+            @param return_loss whether to return the loss
+            @param return_intermediate whether to return the intermediate
+                                       outputs of the rollout
+            @param return_grads whether to return the gradients of the loss
+            @param update whether to apply the updates of the rollout graph.
+                          If False, the gradients can't be requested
+            @return list of the selected outputs, in the order above
+        '''
+        return_grads = kwargs.get('return_grads', False)
+        subset = []
+        if kwargs.get('return_loss', True):
+            subset += [0]
+        if kwargs.get('return_intermediate', True):
+            subset += list(range(1, 1 + len(self.intermediate_outs)))
+        if not kwargs.get('update', True):
+            if return_grads:
+                msg = 'The gradients are only computed with update=True'
+                raise ValueError(msg)
+            return self.compile_diagnostics()(*inputs, output_subset=subset)
+        self.compile(grads=return_grads)
+        if return_grads:
+            subset += self.grads_idx
+        return self.fn(*inputs, output_subset=subset)
+
+    def loss_and_grads(self, *inputs):
+        ret = self(*inputs, return_intermediate=False, return_grads=True)
+        return ret[0], ret[1:]
+
+
+def get_engine(get_loss, pol, dyn, cost, angle_dims=[], **kwargs):
+    '''
+        Returns a RolloutEngine for the given configuration, building it
+        only if it has not been built before.
+    '''
+    # the entries keep references to the dynamics model and cost, so their
+    # ids can't be reused by other objects while the entry exists
+    key = (get_loss.__module__, id(dyn), id(cost),
+           tuple(angle_dims), repr(sorted(kwargs.items())))
+    pol_engines = engines.setdefault(pol, {})
+    if key not in pol_engines:
+        pol_engines[key] = (RolloutEngine(
+            get_loss, pol, dyn, cost, angle_dims, **kwargs), dyn, cost)
+    return pol_engines[key][0]
@@ -1,28 +1,70 @@
+import lasagne
 import numpy as np
 import theano
 import theano.tensor as tt
+import weakref
 
 from kusanagi import utils
+from kusanagi.ghost.algorithms import engine
+from kusanagi.ghost.regression import layers
 
 m_rng = utils.get_mrng()
+# random number generators for common random numbers, per policy and
+# dynamics model (the entries are released with the models)
+crn_streams = weakref.WeakKeyDictionary()
+# dynamics models whose dataset statistics normalize the inputs of a policy,
+# per policy (the entries are released with the models)
+policy_input_stats = weakref.WeakKeyDictionary()
+
+
+def get_crn_stream(pol, dyn, *key):
+    '''
+        Returns the random number generator used for the common random
+        numbers of the graphs built for the given policy and dynamics model
+        objects (and any other hashable key, e.g. the number of samples)
+    '''
+    if isinstance(pol, PopulationPolicy):
+        pol = pol.pol
+    dyn_streams = crn_streams.setdefault(pol, weakref.WeakKeyDictionary())
+    streams = dyn_streams.setdefault(dyn, {})
+    if key not in streams:
+        streams[key] = utils.sampling.FixedRandomStreams()
+    return streams[key]
 
 
 def propagate_particles(latent_x, measured_x, pol, dyn, angle_dims=[],
-                        iid_per_eval=False, deltas=True, **kwargs):
+                        iid_per_eval=False, deltas=True, u_prev=None,
+                        new_control=None, u_noise=None, **kwargs):
     ''' Given a set of input states, this function returns predictions for
         the next states. This is done by 1) evaluating the current pol
         2) using the dynamics model to estimate the next state. If x has
         shape [n, D] where n is tthe number of samples and D is the state
         dimension, this function will return x_next with shape [n, D]
         representing the next states and costs with shape [n, 1]
+        If u_prev is not None, the controls are held from the previous step
+        (zero-order hold) unless the symbolic condition new_control is true,
+        in which case the policy is evaluated; the applied controls are
+        then returned as a third output. If u_noise is not None, it is added
+        to the policy outputs (i.e. the controls are sampled from a
+        stochastic policy), and the applied controls are also returned.
     '''
     # convert angles from input states to their complex representation
     xa1 = utils.gTrig(latent_x, angle_dims)
-    xa2 = utils.gTrig(measured_x, angle_dims)
+
+    def policy_controls():
+        xa2 = utils.gTrig(measured_x, angle_dims)
+        u, sn_u = pol.predict(xa2, iid_per_eval=iid_per_eval,
+                              return_samples=True)
+        if u_noise is not None:
+            u = u + u_noise
+        return u
 
     # compute controls for each sample
-    u, sn_u = pol.predict(xa2, iid_per_eval=iid_per_eval,
-                          return_samples=True)
+    if u_prev is None:
+        u = policy_controls()
+    else:
+        # the policy is only evaluated when needed
+        u = theano.ifelse.ifelse(new_control, policy_controls(), u_prev)
 
     # build state-control vectors
     xu = tt.concatenate([xa1, u], axis=1)
@@ -34,6 +76,8 @@ def propagate_particles(latent_x, measured_x, pol, dyn, angle_dims=[],
 
     # compute the successor states
     x_next = latent_x + delta_x if deltas else delta_x
+    if u_prev is not None or u_noise is not None:
+        return x_next, sn_x, u
     return x_next, sn_x
 
 
@@ -43,11 +87,34 @@ def rollout(x0, H, gamma0,
             noisy_policy_input=True, noisy_cost_input=True,
             time_varying_cost=False, grad_clip=None, infer_noise_mm=False,
             truncate_gradient=-1, extra_shared=[],
-            split_H=1, **kwargs):
+            split_H=1, checkpoint=False, n_groups=1,
+            return_policy_inputs=False, action_repeat=1, action_noise=None,
+            z_u=None, **kwargs):
     ''' Given some initial state particles x0, and a prediction horizon H
     (number of timesteps), returns a set of trajectories sampled from the
     dynamics model and the discounted costs for each step in the
-    trajectory.
+    trajectory. If checkpoint is True (or an integer k), the rollout is
+    split into segments of sqrt(H) (or k) steps, whose intermediate steps
+    are recomputed during backpropagation (see utils.checkpointed_scan). In
+    this case, split_H and truncate_gradient are ignored and the gradients
+    are exact. The costs are returned for every step, but the trajectories
+    only contain the states at the segment boundaries (i.e. at steps 0, k,
+    2k, ..., H), so the memory used for the states is O(sqrt(H)). If
+    n_groups > 1, the particles are split into n_groups contiguous groups
+    of equal size, which are moment matched separately;
+    with mm_cost, the costs will contain one column per group. If
+    return_policy_inputs is True, the states used as inputs for the policy
+    (which include the measurement noise, if noisy_policy_input is True)
+    are returned as a third output. If action_repeat is k > 1, the policy is
+    only evaluated every k steps, and its controls are held constant
+    (zero-order hold) while the dynamics are propagated at every step. In
+    this case, the returned policy inputs are the measured states at every
+    step, including the ones where the policy was not evaluated. If
+    action_noise is not None, the controls are sampled from a gaussian
+    policy centered at the policy outputs, with standard deviation
+    action_noise, using the standard normal samples z_u [H, n, E]; the
+    applied controls are then returned as an additional output (after the
+    policy inputs, if requested).
     '''
     msg = 'Building computation graph for rollout'
     utils.print_with_stamp(msg, 'mc_pilco.rollout')
@@ -63,38 +130,32 @@ def rollout(x0, H, gamma0,
         tv_cost = cost
 
     # define internal scan computations
-    def step_rollout(t_next, z1, z2, z2_prev, x, sn, gamma, *args):
+    def eval_cost(t, xn, mxn=None, Sxn=None):
+        # moment-matching for cost
+        if mm_cost:
+            # compute input moments
+            if mxn is None:
+                mxn = xn.mean(0)
+            if Sxn is None:
+                n = xn.shape[0].astype(theano.config.floatX)
+                delta = xn - mxn
+                Sxn = delta.T.dot(delta)/(n-1)
+            # propagate gaussian through cost (should be implemented in
+            # cost func)
+            c = tv_cost(t, mxn, Sxn)
+            if isinstance(c, list) or isinstance(c, tuple):
+                c = c[0]
+        else:
+            c = tv_cost(t, xn, None)
+        return c
+
+    def resample_and_eval_cost(t_next, z1, z2, x_next, sn_next):
         '''
-            Single step of rollout.
+            Moment matching (if enabled) and cost evaluation for a group of
+            particles.
         '''
-        n = x.shape[0]
+        n = x_next.shape[0]
         n = n.astype(theano.config.floatX)
-
-        # noisy state measruement for control
-        xn = x + z2_prev*sn if noisy_policy_input else x
-
-        # get next state distribution
-        x_next, sn_next = propagate_particles(
-            x, xn, pol, dyn, **kwargs)
-
-        def eval_cost(t, xn, mxn=None, Sxn=None):
-            # moment-matching for cost
-            if mm_cost:
-                # compute input moments
-                if mxn is None:
-                    mxn = xn.mean(0)
-                if Sxn is None:
-                    delta = xn - mxn
-                    Sxn = delta.T.dot(delta)/(n-1)
-                # propagate gaussian through cost (should be implemented in
-                # cost func)
-                c = tv_cost(t, mxn, Sxn)
-                if isinstance(c, list) or isinstance(c, tuple):
-                    c = c[0]
-            else:
-                c = tv_cost(t, xn, None)
-            return c
-
         # if resampling (moment-matching for state)
         if mm_state:
             mx_next = x_next.mean(0)
@@ -123,6 +184,51 @@ def rollout(x0, H, gamma0,
             xn_next = x_next + z2*sn_next if noisy_cost_input else x_next
             #  get cost of applying action:
             c_next = eval_cost(t_next, xn_next)
+        return c_next, x_next
+
+    def step_rollout(t_next, z1, z2, z2_prev, *args):
+        '''
+            Single step of rollout.
+        '''
+        u_noise = None
+        if action_noise is not None:
+            u_noise, args = action_noise*args[0], args[1:]
+        x, sn, gamma = args[:3]
+        args = args[3:]
+        # noisy state measruement for control
+        xn = x + z2_prev*sn if noisy_policy_input else x
+
+        # get next state distribution
+        if action_noise is not None:
+            x_next, sn_next, u = propagate_particles(
+                x, xn, pol, dyn, u_noise=u_noise, **kwargs)
+        elif action_repeat > 1:
+            u_prev = args[0]
+            new_control = tt.eq((t_next - 1) % action_repeat, 0)
+            x_next, sn_next, u = propagate_particles(
+                x, xn, pol, dyn, u_prev=u_prev, new_control=new_control,
+                **kwargs)
+        else:
+            x_next, sn_next = propagate_particles(
+                x, xn, pol, dyn, **kwargs)
+
+        if n_groups > 1:
+            # the particles of every group (e.g. sampled from different
+            # initial state distributions) are treated independently
+            g = x_next.shape[0]//n_groups
+            c_next, x_groups = [], []
+            for i in range(n_groups):
+                idx = slice(i*g, (i+1)*g)
+                c_i, x_i = resample_and_eval_cost(
+                    t_next, z1[idx], z2[idx], x_next[idx], sn_next[idx])
+                c_next.append(c_i)
+                x_groups.append(x_i)
+            c_next = tt.stack(c_next) if mm_cost\
+                else tt.concatenate(c_next)
+            x_next = tt.concatenate(x_groups)
+        else:
+            c_next, x_next = resample_and_eval_cost(
+                t_next, z1, z2, x_next, sn_next)
 
         c_next = gamma*c_next
 
@@ -130,7 +236,11 @@ def rollout(x0, H, gamma0,
             x_next = theano.gradient.grad_clip(
                 x_next, -grad_clip, grad_clip)
 
-        return [c_next, x_next, sn_next, gamma*gamma0]
+        outs = [c_next, x_next, sn_next, gamma*gamma0, xn]
+        if action_repeat > 1 or action_noise is not None:
+            # the held (or sampled) controls are the last output
+            outs.append(u)
+        return outs
 
     # these are the shared variables that will be used in the scan graph.
     # we need to pass them as non_sequences here
@@ -140,32 +250,81 @@ def rollout(x0, H, gamma0,
     nseq.extend(pol.get_intermediate_outputs())
     nseq.extend(extra_shared)
 
+    # controls held between policy evaluations
+    u0 = [tt.zeros((x0.shape[0], pol.E))] if action_repeat > 1 else []
+    if action_noise is not None:
+        if action_repeat > 1:
+            msg = 'Stochastic policies are not supported with action_repeat'
+            raise ValueError(msg)
+        # the sampled controls are not recurrent
+        u0 = [None]
+        action_noise = np.array(action_noise, dtype=theano.config.floatX)
+
     # loop over the planning horizon
     mode = theano.compile.mode.get_mode('FAST_RUN')
-    costs, trajectories = [], [x0[None, :, :]]
-    # if split_H > 1, this results in truncated BPTT
-    H_ = tt.ceil(H*1.0/split_H).astype('int32')
-    for i in range(1, split_H+1):
-        start_idx = (i-1)*H_ + 1
-        end_idx = start_idx + H_
-
-        output = theano.scan(
-            fn=step_rollout, sequences=[tt.arange(start_idx, end_idx),
-                                        z[0, start_idx:end_idx],
-                                        z[1, start_idx:end_idx],
-                                        z[1, -end_idx:-start_idx]],
-            outputs_info=[None, x0, 1e-4*tt.ones_like(x0), gamma0],
-            non_sequences=nseq, strict=True, allow_gc=False,
-            truncate_gradient=H_-truncate_gradient,
-            name="mc_pilco>rollout_scan_%d" % i,
-            mode=mode)
-
+    costs, trajectories, policy_inputs = [], [x0[None, :, :]], []
+    controls = []
+    if checkpoint:
+        save_every = None if checkpoint is True else checkpoint
+        outputs_info = [None, x0, 1e-4*tt.ones_like(x0), gamma0, None] + u0
+        utils.print_with_stamp(
+            'Recomputing the rollout in segments of %s steps' % (
+                'sqrt(H)' if save_every is None else str(save_every)),
+            'mc_pilco.rollout')
+        # only the costs (and the policy inputs or sampled controls, if
+        # requested) are kept for every step
+        every_step = [True, False, False, False, return_policy_inputs]
+        every_step += [action_noise is not None]*len(u0)
+        output = utils.checkpointed_scan(
+            fn=step_rollout, sequences=[tt.arange(1, H+1),
+                                        z[0, 1:H+1],
+                                        z[1, 1:H+1],
+                                        z[1, :H]] + (
+                                            [z_u[:H]] if action_noise
+                                            is not None else []),
+            outputs_info=outputs_info,
+            non_sequences=nseq, n_steps=H, save_every=save_every,
+            every_step=every_step, strict=True, allow_gc=False,
+            name="mc_pilco>rollout_scan", mode=mode)
         rollout_output, rollout_updts = output
-        costs_i, trajectories_i = rollout_output[:2]
-        costs.append(costs_i)
-        trajectories.append(trajectories_i)
-        x0 = trajectories_i[-1, :, :]
-        x0 = theano.gradient.disconnected_grad(x0)
+        costs.append(rollout_output[0])
+        trajectories.append(rollout_output[1])
+        policy_inputs.append(rollout_output[4])
+        if action_noise is not None:
+            controls.append(rollout_output[5])
+    else:
+        # if split_H > 1, this results in truncated BPTT
+        H_ = tt.ceil(H*1.0/split_H).astype('int32')
+        for i in range(1, split_H+1):
+            start_idx = (i-1)*H_ + 1
+            end_idx = start_idx + H_
+            outputs_info = [None, x0, 1e-4*tt.ones_like(x0), gamma0, None] + u0
+
+            output = theano.scan(
+                fn=step_rollout, sequences=[tt.arange(start_idx, end_idx),
+                                            z[0, start_idx:end_idx],
+                                            z[1, start_idx:end_idx],
+                                            z[1, -end_idx:-start_idx]] + (
+                                                [z_u[start_idx-1:end_idx-1]]
+                                                if action_noise is not None
+                                                else []),
+                outputs_info=outputs_info,
+                non_sequences=nseq, strict=True, allow_gc=False,
+                truncate_gradient=H_-truncate_gradient,
+                name="mc_pilco>rollout_scan_%d" % i,
+                mode=mode)
+
+            rollout_output, rollout_updts = output
+            costs_i, trajectories_i = rollout_output[:2]
+            costs.append(costs_i)
+            trajectories.append(trajectories_i)
+            policy_inputs.append(rollout_output[4])
+            if action_noise is not None:
+                controls.append(rollout_output[5])
+            x0 = trajectories_i[-1, :, :]
+            x0 = theano.gradient.disconnected_grad(x0)
+            if action_repeat > 1:
+                u0 = [theano.gradient.disconnected_grad(rollout_output[5][-1])]
 
     costs = tt.concatenate(costs)
     trajectories = tt.concatenate(trajectories)
@@ -177,7 +336,550 @@ def rollout(x0, H, gamma0,
     # first axis; batch, second axis: time step
     trajectories = trajectories.transpose(1, 0, 2)
 
-    return [costs, trajectories], rollout_updts
+    outs = [costs, trajectories]
+    if return_policy_inputs:
+        # (measured) states used as inputs for the policy at every step
+        policy_inputs = tt.concatenate(policy_inputs).transpose(1, 0, 2)
+        outs.append(policy_inputs)
+    if action_noise is not None:
+        # controls applied at every step
+        outs.append(tt.concatenate(controls).transpose(1, 0, 2))
+    return outs, rollout_updts
+
+
+class ParticleCountAdapter(object):
+    '''
+        Adapts the number of particles used by mc_pilco, between iterations
+        of the policy optimizer, according to the variance of the gradient
+        estimate. The particles are split into n_groups groups and the
+        gradients of the loss of each group are used to estimate the
+        per-particle gradient variance. The number of particles is then
+        chosen such that the variance of the gradient estimate is a fraction
+        theta**2 of the squared norm of the mean gradient (the norm test of
+        Byrd et al., 2012). The new particle count is propagated to the
+        models via their update method.
+        @param min_samples minimum number of particles
+        @param max_samples maximum number of particles
+        @param n_groups number of particle groups used to estimate the
+                        gradient variance
+        @param theta relative tolerance on the gradient variance
+        @param adapt_every number of optimizer iterations between updates
+                           of the particle count
+        @param max_factor maximum change factor of the particle count in a
+                          single update
+    '''
+    def __init__(self, min_samples=10, max_samples=1000, n_groups=5,
+                 theta=0.5, adapt_every=10, max_factor=2.0,
+                 name='ParticleCountAdapter'):
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.n_groups = n_groups
+        self.theta = theta
+        self.adapt_every = adapt_every
+        self.max_factor = max_factor
+        self.name = name
+
+        self.n_samples = None
+        self.models = []
+        self.group_losses = None
+        self.stats_fn = None
+
+    def set_models(self, models, n_samples):
+        '''
+            Makes the given models share the same (shared variable) number of
+            samples, initialized to n_samples. Once the gradient statistics
+            have been compiled, the current (adapted) number of samples is
+            kept.
+        '''
+        if self.stats_fn is not None:
+            n_samples = self.n_samples.get_value()
+        n_samples = int(np.clip(n_samples, self.min_samples, self.max_samples))
+        self.models = [m for m in models if hasattr(m, 'update')]
+        self.n_samples = None
+        for m in self.models:
+            if isinstance(getattr(m, 'n_samples', None),
+                          tt.sharedvar.SharedVariable):
+                self.n_samples = m.n_samples
+                break
+        if self.n_samples is None:
+            self.n_samples = theano.shared(
+                np.array(n_samples).astype('int32'),
+                name='%s>n_samples' % (self.name))
+        self.n_samples.set_value(n_samples)
+        for m in self.models:
+            m.update(self.n_samples)
+        return self.n_samples
+
+    def set_particle_losses(self, particle_losses):
+        '''
+            Builds the per-group losses from the per-particle losses. This
+            is a no-op once the gradient statistics have been compiled (see
+            compile); i.e. other graphs built with this object afterwards
+            (e.g. by build_rollout) don't replace the loss of the optimizer.
+            @param particle_losses symbolic vector with the loss of each
+                                   particle
+        '''
+        if self.stats_fn is not None:
+            return
+        n = self.n_samples
+        group_size = n//self.n_groups
+        self.group_losses = particle_losses[:group_size*self.n_groups]\
+            .reshape((self.n_groups, group_size)).mean(1)
+
+    def compile(self, params, givens=None, mode=None):
+        '''
+            Compiles the function that returns the estimated trace of the
+            per-group gradient covariance and the squared norm of the mean
+            gradient.
+            @param params parameters with respect to which the gradients are
+                          computed
+            @param givens substitutions for the inputs of the loss (e.g.
+                          the shared inputs of the optimizer)
+        '''
+        utils.print_with_stamp(
+            'Compiling gradient statistics for %d particle groups' % (
+                self.n_groups), self.name)
+        G = []
+        for i in range(self.n_groups):
+            grads = theano.grad(self.group_losses[i], params)
+            G.append(tt.concatenate([g.flatten() for g in grads]))
+        G = tt.stack(G)
+        mG = G.mean(0)
+        trace_var = ((G - mG)**2).sum()/(self.n_groups - 1)
+        sq_norm = (mG**2).sum()
+        self.stats_fn = theano.function(
+            [], [trace_var, sq_norm], givens=givens,
+            on_unused_input='ignore', allow_input_downcast=True,
+            mode=mode)
+
+    def adapt(self):
+        '''
+            Estimates the gradient variance with the current number of
+            particles and updates the particle count of the models.
+        '''
+        n = int(self.n_samples.get_value())
+        trace_var, sq_norm = self.stats_fn()
+        # per particle variance
+        var = trace_var*(n//self.n_groups)
+        n_new = var/(max(sq_norm, 1e-16)*self.theta**2)
+        n_new = np.clip(n_new, n/self.max_factor, n*self.max_factor)
+        n_new = np.clip(n_new, self.min_samples, self.max_samples)
+        # round up to a multiple of the number of groups
+        n_new = int(self.n_groups*np.ceil(n_new/self.n_groups))
+        n_new = min(max(n_new, self.n_groups*2), self.max_samples)
+        if n_new != n:
+            for m in self.models:
+                m.update(n_new)
+            self.n_samples.set_value(n_new)
+        msg = 'Number of particles: %d (grad. variance: %E, sq. norm: %E)'
+        utils.print_with_stamp(msg % (n_new, var, sq_norm), self.name)
+        return n_new
+
+
+class RolloutReuse(object):
+    '''
+        Reuses the particle rollouts of previous iterations of the policy
+        optimizer, by importance weighting them under the current policy.
+        When enabled, the controls of the rollouts are sampled from a
+        gaussian policy centered at the policy outputs, with standard
+        deviation action_std (i.e. the objective is the expected cost of this
+        stochastic policy, for fresh and reused rollouts). After a fresh
+        rollout, the states used as policy inputs, the sampled controls, the
+        log density of the control noise and the accumulated cost of every
+        particle are cached. While the cache is in use, the loss is estimated
+        as the self-normalized importance weighted average of the cached
+        costs, with the weight of each particle given by the likelihood ratio
+        of its controls under the current and the sampling policy (the
+        dynamics terms of the trajectory densities cancel out, since the
+        states are cached). Only the policy is evaluated on the cached
+        inputs, which is much cheaper than a rollout, and the gradients are
+        the likelihood ratio gradients of the same objective. A fresh rollout
+        is triggered when the effective sample size (ESS) of the weights
+        drops below ess_threshold times the number of particles, or after
+        max_reuse consecutive iterations using the cache.
+        The particles must be rolled out independently (mm_state=False),
+        with per particle costs (mm_cost=False), and the dropout masks of the
+        policy must not change while the cache is in use (i.e. it requires
+        resample_dyn=False and crn_dropout=True in run_pilco_experiment).
+        @param ess_threshold minimum ESS, as a fraction of the number of
+                             particles, to keep using the cache
+        @param action_std standard deviation of the gaussian policy used to
+                          sample the controls. Defaults to 0.1*pol.maxU
+        @param max_reuse maximum number of consecutive iterations using the
+                         cache
+    '''
+    def __init__(self, ess_threshold=0.5, action_std=None, max_reuse=20,
+                 name='RolloutReuse'):
+        self.ess_threshold = ess_threshold
+        self.action_std = action_std
+        self.max_reuse = max_reuse
+        self.name = name
+        floatX = theano.config.floatX
+        self.use_cache = theano.shared(np.array(0, dtype='int8'),
+                                       name='%s>use_cache' % (self.name))
+        self.ess = theano.shared(np.array(0, dtype=floatX),
+                                 name='%s>ess' % (self.name))
+        self.n_reused = 0
+        self.n_fresh = 0
+
+    def get_action_std(self, pol):
+        '''
+            Returns the standard deviation of the sampling policy
+        '''
+        action_std = self.action_std
+        if action_std is None:
+            action_std = 0.1*np.array(getattr(pol, 'maxU', 1.0))
+        return np.array(action_std, dtype=theano.config.floatX)
+
+    def policy_controls(self, pol, x, angle_dims=[]):
+        '''
+            Evaluates the policy on the inputs x, with shape [n, H, D], using
+            the same dropout mask for every time step of each particle.
+        '''
+        def step(x_t):
+            u, sn_u = pol.predict(utils.gTrig(x_t, angle_dims),
+                                  iid_per_eval=False, return_samples=True)
+            return u
+        u, _ = theano.scan(step, sequences=[x.transpose(1, 0, 2)],
+                           name='%s>policy_scan' % (self.name))
+        return u.transpose(1, 0, 2)
+
+    def build(self, pol, loss, costs, policy_inputs, controls, z_u,
+              angle_dims=[], average=True):
+        '''
+            Returns the loss that switches between the fresh rollout loss
+            and the importance weighted estimate, and the updates for the
+            cache.
+            @param loss loss of the fresh rollout
+            @param costs per step costs of the fresh rollout [n, H]
+            @param policy_inputs states used as inputs for the policy [n, H,
+                                 D]
+            @param controls sampled controls [n, H, E]
+            @param z_u standard normal samples used to sample the controls
+                       [n, H, E]
+        '''
+        floatX = theano.config.floatX
+        ifelse = theano.ifelse.ifelse
+        self.inputs = theano.shared(np.zeros((1, 1, 1), dtype=floatX),
+                                    name='%s>inputs' % (self.name))
+        self.controls = theano.shared(np.zeros((1, 1, 1), dtype=floatX),
+                                      name='%s>controls' % (self.name))
+        self.log_q = theano.shared(np.zeros((1,), dtype=floatX),
+                                   name='%s>log_q' % (self.name))
+        self.returns = theano.shared(np.zeros((1,), dtype=floatX),
+                                     name='%s>returns' % (self.name))
+        action_std = self.get_action_std(pol)
+
+        # importance weighted loss with the cached rollouts; the log
+        # densities are up to the same normalization constant
+        u = self.policy_controls(pol, self.inputs, angle_dims)
+        log_p = -0.5*(((self.controls - u)/action_std)**2).sum(axis=[1, 2])
+        log_w = log_p - self.log_q
+        w = tt.nnet.softmax(log_w[None, :])[0]
+        loss_iw = (w*self.returns).sum()
+        ess = 1.0/(w**2).sum()
+
+        # cache the fresh rollouts
+        x = theano.gradient.disconnected_grad(policy_inputs)
+        u_fresh = theano.gradient.disconnected_grad(controls)
+        log_q = -0.5*(theano.gradient.disconnected_grad(z_u)**2).sum(
+            axis=[1, 2])
+        returns = costs.mean(-1) if average else costs.sum(-1)
+        returns = theano.gradient.disconnected_grad(returns)
+        n = tt.cast(returns.shape[0], floatX)
+
+        updates = theano.updates.OrderedUpdates()
+        updates[self.inputs] = ifelse(self.use_cache, self.inputs, x)
+        updates[self.controls] = ifelse(
+            self.use_cache, self.controls, u_fresh)
+        updates[self.log_q] = ifelse(self.use_cache, self.log_q, log_q)
+        updates[self.returns] = ifelse(
+            self.use_cache, self.returns, returns)
+        updates[self.ess] = ifelse(self.use_cache, ess.astype(floatX), n)
+
+        # ifelse is lazy, so only one of the losses is evaluated
+        return ifelse(self.use_cache, loss_iw, loss), updates
+
+    def reset(self):
+        '''
+            Forces a fresh rollout in the next iteration (e.g. after the
+            dynamics model has been updated)
+        '''
+        self.n_reused = 0
+        self.use_cache.set_value(np.array(0, dtype='int8'))
+
+    def after_update(self):
+        '''
+            Decides whether the next iteration should use the cache. To be
+            called after every iteration of the policy optimizer.
+        '''
+        n = self.returns.get_value().shape[0]
+        ess = float(self.ess.get_value())
+        reuse = ess >= self.ess_threshold*n and self.n_reused < self.max_reuse
+        if reuse:
+            self.n_reused += 1
+        else:
+            self.n_reused = 0
+            self.n_fresh += 1
+        self.use_cache.set_value(np.array(int(reuse), dtype='int8'))
+        return reuse
+
+
+class MultipleShooting(object):
+    '''
+        Multiple shooting formulation of the mc_pilco rollouts. The horizon
+        is split into n_segments segments of (up to) ceil(H/n_segments)
+        steps, which are rolled out in the same batch of particles; i.e. the
+        sequential scan only runs over the length of one segment. The first
+        segment starts from the initial state distribution, and every other
+        segment from a gaussian distribution with a learned mean and
+        cholesky factor (which are optimized along with the policy
+        parameters, see params). The mismatch between the moments of the
+        particles at the end of a segment and the start distribution of the
+        next one is added to the loss as a continuity penalty, weighted by
+        penalty (a shared variable, so it can be increased between
+        optimizations).
+        The start distributions should be initialized before optimizing
+        (see init_states), so that they are consistent with a single
+        shooting rollout.
+        @param n_segments number of segments
+        @param penalty weight of the continuity penalty
+    '''
+    def __init__(self, n_segments=4, penalty=10.0, jitter=1e-6,
+                 name='MultipleShooting'):
+        self.n_segments = n_segments
+        self.jitter = jitter
+        self.name = name
+        floatX = theano.config.floatX
+        self.penalty = theano.shared(np.array(penalty, dtype=floatX),
+                                     name='%s>penalty' % (self.name))
+        self.means = None
+        self.chols = None
+        self.params = []
+        self.init_fn = None
+
+    def start_states(self, mx0, Sx0, z0, D):
+        '''
+            Returns the initial particles of every segment, concatenated
+            along the first axis, given standard normal samples z0 with shape
+            [n_segments, n, D]
+        '''
+        floatX = theano.config.floatX
+        S = self.n_segments
+        if self.means is None or self.means.get_value().shape[-1] != D:
+            self.means = theano.shared(
+                np.zeros((S-1, D), dtype=floatX),
+                name='%s>means' % (self.name))
+            self.chols = theano.shared(
+                np.tile(1e-2*np.eye(D, dtype=floatX), (S-1, 1, 1)),
+                name='%s>chols' % (self.name))
+            self.params = [self.means, self.chols]
+            self.init_fn = None
+        x0 = [mx0 + z0[0].dot(tt.slinalg.cholesky(Sx0).T)]
+        for s in range(1, S):
+            x0.append(self.means[s-1] + z0[s].dot(tt.tril(self.chols[s-1]).T))
+        return tt.concatenate(x0)
+
+    def stitch(self, costs, trajectories, H, L, gamma, mm_cost=True):
+        '''
+            Concatenates the costs [n_segments*n, L] (or [n_segments, L] for
+            moment matched costs) and trajectories [n_segments*n, L+1, D] of
+            the segments into the costs [n, H] and trajectories [n, H+1, D]
+            over the whole horizon, and returns them with the continuity
+            penalty.
+        '''
+        S = self.n_segments
+        n = trajectories.shape[0]//S
+        D = trajectories.shape[2]
+        # discount the costs of each segment by its start time
+        c = costs[:, None, :] if mm_cost else costs.reshape((S, n, L))
+        c = c*(gamma**(tt.arange(S)*L))[:, None, None]
+        c = c.transpose(1, 0, 2).reshape((c.shape[1], S*L))[:, :H]
+        X = trajectories.reshape((S, n, L+1, D))
+        X_steps = X[:, :, 1:].transpose(1, 0, 2, 3).reshape((n, S*L, D))
+        X = tt.concatenate([X[0, :, :1], X_steps[:, :H]], axis=1)
+
+        # moments of the particles at the end of every segment (but the last)
+        ends = trajectories.reshape((S, n, L+1, D))[:-1, :, -1]
+        m_e = ends.mean(1)
+        delta = ends - m_e[:, None, :]
+        nf = tt.cast(n, theano.config.floatX)
+        S_e = tt.batched_dot(delta.transpose(0, 2, 1), delta)/(nf - 1)
+        Lc = tt.tril(self.chols)
+        S_s = tt.batched_dot(Lc, Lc.transpose(0, 2, 1))
+        defect = tt.square(m_e - self.means).sum() +\
+            tt.square(S_e - S_s).sum()
+        self.end_moments = [m_e, S_e]
+        return c, X, self.penalty*defect
+
+    def init_states(self, *inputs):
+        '''
+            Sets the start distribution of every segment to the moments at
+            the end of the previous one, by sweeping through the segments
+            (i.e. the result is consistent with a single shooting rollout).
+            @param inputs the inputs of the loss function (mx0, Sx0, H, gamma)
+        '''
+        if self.init_fn is None:
+            utils.print_with_stamp(
+                'Compiling segment initialization', self.name)
+            m_e, S_e = [theano.gradient.disconnected_grad(v)
+                        for v in self.end_moments]
+            eye = self.jitter*tt.eye(S_e.shape[1])
+            chols = tt.stack([tt.slinalg.cholesky(S_e[s] + eye)
+                              for s in range(self.n_segments - 1)])
+            self.init_fn = theano.function(
+                self.inps, [], updates=[(self.means, m_e),
+                                        (self.chols, chols)],
+                allow_input_downcast=True, on_unused_input='ignore')
+        for s in range(self.n_segments - 1):
+            self.init_fn(*inputs)
+
+
+class PopulationPolicy(object):
+    '''
+        Wraps a policy so that a population of parameter vectors can be
+        evaluated with a single rollout (e.g. by gradient free optimizers,
+        see get_population_loss). The particles are split into pop_size
+        contiguous blocks, one per candidate, and the policy outputs for the
+        i-th block are computed with the parameters in the i-th row of the
+        population matrix P (i.e. the parameters, flattened and concatenated
+        as in utils.wrap_params). The dynamics model is evaluated once for
+        all the particles. Other attributes are taken from the wrapped
+        policy.
+        If the wrapped policy is a network of dense layers (e.g. NNPolicy),
+        the layers are evaluated for all the candidates at once, with a
+        batched product of the particles of every candidate and its weights
+        (the dropout masks are shared by the candidates). The output noise
+        of the policy (which is not used by the rollouts) is then computed
+        with the parameters of the wrapped policy. Otherwise, the policy
+        graph is cloned for every candidate.
+        @param pol the policy to wrap
+        @param pop_size number of candidates (rows of P)
+        @param params the parameters replaced by the rows of P. Defaults to
+                      the policy parameters
+    '''
+    def __init__(self, pol, pop_size, params=None):
+        self.pol = pol
+        self.pop_size = pop_size
+        if params is None:
+            params = pol.get_params(symbolic=True)
+        self.params = params
+        self.p_shapes = [p.get_value(borrow=True).shape for p in params]
+        self.P = tt.matrix('%s>population' % (pol.name))
+
+    def __getattr__(self, name):
+        if name == 'pol':
+            raise AttributeError(name)
+        return getattr(self.pol, name)
+
+    def update(self, n_samples=None):
+        ''' Updates the wrapped policy with the number of particles per
+        candidate'''
+        if n_samples is not None:
+            n_samples = n_samples//self.pop_size
+        if hasattr(self.pol, 'update'):
+            self.pol.update(n_samples)
+
+    def get_intermediate_outputs(self):
+        return self.pol.get_intermediate_outputs() + [self.P]
+
+    def candidate_params(self, i):
+        ''' Returns a dictionary mapping the policy parameters to the
+        corresponding slices of the i-th row of P'''
+        replace, offset = {}, 0
+        for p, shape in zip(self.params, self.p_shapes):
+            size = int(np.prod(shape))
+            p_i = self.P[i, offset:offset+size].reshape(shape)
+            replace[p] = p_i.astype(p.dtype)
+            offset += size
+        return replace
+
+    def population_params(self):
+        ''' Returns a dictionary mapping the policy parameters to the
+        corresponding columns of P, with shape [pop_size] + param shape'''
+        replace, offset = {}, 0
+        for p, shape in zip(self.params, self.p_shapes):
+            size = int(np.prod(shape))
+            p_P = self.P[:, offset:offset+size].reshape(
+                (self.pop_size,) + shape)
+            replace[p] = p_P.astype(p.dtype)
+            offset += size
+        return replace
+
+    def batched_layers(self):
+        ''' Returns the layers of the wrapped policy network, if they can be
+        evaluated for all the candidates at once (dense layers, with the
+        forward pass of lasagne.layers.DenseLayer or
+        layers.DenseDropoutLayer). Otherwise, returns None'''
+        pol = self.pol
+        if getattr(pol, 'network', 0) is None and\
+                hasattr(pol, 'build_network'):
+            pol.build_network(pol.network_spec,
+                              params=pol.network_params or {},
+                              name=pol.name)
+        network = getattr(pol, 'network', None)
+        if network is None:
+            return None
+        forward_passes = (lasagne.layers.DenseLayer.get_output_for,
+                          layers.DenseDropoutLayer.get_output_for)
+        net_layers = lasagne.layers.get_all_layers(network)
+        for l in net_layers[1:]:
+            if not isinstance(l, lasagne.layers.DenseLayer) or\
+                    type(l).get_output_for not in forward_passes or\
+                    l.num_leading_axes != 1:
+                return None
+        return net_layers[1:]
+
+    def get_output(self, network, x, deterministic=False,
+                   fixed_noise_samples=False, **kwargs):
+        ''' Evaluates the dense layers of the network for the particles of
+        all the candidates, with the i-th block of particles multiplied by
+        the weights in the i-th row of P'''
+        P_params = self.population_params()
+        n_total = x.shape[0]
+        n = n_total//self.pop_size
+        h = x
+        for l in lasagne.layers.get_all_layers(network)[1:]:
+            if not deterministic and\
+                    isinstance(l, layers.DenseDropoutLayer):
+                if fixed_noise_samples:
+                    # the same masks for the particles of every candidate
+                    noise = tt.tile(l.noise, (self.pop_size, 1))
+                else:
+                    noise = l.sample_noise(h)
+                h = l.apply_noise(h, noise)
+            if l.W in P_params:
+                h_c = h.reshape((self.pop_size, n, h.shape[1]))
+                act = tt.batched_dot(h_c, P_params[l.W])
+                act = act.reshape((n_total, act.shape[2]))
+            else:
+                act = h.dot(l.W)
+            if l.b in P_params:
+                act = act + tt.repeat(P_params[l.b], n, axis=0)
+            elif l.b is not None:
+                act = act + l.b
+            h = l.nonlinearity(act)
+        return h
+
+    def predict(self, x, *args, **kwargs):
+        Sx = args[0] if len(args) > 0 else kwargs.get('Sx')
+        if Sx is None and self.batched_layers() is not None:
+            kwargs['get_output'] = self.get_output
+            return self.pol.predict(x, *args, **kwargs)
+        x_c = x.type('%s>candidate_inputs' % (self.pol.name))
+        outs = self.pol.predict(x_c, *args, **kwargs)
+        idx = [j for j, o in enumerate(outs) if o is not None]
+        n = x.shape[0]//self.pop_size
+        candidate_outs = []
+        for i in range(self.pop_size):
+            replace = self.candidate_params(i)
+            replace[x_c] = x[i*n:(i+1)*n]
+            candidate_outs.append(
+                theano.clone([outs[j] for j in idx], replace=replace))
+        ret = list(outs)
+        for j, o in zip(idx, zip(*candidate_outs)):
+            ret[j] = tt.concatenate(o)
+        return ret
 
 
 def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
@@ -186,6 +888,8 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
              time_varying_cost=False, resample_dyn=False, crn=True,
              average=True, minmax=False, grad_clip=None, truncate_gradient=-1,
              split_H=1, extra_shared=[], extra_updts_init=None,
+             sampler='iid', adaptive_samples=None, n_init_dists=None,
+             advance_crn=True, reuse_rollouts=None, multiple_shooting=None,
              **kwargs):
     '''
         Constructs the computation graph for the value function according to
@@ -218,7 +922,64 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
                            If True, the cost function will be called as
                            cost(t, x); i.e. the first argument will be the
                            timestep index t.
-        @param crn wheter to use common random numbers.
+        @param crn wheter to use common random numbers. The random number
+                   generator state (and not the samples) is stored, and
+                   shared by all the graphs built for the same pol and dyn
+                   (e.g. the loss and build_rollout). If crn is an integer,
+                   the samples are changed every crn evaluations.
+        @param advance_crn whether the common random numbers should be
+                           changed every crn evaluations of this graph. If
+                           False, the graph reuses the current samples.
+        @param reuse_rollouts if not None, a RolloutReuse object used to
+                              replace the rollouts by importance weighted
+                              estimates with the rollouts of previous
+                              iterations, while the effective sample size
+                              is large enough. The controls are then
+                              sampled from a gaussian policy (see
+                              RolloutReuse). Requires mm_state=False and
+                              mm_cost=False
+        @param sampler variance reduction method for drawing the initial
+                       particles and the rollout noise: 'iid', 'antithetic',
+                       'lhs' (latin hypercube) or 'sobol' (randomized quasi
+                       Monte Carlo). See utils.sampling
+        @param adaptive_samples if not None, a ParticleCountAdapter used to
+                                change the number of particles between
+                                optimizer iterations. The number of particles
+                                is then a shared variable, initialized to
+                                n_samples, and the CRN buffer is allocated
+                                for adaptive_samples.max_samples particles.
+        @param checkpoint if True (or an integer k), split the rollout into
+                          segments of sqrt(H) (or k) steps, which are
+                          recomputed during backpropagation (see
+                          utils.checkpointed_scan). The gradients are exact
+                          (split_H and truncate_gradient are ignored). The
+                          returned trajectories then only contain the states
+                          at the segment boundaries (see rollout)
+        @param n_init_dists if not None, the number K of initial state
+                            distributions. In this case, the mx0 and Sx0
+                            inputs are stacks of K means [K, D] and
+                            covariances [K, D, D], and an additional input
+                            w0 [K] with the weight of each distribution is
+                            required. n_samples particles are drawn from
+                            each distribution and rolled out in the same
+                            batch (the moment matching is done separately
+                            for each distribution). The loss is the weighted
+                            average of the per-distribution losses, which are
+                            returned as an additional output variable (the
+                            second one, or the last one if intermediate_outs
+                            is True).
+                            If pol is a PopulationPolicy, n_samples
+                            particles are rolled out for every candidate
+                            (with the same noise samples), and the
+                            per-candidate losses are returned in the same
+                            way (see get_population_loss).
+        @param multiple_shooting if not None, a MultipleShooting object. The
+                                 horizon is then split into segments that
+                                 are rolled out in the same batch, with
+                                 learned start distributions (whose
+                                 parameters, multiple_shooting.params, need
+                                 to be optimized along with the policy) and
+                                 a continuity penalty added to the loss.
         @return Returns a tuple of (outs, inps, updts). These correspond to the
                 output variables, input variables and updates dictionary, if
                 any.
@@ -227,26 +988,73 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
     # get angle dims from policy, if any
     if len(angle_dims) == 0 and hasattr(pol, 'angle_dims'):
         angle_dims = pol.angle_dims
+    K = n_init_dists
+    if multiple_shooting is not None and (
+            K is not None or adaptive_samples is not None or
+            reuse_rollouts is not None):
+        msg = 'Multiple shooting is not supported with multiple initial state'
+        msg += ' distributions, adaptive particle counts or rollout reuse'
+        raise ValueError(msg)
+    if multiple_shooting is not None and kwargs.get('checkpoint', False):
+        # the segments are stitched from the states at every step
+        msg = 'Multiple shooting is not supported with checkpoint'
+        raise ValueError(msg)
+    # number of segments rolled out in the same batch
+    S = 1 if multiple_shooting is None else multiple_shooting.n_segments
+    # number of candidate policies rolled out in the same batch
+    G = pol.pop_size if isinstance(pol, PopulationPolicy) else 1
+    if G > 1 and (K is not None or adaptive_samples is not None or
+                  multiple_shooting is not None or
+                  reuse_rollouts is not None):
+        msg = 'Policy populations are not supported with multiple initial'
+        msg += ' state distributions, adaptive particle counts, multiple'
+        msg += ' shooting or rollout reuse'
+        raise ValueError(msg)
+    if reuse_rollouts is not None and (mm_state or mm_cost or K is not None):
+        msg = 'Reusing rollouts requires independent particles and per'
+        msg += ' particle costs (mm_state=False, mm_cost=False) and a single'
+        msg += ' initial state distribution'
+        raise ValueError(msg)
     # make sure that the dynamics model has the same number of samples
-    if hasattr(dyn, 'update'):
-        dyn.update(n_samples)
-    if hasattr(pol, 'update'):
-        pol.update(n_samples)
+    if adaptive_samples is not None:
+        if sampler == 'sobol':
+            msg = 'The sobol sampler requires a fixed number of particles'
+            raise ValueError(msg)
+        if K is not None:
+            msg = 'Adaptive particle counts are not supported with multiple'
+            msg += ' initial state distributions'
+            raise ValueError(msg)
+        n_samples = adaptive_samples.set_models([dyn, pol], n_samples)
+        n_z = adaptive_samples.max_samples if crn else n_samples
+    else:
+        # total number of particles
+        n_z = S*n_samples if K is None else K*n_samples
+        if hasattr(dyn, 'update'):
+            dyn.update(G*n_z)
+        if hasattr(pol, 'update'):
+            pol.update(G*n_z)
 
     # initial state distribution
-    mx0 = tt.vector('mx0')
-    Sx0 = tt.matrix('Sx0')
+    if K is None:
+        mx0 = tt.vector('mx0')
+        Sx0 = tt.matrix('Sx0')
+    else:
+        utils.print_with_stamp(
+            "Using %d initial state distributions" % (K), 'mc_pilco.rollout')
+        mx0 = tt.matrix('mx0')
+        Sx0 = tt.tensor3('Sx0')
+        w0 = tt.vector('w0')
 
     # prediction horizon
     H = tt.iscalar('H')
     # discount factor
     gamma = tt.scalar('gamma')
-    # how many times we've done a forward pass
-    n_evals = theano.shared(0)
-    # new samples with every rollout
-    z = m_rng.normal((2, H+1, n_samples, mx0.shape[0]))
+    D = dyn.E
 
     # sample random numbers to be used in the rollout
+    utils.print_with_stamp(
+        "Drawing %s samples for the rollout noise" % (sampler),
+        'mc_pilco.rollout')
     updates = theano.updates.OrderedUpdates()
     if crn:
         utils.print_with_stamp(
@@ -259,39 +1067,86 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
         utils.print_with_stamp(
             "CRNs will be resampled every %d rollouts" % crn,
             "mc_pilco.rollout")
-        z_resampled = z
-        z_init = np.random.normal(
-            size=(2, 1000, n_samples, dyn.E)).astype(theano.config.floatX)
-        z = theano.shared(z_init)
-        updates[z] = theano.ifelse.ifelse(
-            tt.eq(n_evals % crn, 0), z_resampled, z)
-        updates[n_evals] = n_evals + 1
-
-        # now we will make sure that z is has the correct shape
-        z = theano.ifelse.ifelse(
-            z.shape[1] < H,
-            tt.tile(z, (1, tt.ceil(H/z.shape[0]).astype('int64'), 1, 1)),
-            z
-        )[:H+1]
+        # we only store the state of the random number generator, which is
+        # shared by all the graphs built for the same models; i.e. the
+        # samples are regenerated, with the size of the current horizon,
+        # at every evaluation
+        crn_rng = get_crn_stream(pol, dyn, n_z, D, sampler)
+        crn_rng.reset()
+        z = utils.sampling.symbolic_normal_samples(
+            (2, H+1, n_z, D), sampler, crn_rng)
+        if advance_crn:
+            # how many times we've done a forward pass. The samples are
+            # changed after every crn evaluations
+            n_evals = theano.shared(0)
+            updates += crn_rng.get_updates(tt.eq((n_evals + 1) % crn, 0))
+            updates[n_evals] = n_evals + 1
+    else:
+        # new samples with every rollout
+        z = utils.sampling.symbolic_normal_samples(
+            (2, H+1, n_z, D), sampler, m_rng)
+
+    if adaptive_samples is not None:
+        z = z[:, :, :n_samples]
+    if G > 1:
+        # every candidate gets the same rollout noise
+        z = tt.tile(z, (1, 1, G, 1))
 
     # draw initial set of particles
-    z0 = m_rng.normal((n_samples, mx0.shape[0]))
-    Lx0 = tt.slinalg.cholesky(Sx0)
-    x0 = mx0 + z0.dot(Lx0.T)
+    if multiple_shooting is not None:
+        utils.print_with_stamp(
+            "Using multiple shooting with %d segments" % (S),
+            'mc_pilco.rollout')
+        z0 = utils.sampling.symbolic_normal_samples(
+            (S, n_samples, D), sampler, m_rng)
+        x0 = multiple_shooting.start_states(mx0, Sx0, z0, D)
+        # number of steps per segment
+        H_r = (H + S - 1)//S
+    elif K is None:
+        z0 = utils.sampling.symbolic_normal_samples(
+            (n_samples, D), sampler, m_rng)
+        Lx0 = tt.slinalg.cholesky(Sx0)
+        x0 = mx0 + z0.dot(Lx0.T)
+    else:
+        z0 = utils.sampling.symbolic_normal_samples(
+            (K, n_samples, D), sampler, m_rng)
+        x0 = tt.concatenate(
+            [mx0[k] + z0[k].dot(tt.slinalg.cholesky(Sx0[k]).T)
+             for k in range(K)])
+    if G > 1:
+        x0 = tt.tile(x0, (G, 1))
 
-    if pol.Xm is None:
+    base_pol = pol.pol if isinstance(pol, PopulationPolicy) else pol
+    stats_dyns = policy_input_stats.setdefault(base_pol, weakref.WeakSet())
+    if pol.Xm is None or dyn in stats_dyns:
         # try to normalize policy inputs (output is implicitly normalized)
         Xm = dyn.Xm[:pol.D]
         Xc = tt.cov(dyn.X[:, :pol.D]-Xm, rowvar=False, ddof=1)
         iXs = tt.slinalg.cholesky(tt.nlinalg.matrix_inverse(Xc))
-        pol.set_params(dict(Xm=Xm.eval(), iXs=iXs.eval()), trainable=False)
+        if pol.Xm is None:
+            pol.set_params(dict(Xm=Xm.eval(), iXs=iXs.eval()),
+                           trainable=False)
+            stats_dyns.add(dyn)
 
-        # ensure we're always using the same scaling as the dynamics model
+        # ensure we're always using the same scaling as the dynamics model,
+        # in every graph built for the policy (e.g. the loss is not
+        # necessarily the first one)
         updates[pol.Xm] = Xm
         updates[pol.iXs] = iXs
 
+    if multiple_shooting is None:
+        H_r = H
+
+    action_noise = z_u = None
+    if reuse_rollouts is not None:
+        # the controls are sampled from a gaussian policy, so that the
+        # rollouts can be reweighted under new policy parameters
+        action_noise = reuse_rollouts.get_action_std(pol)
+        z_u = utils.sampling.symbolic_normal_samples(
+            (H, n_samples, pol.E), 'iid', m_rng)
+
     # get rollout output
-    r_outs, updts = rollout(x0, H, gamma,
+    r_outs, updts = rollout(x0, H_r, gamma,
                             pol, dyn, cost,
                             angle_dims=angle_dims,
                             z=z,
@@ -303,12 +1158,28 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
                             noisy_policy_input=noisy_policy_input,
                             noisy_cost_input=noisy_cost_input,
                             time_varying_cost=time_varying_cost,
-                            extra_shared=extra_shared, **kwargs)
+                            extra_shared=extra_shared,
+                            n_groups=S*G if K is None else K,
+                            return_policy_inputs=reuse_rollouts is not None,
+                            action_noise=action_noise, z_u=z_u,
+                            **kwargs)
 
-    costs, trajectories = r_outs
+    costs, trajectories = r_outs[:2]
+    if multiple_shooting is not None:
+        costs, trajectories, continuity_penalty = multiple_shooting.stitch(
+            costs, trajectories, H, H_r, gamma, mm_cost)
     acc_costs = costs.mean(-1, keepdims=True) if average\
         else costs.sum(-1, keepdims=True)
-    if minmax and not mm_cost:
+    if K is not None or G > 1:
+        # loss per initial state distribution (or per candidate policy)
+        if mm_cost:
+            losses = acc_costs[:, 0]
+        else:
+            losses = acc_costs[:, 0].reshape((K or G, n_samples)).mean(1)
+        losses.name = 'losses'
+        loss = (w0*losses).sum()/w0.sum() if K is not None\
+            else losses.mean()
+    elif minmax and not mm_cost:
         temp = acc_costs.std()
         utils.print_with_stamp(
             "Using softmax loss", 'mc_pilco.rollout')
@@ -324,10 +1195,33 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
         #          = (1/H)*sum E_{x_t}(c(x_t))
         loss = acc_costs.mean()
 
+    if adaptive_samples is not None:
+        adaptive_samples.set_particle_losses(acc_costs[:, 0])
+
+    if multiple_shooting is not None:
+        loss += continuity_penalty
+
+    if reuse_rollouts is not None:
+        utils.print_with_stamp(
+            "Reusing rollouts via importance weighting", 'mc_pilco.rollout')
+        loss, reuse_updts = reuse_rollouts.build(
+            pol, loss, costs, r_outs[2], r_outs[3], z_u.transpose(1, 0, 2),
+            angle_dims, average)
+        updts += reuse_updts
+
     inps = [mx0, Sx0, H, gamma]
+    if multiple_shooting is not None:
+        multiple_shooting.inps = inps
     updates += updts
     if callable(extra_updts_init):
         updates += extra_updts_init(loss, costs, trajectories)
+    if K is not None:
+        inps.append(w0)
+    if K is not None or G > 1:
+        if intermediate_outs:
+            return [loss, costs, trajectories, losses], inps, updates
+        else:
+            return [loss, losses], inps, updates
     if intermediate_outs:
         return [loss, costs, trajectories], inps, updates
     else:
@@ -335,8 +1229,29 @@ def get_loss(pol, dyn, cost, angle_dims=[], n_samples=100,
 
 
 def build_rollout(*args, **kwargs):
-    kwargs['intermediate_outs'] = True
-    outs, inps, updts = get_loss(*args, **kwargs)
-    rollout_fn = theano.function(inps, outs, updates=updts,
-                                 allow_input_downcast=True)
-    return rollout_fn
+    '''
+        Returns a (cached) RolloutEngine that evaluates the loss, the
+        per-step costs and the trajectories (and optionally the gradients)
+        with a single compiled function. See engine.RolloutEngine
+    '''
+    return engine.get_engine(get_loss, *args, **kwargs)
+
+
+def get_population_loss(pol, dyn, cost, pop_size, angle_dims=[],
+                        params=None, **kwargs):
+    '''
+        Constructs the computation graph for the losses of a population of
+        policy parameter vectors, which are evaluated with a single forward
+        rollout of pop_size*n_samples particles (see PopulationPolicy). This
+        is meant for gradient free optimizers (see ESOptimizer).
+        @param pop_size number of candidates
+        @param params the policy parameters replaced by the candidates.
+                      Defaults to the policy parameters
+        @return Returns a tuple of (losses, P, inps, updts), where losses[i]
+                is the loss for the parameters in the i-th row of the
+                population matrix P
+    '''
+    pop_pol = PopulationPolicy(pol, pop_size, params)
+    kwargs['intermediate_outs'] = False
+    outs, inps, updts = get_loss(pop_pol, dyn, cost, angle_dims, **kwargs)
+    return outs[1], pop_pol.P, inps, updts
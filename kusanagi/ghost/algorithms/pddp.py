@@ -1,6 +1,7 @@
 # pylint: disable=C0103
 import numpy as np
 import theano
+import time
 import theano.tensor as tt
 from kusanagi import utils
 from kusanagi.ghost import regression
@@ -108,21 +109,26 @@ def propagate_belief(mx, Sx, u, dynmodel, D, angle_dims=None):
 def rollout(mx0, Sx0,
             Z_nom, U_nom, I, L,
             dynmodel, cost,
-            D, angle_dims=None):
-    ''' Given some initial state distribution Normal(mx0,Sx0), and a
-    prediction horizon H (number of timesteps), returns the predicted state
-    distribution and discounted cost for every timestep. The discounted cost
-    is returned as a distribution, since the state is uncertain.'''
+            D, angle_dims=None, maxU=None):
+    ''' Given some initial state distribution Normal(mx0,Sx0), and a locally
+    linear time varying controller u[t] = u_nom[t] + I[t] + L[t].dot(z[t] -
+    z_nom[t]), where z[t] is the belief state (the mean and the upper
+    triangular part of the covariance of the state), returns the predicted
+    belief states z[1:H+1], the applied controls u[0:H] and the expected
+    cost at every predicted state. If maxU is not None, the controls are
+    clipped to [-maxU, maxU].'''
     msg = 'Building computation graph for belief state propagation'
-    utils.print_with_stamp(msg, 'pilco.rollout')
+    utils.print_with_stamp(msg, 'pddp.rollout')
 
     # define internal scan computations
-    def forward_step(z, z_nom, u_nom, L_, I_, *args):
+    def forward_step(z_nom, u_nom, L_, I_, z, *args):
         '''
             Single step of rollout.
         '''
         # get controls from local linear policy
         u = u_nom + I_ + L_.dot(z-z_nom)
+        if maxU is not None:
+            u = tt.clip(u, -maxU, maxU)
 
         # split z into the mean and covariance of the state
         mx, Sx, triu_indices = unwrap_belief(z, D)
@@ -137,7 +143,7 @@ def rollout(mx0, Sx0,
 
         #  get cost of applying action:
         mcost, Scost = cost(mx_next, Sx_next)
-        next_v = [z_next, u]
+        next_v = [z_next, u, mcost]
         return next_v, updates
 
     # these are the shared variables that will be used in the graph.
@@ -150,18 +156,18 @@ def rollout(mx0, Sx0,
     # create the nodes that return the result from scan
     rollout_output, updts = theano.scan(fn=forward_step,
                                         sequences=[Z_nom, U_nom, L, I],
-                                        outputs_info=[z0],
+                                        outputs_info=[z0, None, None],
                                         non_sequences=shared_vars,
                                         strict=True,
                                         allow_gc=False,
                                         name="pddp>rollout_scan")
 
-    z, u = rollout_output[:2]
+    z, u, c = rollout_output[:3]
 
-    return [z, u], updts
+    return [z, u, c], updts
 
 
-def build_pddp(dynmodel, cost, D, angle_dims=None):
+def build_pddp(dynmodel, cost, D, angle_dims=None, maxU=None):
     # initial state distribution
     mx0 = tt.vector('mx0')
     Sx0 = tt.matrix('Sx0')
@@ -173,7 +179,243 @@ def build_pddp(dynmodel, cost, D, angle_dims=None):
     I = tt.matrix('I')
     L = tt.tensor3('L')
 
-    [z, u], updts = rollout(mx0, Sx0, z_nom, u_nom, I, L,
-                            dynmodel, cost, D, angle_dims)
-
-    return [z, u], updts
+    [z, u, c], updts = rollout(mx0, Sx0, z_nom, u_nom, I, L,
+                               dynmodel, cost, D, angle_dims, maxU)
+
+    inps = [mx0, Sx0, z_nom, u_nom, I, L]
+    return [z, u, c], inps, updts
+
+
+def linearize(dynmodel, cost, D, angle_dims=None, chunk_size=16):
+    ''' Builds the computation graph for the linearization of the belief
+        dynamics z[t+1] = f(z[t], u[t]) along a nominal trajectory, and for
+        the first and second derivatives of the expected cost at the
+        predicted belief states. The jacobians of all the time steps are
+        computed in a single scan, with the batched jacobian from
+        utils.fast_jacobian.
+        @return Returns a tuple of (outs, inps, updts), where outs = [fz, fu,
+                lz, lzz], with shapes [H, Nz, Nz], [H, Nz, U], [H, Nz] and
+                [H, Nz, Nz], and inps = [Z, U, Z_next]: the belief states at
+                which the controls are applied, the controls and the
+                predicted belief states.
+    '''
+    Z = tt.matrix('Z')
+    U = tt.matrix('U')
+    Z_next = tt.matrix('Z_next')
+    Nz = D + D*(D+1)//2
+
+    def linearize_step(z, u, z_next, *args):
+        # dynamics jacobians with respect to the belief state and control
+        zu = tt.concatenate([z, u])
+        mx, Sx, triu_indices = unwrap_belief(zu[:Nz], D)
+        [mx_next, Sx_next], _ = propagate_belief(mx, Sx, zu[Nz:], dynmodel,
+                                                 D, angle_dims)
+        f = wrap_belief(mx_next, Sx_next, triu_indices)
+        J = utils.fast_jacobian(f, zu, chunk_size=chunk_size)
+
+        # derivatives of the expected cost at the predicted belief state
+        mx_next, Sx_next, _ = unwrap_belief(z_next, D)
+        mcost, Scost = cost(mx_next, Sx_next)
+        c = mcost.sum()
+        lz = theano.grad(c, z_next)
+        lzz = theano.gradient.hessian(c, z_next)
+        return J[:, :Nz], J[:, Nz:], lz, lzz
+
+    (fz, fu, lz, lzz), updts = theano.scan(
+        fn=linearize_step, sequences=[Z, U, Z_next],
+        non_sequences=dynmodel.get_all_shared_vars(),
+        allow_gc=False, name="pddp>linearize_scan")
+
+    return [fz, fu, lz, lzz], [Z, U, Z_next], updts
+
+
+def backward_pass(fz, fu, lz, lzz, mu=0.0):
+    ''' Riccati recursion for the locally linear controller, given the
+        linearized dynamics and the quadratic expansion of the cost
+        (as returned by linearize). The cost lz[t], lzz[t] corresponds to the
+        belief state reached after applying the control at time t. mu is
+        the regularization of the value function hessian (Tassa et al,
+        2012).
+        @return Returns a tuple (I, L, dV) with the open loop terms [H, U],
+                the feedback gains [H, U, Nz] and the coefficients of the
+                expected change in cost for a step size alpha:
+                dV[0]*alpha + dV[1]*alpha**2. If the control hessian is not
+                positive definite at any step, returns None
+    '''
+    H, Nz, Nu = fu.shape
+    I = np.zeros((H, Nu))
+    L = np.zeros((H, Nu, Nz))
+    dV = np.zeros(2)
+    Vz = lz[-1]
+    Vzz = lzz[-1]
+    for t in range(H-1, -1, -1):
+        Qz = fz[t].T.dot(Vz)
+        Qu = fu[t].T.dot(Vz)
+        Qzz = fz[t].T.dot(Vzz).dot(fz[t])
+        Quu = fu[t].T.dot(Vzz).dot(fu[t])
+        Quz = fu[t].T.dot(Vzz).dot(fz[t])
+        # the regularized terms are only used to compute the controller
+        Quu_reg = Quu + mu*fu[t].T.dot(fu[t])
+        Quz_reg = Quz + mu*fu[t].T.dot(fz[t])
+        try:
+            cQuu = np.linalg.cholesky(0.5*(Quu_reg + Quu_reg.T))
+        except np.linalg.LinAlgError:
+            return None
+        # solve for the open loop and feedback terms at once
+        IL = -np.linalg.solve(
+            cQuu.T, np.linalg.solve(cQuu, np.column_stack([Qu, Quz_reg])))
+        I[t], L[t] = IL[:, 0], IL[:, 1:]
+
+        # update the value function approximation
+        dV += [I[t].dot(Qu), 0.5*I[t].dot(Quu).dot(I[t])]
+        Vz = Qz + L[t].T.dot(Quu).dot(I[t]) + L[t].T.dot(Qu) + Quz.T.dot(I[t])
+        Vzz = Qzz + L[t].T.dot(Quu).dot(L[t]) + L[t].T.dot(Quz) +\
+            Quz.T.dot(L[t])
+        Vzz = 0.5*(Vzz + Vzz.T)
+        if t > 0:
+            # add the cost of the belief state at time t
+            Vz = Vz + lz[t-1]
+            Vzz = Vzz + lzz[t-1]
+    return I, L, dV
+
+
+class PDDP(object):
+    '''
+        Probabilistic differential dynamic programming (Pan and Theodorou,
+        2014). Optimizes a LocalLinearPolicy for the expected cost of the
+        belief state trajectory predicted with moment matching, by
+        iterating 1) the linearization of the belief dynamics along the
+        nominal trajectory (see linearize), 2) a Riccati backward pass (see
+        backward_pass) and 3) forward passes with a backtracking line search
+        over the step size of the open loop terms.
+        @param policy LocalLinearPolicy whose nominal trajectory and gains
+                      are optimized
+        @param dynmodel dynamics model compatible with moment matching
+        @param cost cost function, compatible with moment matching
+        @param max_iters maximum number of iterations
+        @param mu0 initial regularization for the backward pass
+        @param tol convergence threshold on the relative cost improvement
+    '''
+    def __init__(self, policy, dynmodel, cost, angle_dims=[], max_iters=50,
+                 mu0=1e-6, mu_max=1e10, tol=1e-6,
+                 alphas=10**np.linspace(0, -3, 11), chunk_size=16,
+                 name='PDDP', **kwargs):
+        self.policy = policy
+        self.dynmodel = dynmodel
+        self.cost = cost
+        self.angle_dims = angle_dims
+        self.max_iters = max_iters
+        self.mu0 = mu0
+        self.mu_max = mu_max
+        self.tol = tol
+        self.alphas = alphas
+        self.chunk_size = chunk_size
+        self.name = name
+        self.D = len(policy.m0)
+        self.rollout_fn = None
+        self.linearize_fn = None
+
+    def compile(self):
+        utils.print_with_stamp('Compiling belief rollout', self.name)
+        outs, inps, updts = build_pddp(
+            self.dynmodel, self.cost, self.D, self.angle_dims,
+            self.policy.maxU)
+        self.rollout_fn = theano.function(
+            inps, outs, updates=updts, allow_input_downcast=True)
+
+        utils.print_with_stamp('Compiling linearization', self.name)
+        outs, inps, updts = linearize(
+            self.dynmodel, self.cost, self.D, self.angle_dims,
+            self.chunk_size)
+        self.linearize_fn = theano.function(
+            inps, outs, updates=updts, allow_input_downcast=True)
+
+    def forward_pass(self, m0, S0, Z_nom, U_nom, I, L, alpha=1.0):
+        ''' Returns the belief states (including the initial one), the
+            controls and the total expected cost of the trajectory obtained
+            with the open loop terms scaled by alpha'''
+        z, u, c = self.rollout_fn(m0, S0, Z_nom, U_nom, alpha*I, L)
+        z0 = np.concatenate([m0, S0[np.triu_indices(self.D)]])
+        return np.vstack([z0, z]), u, c.sum()
+
+    def minimize(self, m0=None, S0=None, callback=None):
+        '''
+            Optimizes the nominal controls and feedback gains of the
+            policy, starting from the initial state distribution
+            Normal(m0, S0) (defaults to the one of the policy).
+            @return the expected cost of the final trajectory
+        '''
+        if self.rollout_fn is None or self.linearize_fn is None:
+            self.compile()
+        pol = self.policy
+        m0 = np.array(pol.m0 if m0 is None else m0, dtype=np.float64)
+        S0 = np.array(pol.S0 if S0 is None else S0, dtype=np.float64)
+
+        # initial nominal trajectory, from the current policy
+        U_nom, Z_nom, I, L = pol.get_params()
+        Z, U, c = self.forward_pass(m0, S0, Z_nom, U_nom, I, L)
+        Z_nom, U_nom = Z[:-1], U
+        I, L = np.zeros_like(I), np.zeros_like(L)
+        utils.print_with_stamp('Initial cost: %f' % (c), self.name)
+
+        mu = self.mu0
+        start_time = time.time()
+        for i in range(self.max_iters):
+            # 1. linearize along the nominal trajectory
+            fz, fu, lz, lzz = self.linearize_fn(Z_nom, U_nom, Z[1:])
+
+            # 2. backward pass (increasing the regularization until the
+            # control hessians are positive definite)
+            ret = None
+            while ret is None and mu <= self.mu_max:
+                ret = backward_pass(fz, fu, lz, lzz, mu)
+                if ret is None:
+                    mu = max(10*mu, 1e-6)
+            if ret is None:
+                utils.print_with_stamp(
+                    'Backward pass failed, stopping.', self.name)
+                break
+            I, L, dV = ret
+
+            # 3. forward pass with backtracking line search
+            accepted = False
+            for alpha in self.alphas:
+                Z_new, U_new, c_new = self.forward_pass(
+                    m0, S0, Z_nom, U_nom, I, L, alpha)
+                expected = -(alpha*dV[0] + alpha**2*dV[1])
+                ratio = (c - c_new)/expected if expected > 0 else\
+                    np.sign(c - c_new)
+                if ratio > 0.1:
+                    accepted = True
+                    break
+            if accepted:
+                dc = c - c_new
+                # the new controls become the nominal trajectory
+                Z, U_nom, c = Z_new, U_new, c_new
+                Z_nom = Z[:-1]
+                mu = mu/10.0
+                msg = 'Iter: %d, cost: %f, alpha: %f, mu: %E'
+                utils.print_with_stamp(msg % (i, c, alpha, mu), self.name,
+                                       True)
+                if callable(callback):
+                    callback(Z, U_nom, c)
+                if dc < self.tol*abs(c):
+                    break
+            else:
+                mu = max(10*mu, 1e-6)
+                if mu > self.mu_max:
+                    break
+
+        print('')
+        msg = 'Done. Final cost: %f, time [%f s]'
+        utils.print_with_stamp(msg % (c, time.time() - start_time), self.name)
+
+        # store the optimized controller in the policy. Since the open loop
+        # terms have been applied to the nominal controls, only the
+        # feedback gains are kept
+        pol.u_nominal.set_value(U_nom)
+        pol.z_nominal.set_value(Z_nom)
+        pol.I_.set_value(np.zeros_like(I))
+        pol.L_.set_value(L)
+        pol.state_changed = True
+        return c
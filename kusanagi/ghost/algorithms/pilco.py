@@ -4,9 +4,107 @@ import theano
 import theano.tensor as tt
 from kusanagi import utils
 from kusanagi.ghost import regression
+from kusanagi.ghost.algorithms import engine
+
+
+def sigma_points(mx, Sx, method='unscented', alpha=1.0, beta=2.0,
+                 kappa=0.0):
+    ''' Returns the 2D+1 sigma points of the distribution Normal(mx, Sx),
+        with shape [2D+1, D], and the weights used to compute the mean and
+        covariance of the transformed points. If method is 'cubature', the
+        spherical-radial cubature rule is used: the central point gets zero
+        weight and the others are placed at mx +/- sqrt(D) columns of
+        chol(Sx). Otherwise, the scaled unscented transform is used with the
+        given alpha, beta and kappa parameters. Note that with the defaults
+        (alpha=1, kappa=0) lambda = alpha^2(D + kappa) - D is zero, so the
+        central point gets zero weight for the mean and the sigma points are
+        the same as the cubature rule's; the only difference is the beta term
+        in the covariance weight of the central point. Use kappa > 0 (e.g.
+        kappa = 3 - D, for small D) to give weight to the central point.
+    '''
+    D = tt.cast(mx.shape[0], theano.config.floatX)
+    if method == 'cubature':
+        alpha, beta, kappa = 1.0, 0.0, 0.0
+    lmbda = alpha**2*(D + kappa) - D
+    L = tt.slinalg.cholesky(Sx)*tt.sqrt(D + lmbda)
+    X = tt.concatenate([mx[None, :], mx + L.T, mx - L.T], axis=0)
+    wi = tt.ones((2*mx.shape[0],))/(2*(D + lmbda))
+    wm = tt.concatenate([(lmbda/(D + lmbda))[None], wi])
+    wc = tt.concatenate([(lmbda/(D + lmbda) + 1 - alpha**2 + beta)[None], wi])
+    return X, wm, wc
+
+
+def predict_points(model, X):
+    ''' Returns the deterministic predictions of a regression model (or
+        policy) for a batch of inputs X, with shape [n, D], and the variance
+        of the predictions at every input (e.g. the observation noise of a
+        BNN, or the predictive variance of a GP). Models that support
+        batched predictions (BNN, NNPolicy, RBFGP, RBFPolicy) are evaluated
+        in a single call; the others are evaluated at every point with a
+        scan over the inputs. For the latter, the point prediction method of
+        the closest base class without uncertain inputs is used (e.g.
+        GP.predict for GP_UI), so no second moments are computed.
+    '''
+    if isinstance(model, regression.BNN) or\
+       isinstance(model, regression.RBFGP):
+        Y, sn = model.predict(X, None, deterministic=True,
+                              return_samples=True)
+        return Y, tt.square(sn)
+
+    predict = next(
+        c.__dict__['predict'] for c in type(model).__mro__
+        if 'predict' in c.__dict__ and not issubclass(c, regression.GP_UI))
+
+    def predict_point(x, *args):
+        M, S, V = predict(model, x, None)
+        return M, tt.diag(S)
+
+    (Y, Sy), updts = theano.scan(
+        fn=predict_point, sequences=[X],
+        non_sequences=model.get_intermediate_outputs(),
+        allow_gc=False, name='%s>predict_points_scan' % (model.name))
+    return Y, Sy
+
+
+def propagate_sigma_points(mx, Sx, policy, dynmodel, angle_dims=None,
+                           method='unscented', ut_params={}):
+    ''' Computes the successor state distribution with a sigma point
+        approximation, instead of moment matching: the sigma points of
+        Normal(mx, Sx) are propagated through the deterministic predictions
+        of the policy and dynamics model (see predict_points) and the mean
+        and covariance of the next state are estimated from the propagated
+        points. This only requires batched point predictions from the
+        models, so any regressor can be used for the policy and dynamics.
+        The policy noise is ignored, as in the moment matching case.
+        @param method 'unscented' or 'cubature' (see sigma_points)
+        @param ut_params dictionary with the alpha, beta and kappa
+                         parameters of the unscented transform
+    '''
+    if angle_dims is None:
+        angle_dims = []
+    X, wm, wc = sigma_points(mx, Sx, method, **ut_params)
+
+    # evaluate the policy and dynamics at every sigma point
+    Xa = utils.gTrig(X, angle_dims)
+    U, _ = predict_points(policy, Xa)
+    deltaX, Sdelta = predict_points(dynmodel, tt.concatenate([Xa, U], axis=1))
+    X_next = X + deltaX
+
+    # weighted statistics of the propagated points
+    mx_next = wm.dot(X_next)
+    dX = X_next - mx_next
+    Sx_next = (wc[:, None]*dX).T.dot(dX)
+    # add the expected predictive variance of the dynamics model
+    Sx_next += tt.diag(wm.dot(Sdelta))
+    Sx_next = 0.5*(Sx_next + Sx_next.T)
+
+    updates = theano.updates.OrderedUpdates()
+    return [mx_next, Sx_next], updates
 
 
-def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None):
+def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None,
+                     propagation='moment_matching', ut_params={},
+                     u_dist=None, new_control=None):
     ''' Given the input variables mx (tt.vector) and Sx (tt.matrix),
         representing the mean and variance of the system's state x, this
         function returns the next state distribution, and the mean and
@@ -22,10 +120,31 @@ def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None):
         @param mx mean of state distribution
         @param Sx variance of state distribution
         @param dynmodel dynamics model compatible with moment matching
+                        (e.g. regression.BNN with analytic_moments=True)
         @param policy Interface to the policy operations, compatible with
                moment matching
         @param cost cost function, compatible with moment matching
+        @param propagation 'moment_matching' (default), or 'unscented' and
+                           'cubature' for a sigma point approximation that
+                           only requires deterministic predictions from the
+                           models (see propagate_sigma_points)
+        @param ut_params parameters for the sigma point approximation
+        @param u_dist distribution of the control applied at the previous
+                      step, as a list [mu, Su, Cxu], where Cxu is the
+                      covariance between the state and the control. If not
+                      None, the control is held (zero-order hold) unless the
+                      symbolic condition new_control is true, in which case
+                      the policy is evaluated. The distribution of the
+                      applied control (with its covariance with the next
+                      state) is then appended to the outputs. Only supported
+                      with moment matching.
     '''
+    if propagation in ('unscented', 'cubature'):
+        if u_dist is not None:
+            msg = 'Holding the controls is only supported with moment matching'
+            raise ValueError(msg)
+        return propagate_sigma_points(mx, Sx, policy, dynmodel, angle_dims,
+                                      propagation, ut_params)
     if angle_dims is None:
         angle_dims = []
     if isinstance(angle_dims, list) or isinstance(angle_dims, tuple):
@@ -35,16 +154,40 @@ def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None):
     # convert angles from input distribution to their complex representation
     mxa, Sxa, Ca = utils.gTrig2(mx, Sx, angle_dims)
 
-    # compute distribution of control signal
-    mu, Su, Cu = policy.predict(mxa, Sxa)
+    idx = tt.arange(D)
+    non_angle_dims = (1-tt.eq(idx, angle_dims[:, None])).prod(0).nonzero()[0]
+    # linear map such that the covariance between x and its complex
+    # representation is Sx.dot(J)
+    J = tt.concatenate([tt.eye(D)[:, non_angle_dims], Ca], axis=1)
+
+    def policy_dist():
+        # compute distribution of control signal
+        mu, Su, Cu = policy.predict(mxa, Sxa)
+        if isinstance(policy, regression.SSGP) or\
+           isinstance(policy, regression.BNN):
+            q = Cu
+            Cxu = Sx.dot(J).dot(tt.slinalg.solve(Sxa, q))
+        else:
+            q = Sxa.dot(Cu)
+            Cxu = Sx.dot(J).dot(Cu)
+        return [mu, Su, q, Cxu]
+
+    if u_dist is None:
+        mu, Su, q, Cxu = policy_dist()
+    else:
+        # the covariance between the complex representation of the state
+        # and the held control, from the covariance with the state
+        mu, Su, Cxu = u_dist
+        held = [mu, Su, J.T.dot(Cxu), Cxu]
+        if new_control is not None:
+            # the policy is only evaluated when needed
+            mu, Su, q, Cxu = theano.ifelse.ifelse(
+                new_control, policy_dist(), held)
+        else:
+            mu, Su, q, Cxu = held
 
     # compute state control joint distribution
     mxu = tt.concatenate([mxa, mu])
-    if isinstance(policy, regression.SSGP) or\
-       isinstance(policy, regression.BNN):
-        q = Cu
-    else:
-        q = Sxa.dot(Cu)
     Sxu_up = tt.concatenate([Sxa, q], axis=1)
     Sxu_lo = tt.concatenate([q.T, Su], axis=1)
     Sxu = tt.concatenate([Sxu_up, Sxu_lo], axis=0)  # [D+U]x[D+U]
@@ -64,8 +207,6 @@ def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None):
     else:
         Sxu_deltax = Sxu.dot(C_deltax)
 
-    idx = tt.arange(D)
-    non_angle_dims = (1-tt.eq(idx, angle_dims[:, None])).prod(0).nonzero()[0]
     Da = D+angle_dims.size
     Dna = D-angle_dims.size
     # this contains the covariance between the previous state (with angles
@@ -90,16 +231,74 @@ def propagate_belief(mx, Sx, policy, dynmodel, angle_dims=None):
     # check if dynamics model has an updates dictionary
     updates = theano.updates.OrderedUpdates()
 
+    if u_dist is not None:
+        # covariance between the next state and the applied control
+        Cxu_next = Cxu + Sxu_deltax[Da:].T
+        return [mx_next, Sx_next, mu, Su, Cxu_next], updates
     return [mx_next, Sx_next], updates
 
 
+def propagate_mean(mx, policy, dynmodel, angle_dims=None):
+    ''' Returns the next state for the state mx, using the deterministic
+        predictions of the policy and the dynamics model (see
+        predict_points). No second moments are computed.
+    '''
+    if angle_dims is None:
+        angle_dims = []
+    xa = utils.gTrig(mx[None, :], angle_dims)
+    u, _ = predict_points(policy, xa)
+    delta_x, _ = predict_points(dynmodel, tt.concatenate([xa, u], axis=1))
+    return mx + delta_x[0]
+
+
+def rollout_mean(mx0, H, gamma, policy, dynmodel, cost, angle_dims=None):
+    ''' Propagates only the mean of the state distribution, starting from
+        mx0, and evaluates the cost at the predicted states. This is much
+        cheaper than rollout, as it skips all the second moment
+        computations, and is meant for quick evaluations of a policy (e.g.
+        screening candidates, checking whether the task was learned, or
+        plotting).'''
+    msg = 'Building computation graph for mean state propagation'
+    utils.print_with_stamp(msg, 'pilco.rollout_mean')
+
+    def step_rollout(i, mx, *args):
+        mx_next = propagate_mean(mx, policy, dynmodel, angle_dims)
+        c = cost(mx_next[None, :], None).flatten()[0]
+        gamma = args[0]
+        return [gamma**i*c, mx_next]
+
+    nseq = [gamma]
+    nseq.extend(dynmodel.get_intermediate_outputs())
+    nseq.extend(policy.get_intermediate_outputs())
+
+    (mean_costs, mean_states), updts = theano.scan(
+        fn=step_rollout, sequences=[theano.tensor.arange(H)],
+        outputs_info=[None, mx0], non_sequences=nseq,
+        strict=True, allow_gc=False, name="pilco>rollout_mean_scan")
+
+    mean_costs.name = 'mc_list'
+    mean_states.name = 'mx_list'
+
+    return [mean_costs, mean_states], updts
+
+
 def rollout(mx0, Sx0, H, gamma,
             policy, dynmodel, cost,
-            angle_dims=None):
+            angle_dims=None, checkpoint=False,
+            propagation='moment_matching', ut_params={}, action_repeat=1):
     ''' Given some initial state distribution Normal(mx0,Sx0), and a
     prediction horizon H (number of timesteps), returns the predicted state
     distribution and discounted cost for every timestep. The discounted cost
-    is returned as a distribution, since the state is uncertain.'''
+    is returned as a distribution, since the state is uncertain. If
+    checkpoint is True (or an integer k), the rollout is split into segments
+    of sqrt(H) (or k) steps, whose intermediate steps are recomputed for
+    backpropagation (see utils.checkpointed_scan); the cost distributions
+    are returned for every step, but the state distributions only for the
+    last step of every segment (i.e. steps k, 2k, ..., H). The belief states
+    are propagated with the given propagation method (see
+    propagate_belief). If action_repeat is k > 1, the policy is only
+    evaluated every k steps, and the control distribution is held constant
+    (zero-order hold) in between.'''
     msg = 'Building computation graph for belief state propagation'
     utils.print_with_stamp(msg, 'pilco.rollout')
 
@@ -109,15 +308,24 @@ def rollout(mx0, Sx0, H, gamma,
             Single step of rollout.
         '''
         # get next state distribution
-        b_out, updates = propagate_belief(mx, Sx, policy, dynmodel,
-                                          angle_dims)
-        mx_next, Sx_next = b_out
+        if action_repeat > 1:
+            u_dist = list(args[:3])
+            args = args[3:]
+            b_out, updates = propagate_belief(
+                mx, Sx, policy, dynmodel, angle_dims, propagation, ut_params,
+                u_dist=u_dist, new_control=tt.eq(i % action_repeat, 0))
+        else:
+            b_out, updates = propagate_belief(
+                mx, Sx, policy, dynmodel, angle_dims, propagation, ut_params)
+        mx_next, Sx_next = b_out[:2]
 
         #  get cost of applying action:
         mcost, Scost = cost(mx_next, Sx_next)
         gamma = args[0]
         gamma_i = gamma**i
         next_v = [gamma_i*mcost, tt.square(gamma_i)*Scost, mx_next, Sx_next]
+        # held control distribution
+        next_v += b_out[2:]
         return next_v, updates
 
     # these are the shared variables that will be used in the graph.
@@ -127,14 +335,26 @@ def rollout(mx0, Sx0, H, gamma,
     nseq.extend(dynmodel.get_intermediate_outputs())
     nseq.extend(policy.get_intermediate_outputs())
 
+    outputs_info = [None, None, mx0, Sx0]
+    if action_repeat > 1:
+        # initial (held) control distribution, replaced at the first step
+        U = policy.E
+        outputs_info += [tt.zeros((U,)), tt.zeros((U, U)),
+                         tt.zeros((mx0.shape[0], U))]
+
     # create the nodes that return the result from scan
-    rollout_output, updts = theano.scan(fn=step_rollout,
-                                        sequences=[theano.tensor.arange(H)],
-                                        outputs_info=[None, None, mx0, Sx0],
-                                        non_sequences=nseq,
-                                        strict=True,
-                                        allow_gc=False,
-                                        name="pilco>rollout_scan")
+    if checkpoint:
+        save_every = None if checkpoint is True else checkpoint
+        rollout_output, updts = utils.checkpointed_scan(
+            fn=step_rollout, sequences=[theano.tensor.arange(H)],
+            outputs_info=outputs_info, non_sequences=nseq,
+            n_steps=H, save_every=save_every, strict=True, allow_gc=False,
+            name="pilco>rollout_scan")
+    else:
+        rollout_output, updts = theano.scan(
+            fn=step_rollout, sequences=[theano.tensor.arange(H)],
+            outputs_info=outputs_info, non_sequences=nseq,
+            strict=True, allow_gc=False, name="pilco>rollout_scan")
 
     mean_costs, var_costs, mean_states, cov_states = rollout_output[:4]
 
@@ -163,6 +383,21 @@ def get_loss(policy, dynmodel, cost, angle_dims, intermediate_outs=False,
         @param D number of state dimensions, must be a python integer
         @param angle_dims angle dimensions that should be converted to complex
                           representation
+        @param checkpoint if True (or an integer k), recompute the rollout
+                          in segments of sqrt(H) (or k) steps for
+                          backpropagation. The intermediate outputs then
+                          only contain the state distributions at the end of
+                          every segment (see rollout)
+        @param mean_only if True, only the mean of the state distribution is
+                         propagated (see rollout_mean). The intermediate
+                         outputs are then the costs and states of the mean
+                         trajectory, with shapes [1, H] and [1, H, D] (as
+                         for a single particle in mc_pilco)
+        @param action_repeat number of steps each control is held for (see
+                             rollout)
+        @param propagation method used for propagating the belief states:
+                           'moment_matching' (default), 'unscented' or
+                           'cubature' (see propagate_belief)
         @return Returns a tuple of (outs, inps, updts). These correspond to the
                 output variables, input variables and updates dictionary, if
                 any. By default, the only output variable is the value.
@@ -177,10 +412,25 @@ def get_loss(policy, dynmodel, cost, angle_dims, intermediate_outs=False,
 
     inps = [mx0, Sx0, H, gamma]
 
+    if kwargs.get('mean_only', False):
+        (mean_costs, mean_states), updts = rollout_mean(
+            mx0, H, gamma, policy, dynmodel, cost, angle_dims)
+        loss = mean_costs.mean()
+        if intermediate_outs:
+            return [loss, mean_costs[None, :], mean_states[None, :, :]],\
+                inps, updts
+        else:
+            return loss, inps, updts
+
     # get rollout output
     r_outs, updts = rollout(mx0, Sx0, H, gamma,
                             policy, dynmodel, cost,
-                            angle_dims)
+                            angle_dims,
+                            checkpoint=kwargs.get('checkpoint', False),
+                            propagation=kwargs.get('propagation',
+                                                   'moment_matching'),
+                            ut_params=kwargs.get('ut_params', {}),
+                            action_repeat=kwargs.get('action_repeat', 1))
 
     mean_costs = r_outs[0]
 
@@ -195,8 +445,20 @@ def get_loss(policy, dynmodel, cost, angle_dims, intermediate_outs=False,
 
 
 def build_rollout(*args, **kwargs):
-    kwargs['intermediate_outs'] = True
-    outs, inps, updts = get_loss(*args, **kwargs)
-    rollout_fn = theano.function(inps, outs, updates=updts,
-                                 allow_input_downcast=True)
-    return rollout_fn
+    '''
+        Returns a (cached) RolloutEngine that evaluates the loss and the
+        predicted cost and state distributions (and optionally the
+        gradients) with a single compiled function. See engine.RolloutEngine
+    '''
+    return engine.get_engine(get_loss, *args, **kwargs)
+
+
+def build_mean_rollout(*args, **kwargs):
+    '''
+        Returns a (cached) RolloutEngine for the mean only rollout (see
+        rollout_mean). Its outputs have the same layout as the mc_pilco
+        rollout functions (loss, costs, trajectories), so they can be used
+        with the plotting and evaluation utilities.
+    '''
+    kwargs['mean_only'] = True
+    return engine.get_engine(get_loss, *args, **kwargs)
@@ -1,18 +1,110 @@
+import lasagne
 import numpy as np
 import theano
 import theano.tensor as tt
 
-from kusanagi.ghost.regression import BNN
-from kusanagi.ghost.control.saturation import sfunc, tanhSat as sat
+from scipy.special import expit
+from kusanagi.ghost.regression import BNN, layers
+from kusanagi.ghost.control.saturation import (sfunc, tanhSat, sigmoidSat,
+                                               maxSat)
 from functools import partial
 
 from kusanagi import utils
 
 
+def numpy_nonlinearity(f):
+    ''' Returns a numpy function that applies the nonlinearity f in place
+        (i.e. the input array is overwritten with the output) '''
+    nl = lasagne.nonlinearities
+    if f in (None, nl.linear, nl.identity):
+        return None
+    elif f is nl.rectify:
+        return lambda x: np.maximum(x, 0, out=x)
+    elif f is nl.tanh:
+        return lambda x: np.tanh(x, out=x)
+    elif f is nl.sigmoid:
+        return lambda x: expit(x, out=x)
+    elif isinstance(f, partial) and f.func is sfunc:
+        # saturating functions of the form sat_func(x, e) + bias
+        bias = np.array(f.args[0], dtype=np.float64)
+        sat_func = f.args[1]
+        e = np.array(sat_func.keywords['e'], dtype=np.float64)
+        if sat_func.func is tanhSat:
+            def sat_np(x):
+                np.tanh(x, out=x)
+                x *= e
+        elif sat_func.func is sigmoidSat:
+            def sat_np(x):
+                expit(x, out=x)
+                x *= 2
+                x -= 1
+                x *= e
+        elif sat_func.func is maxSat:
+            def sat_np(x):
+                np.clip(x, -e, e, out=x)
+        else:
+            msg = 'No numpy implementation for saturating function %s'
+            raise NotImplementedError(msg % (str(sat_func.func)))
+
+        def sfunc_np(x):
+            sat_np(x)
+            x += bias
+        return sfunc_np
+    else:
+        msg = 'No numpy implementation for nonlinearity %s'
+        raise NotImplementedError(msg % (str(f)))
+
+
+class NumpyPolicy(object):
+    ''' Frozen numpy implementation of a NNPolicy, for real time control.
+        The dropout masks (or their mean) and the input whitening are folded
+        into the network weights, and all the intermediate activations are
+        stored in preallocated buffers; i.e. no memory is allocated when
+        calling this object. Note that the returned control signal is a view
+        of an internal buffer, which is overwritten at every call.
+    '''
+    def __init__(self, weights, biases, nonlinearities, Ym, Ys, E,
+                 sat_func=None, name='NumpyPolicy'):
+        self.name = name
+        self.E = E
+        self.D = weights[0].shape[0]
+        self.weights = [np.ascontiguousarray(W, dtype=np.float64)
+                        for W in weights]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float64)
+                       for b in biases]
+        self.nonlinearities = [numpy_nonlinearity(f) for f in nonlinearities]
+        self.Ym = np.ascontiguousarray(Ym, dtype=np.float64)
+        self.Ys = np.ascontiguousarray(Ys, dtype=np.float64)
+        self.sat_func = numpy_nonlinearity(sat_func)
+
+        # preallocated buffers
+        self.x = np.empty((self.D,), dtype=np.float64)
+        self.h = [np.empty((W.shape[1],), dtype=np.float64)
+                  for W in self.weights]
+        self.u = np.empty((E,), dtype=np.float64)
+
+    def __call__(self, m, s=None, t=None, **kwargs):
+        np.copyto(self.x, m.reshape(-1))
+        h_in = self.x
+        for W, b, f, h in zip(self.weights, self.biases,
+                              self.nonlinearities, self.h):
+            np.dot(h_in, W, out=h)
+            h += b
+            if f is not None:
+                f(h)
+            h_in = h
+        # scale and center outputs
+        np.dot(h_in[:self.E], self.Ys, out=self.u)
+        self.u += self.Ym
+        if self.sat_func is not None:
+            self.sat_func(self.u)
+        return self.u
+
+
 # NN controller
 class NNPolicy(BNN):
     def __init__(self, input_dims, maxU=[10], minU=None, angle_dims=[],
-                 sat_func=sat, name='NNPolicy', filename=None, **kwargs):
+                 sat_func=tanhSat, name='NNPolicy', filename=None, **kwargs):
         # policy output noise is not input-dependent by default
         kwargs['heteroscedastic'] = kwargs.get('heteroscedastic', False)
         self.maxU = np.array(maxU, dtype=theano.config.floatX)
@@ -86,3 +178,54 @@ class NNPolicy(BNN):
 
     def __call__(self, m, s=None, t=None, **kwargs):
         return super(NNPolicy, self).__call__(m, s, **kwargs)
+
+    def export_numpy(self, mask_index=None, deterministic=False):
+        ''' Returns a NumpyPolicy with the current parameters of this policy.
+            If mask_index is not None, the network will use the dropout
+            masks stored at that index of the fixed noise samples (see
+            update). Otherwise, the noise is replaced by its mean (the mean
+            network). If deterministic is True, the noise is ignored.'''
+        if self.network is None:
+            self.build_network(self.network_spec,
+                               params=self.network_params or {},
+                               name=self.name)
+        weights, biases, nonlinearities = [], [], []
+        for l in lasagne.layers.get_all_layers(self.network):
+            if isinstance(l, lasagne.layers.InputLayer):
+                continue
+            if not isinstance(l, lasagne.layers.DenseLayer):
+                msg = 'Unsupported layer type %s'
+                raise NotImplementedError(msg % (l.__class__.__name__))
+            W = l.W.get_value()
+            b = (l.b.get_value() if l.b is not None
+                 else np.zeros((W.shape[1],)))
+            is_dropout = isinstance(l, layers.DenseDropoutLayer) and\
+                not isinstance(l, layers.DenseAdditiveGaussianDropoutLayer)
+            if is_dropout and not deterministic:
+                if mask_index is None:
+                    mask = l.noise_moments()[0]
+                else:
+                    noise = l.noise[mask_index:mask_index+1]
+                    mask = l.apply_noise(tt.ones_like(noise), noise)[0]
+                if isinstance(mask, theano.gof.Variable):
+                    mask = mask.eval()
+                # fold the mask into the weights
+                W = np.broadcast_to(mask, (W.shape[0],))[:, None]*W
+            weights.append(W)
+            biases.append(b)
+            nonlinearities.append(l.nonlinearity)
+
+        # fold the input whitening into the first layer
+        if self.Xm is not None:
+            Xm, iXs = self.Xm.get_value(), self.iXs.get_value()
+            weights[0] = iXs.dot(weights[0])
+            biases[0] = biases[0] - Xm.dot(weights[0])
+
+        E = self.E
+        if self.Ym is not None:
+            Ym, Ys = self.Ym.get_value(), self.Ys.get_value()
+        else:
+            Ym, Ys = np.zeros((E,)), np.eye(E)
+
+        return NumpyPolicy(weights, biases, nonlinearities, Ym, Ys, E,
+                           self.sat_func, name=self.name+'_numpy')
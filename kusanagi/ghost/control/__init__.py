@@ -1,2 +1,3 @@
 from .control_ import *
 from .NNPolicy import *
+from .mpc import *
@@ -162,6 +162,7 @@ class LocalLinearPolicy(Loadable):
         self.m0 = m0
         D = len(self.m0)
         self.S0 = S0 if S0 is not None else np.zeros((D, D))
+        self.D = D
         self.t = 0
         self.noise = 0
         self.name = name
@@ -180,13 +181,13 @@ class LocalLinearPolicy(Loadable):
         u = self.maxU*(2*np.random.random((H_steps, len(self.maxU))) - 1)
         self.u_nominal = theano.shared(u)
 
-        # intialize the nominal states to the appropriate size
-        m0, S0 = utils.gTrig2_np(np.array(self.m0)[None, :],
-                                 np.array(self.S0)[None, :, :],
-                                 self.angle_dims,
-                                 len(self.m0))
+        # intialize the nominal states to the appropriate size. The belief
+        # state is the mean and the upper triangular part of the covariance
+        # of the state (see algorithms.pddp)
+        m0 = np.array(self.m0)
         self.triu_indices = np.triu_indices(m0.size)
-        z0 = np.concatenate([m0.flatten(), S0[0][self.triu_indices]])
+        z0 = np.concatenate([m0.flatten(),
+                             np.array(self.S0)[self.triu_indices]])
         z = np.tile(z0, (H_steps, 1))
         self.z_nominal = theano.shared(z)
 
@@ -208,26 +209,37 @@ class LocalLinearPolicy(Loadable):
         u, z, I, L = self.u_nominal, self.z_nominal, self.I_, self.L_
 
         if s is None:
-            s = np.zeros((D, D))
+            s = tt.zeros((D, D))
 
         # construct flattened state covariance vector
-        z_t = tt_.concatenate([m.flatten(), s[self.triu_indices]])
+        z_t = tt.concatenate([m.flatten(), s[self.triu_indices]])
         # compute control
         u_t = u[t] + I[t] + L[t].dot(z_t - z[t])
 
         # limit the controller output
-        #u_t = tt.clip(u_t, -self.maxU,  self.maxU)
+        u_t = tt.clip(u_t, -self.maxU, self.maxU)
 
         U = u_t.shape[0]
         self.t += 1
-        return u_t, tt_.zeros((U, U)), tt_.zeros((D, U))
+        return u_t, tt.zeros((U, U)), tt.zeros((D, U))
 
     def __call__(self, m, s=None, t=None):
-        # TODO implement this
-        raise NotImplementedError
+        D = len(self.m0)
+        if t is not None:
+            self.t = t
+        t = min(self.t, self.u_nominal.get_value().shape[0] - 1)
+        u, z, I, L = self.get_params()
+
+        m = np.array(m).flatten()[:D]
+        if s is None:
+            s = np.zeros((D, D))
+        z_t = np.concatenate([m, np.array(s)[self.triu_indices]])
+        u_t = u[t] + I[t] + L[t].dot(z_t - z[t])
+        self.t += 1
+        return np.clip(u_t, -self.maxU, self.maxU)
 
     def get_params(self, symbolic=False, t=None):
-        params = [self.u_nominal, self.z_nominal, self.I, self.L]
+        params = [self.u_nominal, self.z_nominal, self.I_, self.L_]
 
         if not symbolic:
             params = [p.get_value() for p in params]
@@ -0,0 +1,173 @@
+# pylint: disable=C0103
+import numpy as np
+import theano
+import theano.tensor as tt
+import time
+
+from kusanagi import utils
+from kusanagi.ghost.algorithms.pilco import predict_points
+
+floatX = theano.config.floatX
+
+
+class MPCPolicy(object):
+    '''
+        Receding horizon controller that plans over the predictions of a
+        learned dynamics model (e.g. BNN or SSGP_UI). At every control step,
+        the sequence of controls over the next H steps is optimized with the
+        cross entropy method: a population of control sequences is sampled
+        from a Gaussian, evaluated with a batched particle rollout, and the
+        Gaussian is refit to the elite sequences. Only the first control of
+        the final mean of the Gaussian is applied, and the mean is warm
+        started from the previous solution, shifted by one step.
+        The particles are propagated with the deterministic predictions of
+        the dynamics model (see algorithms.pilco.predict_points), plus
+        gaussian noise with the predictive variance of the model. The same
+        noise samples are used for every candidate of an iteration (common
+        random numbers), so the candidates are ranked by their controls and
+        not by the luck of their particles.
+        The policy expects the raw state as input (i.e. it should be run
+        with apply_controller without the gTrig preprocessing).
+        @param dynmodel trained dynamics model, predicting state deltas
+        @param cost cost function, evaluated with deterministic states
+                    (cost(x, None), with x of shape [n, D])
+        @param D number of state dimensions
+        @param H planning horizon (number of steps)
+        @param n_candidates number of control sequences per iteration
+        @param n_elite number of elite sequences used to refit the sampling
+                       distribution
+        @param n_particles number of particles per control sequence
+        @param max_iters maximum number of iterations per control step
+        @param time_budget maximum planning time (in seconds) per control
+                           step. An iteration is only started if, at the
+                           time per iteration measured so far (initialized
+                           when compiling the rollout), it would finish
+                           within the budget. If no iteration fits within
+                           the budget, the warm start solution is applied.
+                           If None, max_iters iterations are run
+        @param smoothing weight of the previous sampling distribution when
+                         refitting it to the elite sequences
+    '''
+    def __init__(self, dynmodel, cost, D, H=15, maxU=[10], minU=None,
+                 angle_dims=[], n_candidates=200, n_elite=20, n_particles=10,
+                 max_iters=5, time_budget=0.1, smoothing=0.1,
+                 name='MPCPolicy', **kwargs):
+        self.dynmodel = dynmodel
+        self.cost = cost
+        self.D = D
+        self.H = H
+        self.maxU = np.array(maxU, dtype=floatX)
+        self.minU = (np.array(minU, dtype=floatX)
+                     if minU is not None else -self.maxU)
+        self.E = self.maxU.size
+        self.angle_dims = angle_dims
+        self.n_candidates = n_candidates
+        self.n_elite = n_elite
+        self.n_particles = n_particles
+        self.max_iters = max_iters
+        self.time_budget = time_budget
+        self.smoothing = smoothing
+        self.name = name
+        self.eval_fn = None
+        self.iter_time = None
+        self.n_iters = 0
+        self.reset()
+
+    def reset(self):
+        ''' Clears the warm start solution (e.g. before a new episode)'''
+        self.u_mean = np.tile(0.5*(self.maxU + self.minU), (self.H, 1))
+
+    def get_params(self, symbolic=False, **kwargs):
+        return []
+
+    def init_params(self):
+        self.reset()
+
+    def compile(self):
+        '''
+            Compiles the batched rollout used to evaluate the candidate
+            control sequences
+        '''
+        utils.print_with_stamp('Building computation graph for rollouts',
+                               self.name)
+        x0 = tt.vector('x0')
+        U = tt.tensor3('U')
+        n_particles = self.n_particles
+        m_rng = utils.get_mrng()
+
+        # one row per particle, n_particles consecutive rows per candidate
+        U_p = tt.repeat(U, n_particles, axis=0).transpose(1, 0, 2)
+        x = tt.tile(x0, (U_p.shape[1], 1))
+        # the same noise samples for the particles of every candidate
+        z = m_rng.normal((self.H, n_particles, self.D))
+        z = tt.tile(z, (1, U.shape[0], 1))
+
+        def step(u, z_t, x, *args):
+            xa = utils.gTrig(x, self.angle_dims)
+            delta_x, var_x = predict_points(
+                self.dynmodel, tt.concatenate([xa, u], axis=1))
+            x_next = x + delta_x + tt.sqrt(var_x)*z_t
+            return [self.cost(x_next, None).flatten(), x_next]
+
+        (c, xs), updts = theano.scan(
+            fn=step, sequences=[U_p, z], outputs_info=[None, x],
+            non_sequences=self.dynmodel.get_intermediate_outputs(),
+            allow_gc=False, name='%s>rollout_scan' % (self.name))
+
+        # expected total cost per candidate
+        costs = c.sum(0).reshape((U.shape[0], n_particles)).mean(1)
+
+        utils.print_with_stamp('Compiling rollout function', self.name)
+        self.eval_fn = theano.function(
+            [x0, U], costs, updates=updts, allow_input_downcast=True)
+
+        # initial estimate of the time per iteration
+        start_time = time.time()
+        U = np.tile(self.u_mean, (self.n_candidates, 1, 1))
+        self.eval_fn(np.zeros(self.D), U)
+        self.iter_time = time.time() - start_time
+
+    def plan(self, x):
+        '''
+            Optimizes the control sequence starting from state x, with the
+            cross entropy method. Returns the mean of the sampling
+            distribution and the average cost of the elite sequences of the
+            last iteration (None if no iteration was run).
+        '''
+        if self.eval_fn is None:
+            self.compile()
+        start_time = time.time()
+        # warm start, shifting the previous solution by one step
+        mean = np.concatenate([self.u_mean[1:], self.u_mean[-1:]])
+        std = np.tile(0.5*(self.maxU - self.minU), (self.H, 1))
+        cost = None
+        self.n_iters = 0
+        for i in range(self.max_iters):
+            elapsed = time.time() - start_time
+            if self.time_budget is not None and\
+               elapsed + self.iter_time > self.time_budget:
+                # the next iteration would exceed the budget
+                break
+            iter_start = time.time()
+            U = mean + std*np.random.randn(self.n_candidates, self.H, self.E)
+            # always evaluate the current mean
+            U[0] = mean
+            U = np.clip(U, self.minU, self.maxU)
+            costs = self.eval_fn(x, U)
+            elite = np.argsort(costs)[:self.n_elite]
+            cost = costs[elite].mean()
+            a = self.smoothing
+            mean = a*mean + (1 - a)*U[elite].mean(0)
+            std = a*std + (1 - a)*U[elite].std(0)
+            # running estimate of the time per iteration
+            self.iter_time = 0.5*(self.iter_time + time.time() - iter_start)
+            self.n_iters += 1
+        self.u_mean = mean
+        return mean, cost
+
+    def __call__(self, m, s=None, t=None, **kwargs):
+        x = np.array(m, dtype=floatX).flatten()
+        if t == 0:
+            self.reset()
+        U, c = self.plan(x)
+        return U[0]
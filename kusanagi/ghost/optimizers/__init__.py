@@ -1,2 +1,5 @@
+from .base_optimizer import *
 from .scipy_optimizer import *
 from .sgd_optimizer import *
+from .multistart_optimizer import *
+from .es_optimizer import *
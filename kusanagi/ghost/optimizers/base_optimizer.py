@@ -0,0 +1,112 @@
+# pylint: disable=C0103
+from kusanagi import utils
+from kusanagi.base.Loadable import Loadable
+
+
+class BaseOptimizer(Loadable):
+    '''
+        Base class for the policy optimizers, implementing the logic for
+        saving and restoring their state. The state consists of the values of
+        the shared variables in self.optimizer_state (the parameters, the
+        internal variables of the update rules, e.g. the moment estimates of
+        Adam/Nadam or the Polyak averages, and the variables updated by the
+        loss, e.g. the counters and random number generator states used for
+        common random numbers) plus the iteration counters. The values are
+        matched by position with the variables of the current objective, so
+        a state can be restored after rebuilding the same objective (e.g.
+        after a crash).
+        @param warm_start whether the internal variables of the update rules
+                          are kept across calls to minimize (and copied to
+                          the new variables when set_objective is called
+                          again), instead of being reset to their initial
+                          values
+    '''
+    def __init__(self, name, filename=None, warm_start=False, **kwargs):
+        self.optimizer_state = None
+        self.accumulators = []
+        self.accumulators0 = []
+        self.state_values = None
+        self.warm_start = warm_start
+        self.n_evals = 0
+        self.total_evals = 0
+        self.n_minimize = 0
+        self.curr_iter = 0
+        self.best_p = [None, None, self.n_evals]
+        filename = name+'_state' if filename is None else filename
+        Loadable.__init__(self, name=name, filename=filename)
+        self.register(['state_values', 'n_evals', 'total_evals',
+                       'n_minimize', 'curr_iter', 'best_p'])
+
+    def get_state(self, variables=None):
+        '''
+            Returns a list with the values of the state variables (or of the
+            given list of variables)
+        '''
+        variables = self.optimizer_state if variables is None else variables
+        return [s.get_value(return_internal_type=False, borrow=False)
+                for s in variables]
+
+    def set_state(self, values, variables=None):
+        '''
+            Sets the values of the state variables (or of the given list of
+            variables). Values whose shapes do not match the corresponding
+            variable are skipped.
+        '''
+        variables = self.optimizer_state if variables is None else variables
+        if len(values) != len(variables):
+            msg = 'Expected %d state variables, got %d'
+            utils.print_with_stamp(msg % (len(variables), len(values)),
+                                   self.name)
+        for s, v in zip(variables, values):
+            shape = s.get_value(borrow=True).shape
+            if shape != v.shape:
+                msg = 'Skipping state variable %s (shape %s, expected %s)'
+                utils.print_with_stamp(msg % (s.name, v.shape, shape),
+                                       self.name)
+                continue
+            s.set_value(v)
+
+    def init_accumulators(self, accumulators):
+        '''
+            Stores the internal variables of the update rules of a new
+            objective, and their initial values. If warm_start is set, the
+            values of the previous accumulators are copied to the new ones.
+        '''
+        prev = None
+        if self.warm_start and len(self.accumulators) > 0:
+            prev = self.get_state(self.accumulators)
+        self.accumulators = accumulators
+        self.accumulators0 = self.get_state(accumulators)
+        if prev is not None:
+            self.set_state(prev, accumulators)
+
+    def reset_accumulators(self):
+        ''' Resets the internal variables of the update rules'''
+        self.set_state(self.accumulators0, self.accumulators)
+
+    def restore_state(self):
+        '''
+            Sets the state loaded from disk, if any, on the variables of the
+            current objective
+        '''
+        if self.state_values is not None and self.optimizer_state is not None:
+            utils.print_with_stamp('Restoring optimizer state', self.name)
+            self.set_state(self.state_values)
+            self.state_values = None
+
+    def load(self, output_folder=None, output_filename=None):
+        ''' Loads the state from file, and restores it if the objective has
+        already been set'''
+        ret = super(BaseOptimizer, self).load(output_folder, output_filename)
+        if ret:
+            self.restore_state()
+        return ret
+
+    def save(self, output_folder=None, output_filename=None):
+        ''' Stores the values of the state variables before saving'''
+        if self.optimizer_state is not None:
+            self.state_values = self.get_state()
+        # the state changes with every optimization iteration
+        self.state_changed = True
+        super(BaseOptimizer, self).save(output_folder, output_filename)
+        self.state_values = None
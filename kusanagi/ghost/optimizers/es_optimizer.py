@@ -0,0 +1,361 @@
+# pylint: disable=C0103
+import lasagne
+import multiprocessing as mp
+import numpy as np
+import theano
+import time
+
+from kusanagi import utils
+from theano.updates import OrderedUpdates
+
+ES_METHODS = ['CEM', 'CMA']
+
+# optimizer whose loss is evaluated by the worker processes. It is set
+# before creating the process pool, so that the forked workers get a copy
+# of it (see MultiStartOptimizer)
+_worker_optimizer = None
+
+
+def _evaluate_worker(args):
+    '''
+        Evaluates the loss for a block of parameter vectors. Executed in the
+        worker processes.
+    '''
+    P, inputs = args
+    return _worker_optimizer.evaluate_sequential(P, *inputs)
+
+
+class ESOptimizer(object):
+    '''
+        Gradient free optimizer, based on evolution strategies: the cross
+        entropy method (CEM), with a diagonal gaussian search distribution,
+        or CMA-ES (Hansen, 2016), with a full covariance matrix (only
+        practical for a moderate number of parameters). It has the same
+        set_objective/minimize interface as the gradient based optimizers,
+        but it only compiles the forward computation of the loss.
+        If batched is True and a population loss is given to set_objective
+        (e.g. from mc_pilco.get_population_loss), the losses of the whole
+        population are evaluated with a single call to a compiled function;
+        i.e. with a single rollout, where the particles of every candidate
+        are evaluated with the parameters in the corresponding row of the
+        population matrix. Otherwise, the candidates are evaluated one by
+        one, optionally in n_workers forked processes (the process pool is
+        created once per call to minimize).
+        The population is sampled with a random number generator seeded
+        from lasagne.random.get_rng(). At the end of the optimization, the
+        parameters are set to the mean of the search distribution, whose
+        loss is re-evaluated (with pop_size times the number of particles of
+        a single candidate, if the population loss is used); i.e. the
+        returned loss is not the minimum of the noisy losses of the sampled
+        candidates.
+        @param max_evals maximum number of loss evaluations
+        @param pop_size number of candidates per generation
+        @param elite_frac fraction of the population used to update the
+                          search distribution
+        @param init_std initial standard deviation of the search
+                        distribution, relative to the standard deviation of
+                        each parameter
+        @param smoothing weight of the previous search distribution in the
+                         CEM updates
+    '''
+    def __init__(self, method='CEM', max_evals=5000, pop_size=50,
+                 elite_frac=0.2, init_std=0.1, min_std=1e-6, smoothing=0.5,
+                 batched=True, n_workers=1, name='ESOptimizer', **kwargs):
+        self.method = method.upper()
+        if self.method not in ES_METHODS:
+            msg = 'Unknown method %s (available methods: %s)'
+            raise ValueError(msg % (method, ES_METHODS))
+        self.max_evals = max_evals
+        self.pop_size = pop_size
+        self.elite_frac = elite_frac
+        self.init_std = init_std
+        self.min_std = min_std
+        self.smoothing = smoothing
+        self.batched = batched
+        self.n_workers = n_workers
+        self.name = name
+
+        self.loss_fn = None
+        self.batch_loss_fn = None
+        self.pool = None
+        self.n_evals = 0
+        self.best_p = [None, None, self.n_evals]
+        self.params = None
+        self.callback = None
+
+    def set_objective(self, loss, params, inputs=None, updts=None,
+                      outputs=[], population=None, compilation_mode=None,
+                      engine=None, **kwargs):
+        '''
+            Changes the objective function to be optimized
+            @param loss theano graph representing the loss to be optimized
+            @param params theano shared variables representing the parameters
+                          to be optimized
+            @param inputs theano variables representing the inputs required to
+                          compute the loss, other than params
+            @param updts dictionary of list of theano updates to be applied
+                         after every evaluation of the loss function
+            @param population tuple of (losses, P, inputs, updts) with the
+                              graph for the losses of a population of
+                              pop_size candidates, given as the rows of the
+                              matrix P, the inputs of that graph (in the
+                              same order as inputs) and its updates; e.g.
+                              as returned by mc_pilco.get_population_loss.
+                              Used if batched is True.
+            @param engine if not None, a RolloutEngine (see
+                          algorithms.engine) whose compiled function is used
+                          to evaluate the loss of a single candidate, instead
+                          of compiling it here
+        '''
+        if len(kwargs) > 0:
+            msg = 'Unsupported arguments for %s: %s'
+            raise ValueError(msg % (self.__class__.__name__,
+                                    sorted(kwargs.keys())))
+        if inputs is None:
+            inputs = []
+
+        if updts is not None:
+            updts = OrderedUpdates(updts)
+
+        self.params = params
+        self.p_shapes = [p.get_value(borrow=True).shape for p in params]
+        self.loss_fn = None
+        self.batch_loss_fn = None
+
+        if self.batched and population is not None:
+            utils.print_with_stamp(
+                'Compiling function for population loss', self.name)
+            losses, P, pop_inputs, pop_updts = population
+            if pop_updts is not None:
+                pop_updts = OrderedUpdates(pop_updts)
+            batch_loss_fn = theano.function(
+                [P] + list(pop_inputs), losses, updates=pop_updts,
+                allow_input_downcast=True, mode=compilation_mode)
+            n_inps = len(pop_inputs)
+
+            # extra inputs (e.g. for other optimizers) are ignored
+            def batch_loss(P, *inputs):
+                return batch_loss_fn(P, *inputs[:n_inps])
+            self.batch_loss_fn = batch_loss
+        else:
+            if self.batched:
+                msg = 'No population loss was given, evaluating the'
+                msg += ' candidates one by one'
+                utils.print_with_stamp(msg, self.name)
+            if engine is not None:
+                # compile before forking the worker processes
+                engine.compile(compilation_mode=compilation_mode)
+                n_inps = len(engine.inps)
+
+                def loss_fn(*inputs):
+                    return engine(*inputs[:n_inps],
+                                  return_intermediate=False)[0]
+                self.loss_fn = loss_fn
+            else:
+                utils.print_with_stamp(
+                    'Compiling function for loss', self.name)
+                self.loss_fn = theano.function(
+                    inputs, loss, updates=updts, allow_input_downcast=True,
+                    mode=compilation_mode)
+        self.n_evals = 0
+
+    def set_params(self, p):
+        p = utils.unwrap_params(p, self.p_shapes)
+        for sp, p_i in zip(self.params, p):
+            sp.set_value(np.asarray(p_i, dtype=sp.dtype))
+
+    def evaluate_sequential(self, P, *inputs):
+        losses = []
+        for p in P:
+            self.set_params(p)
+            losses.append(self.loss_fn(*inputs))
+        return np.array(losses, dtype=np.float64)
+
+    def evaluate(self, P, *inputs):
+        '''
+            Returns the losses of the parameter vectors in the rows of P
+        '''
+        if self.batch_loss_fn is not None:
+            losses = self.batch_loss_fn(P, *inputs)
+        elif self.pool is not None:
+            blocks = np.array_split(P, self.n_workers)
+            losses = np.concatenate(self.pool.map(
+                _evaluate_worker, [(b, inputs) for b in blocks]))
+        else:
+            losses = self.evaluate_sequential(P, *inputs)
+        losses = np.array(losses, dtype=np.float64).flatten()
+        # treat failed evaluations as the worst possible candidates
+        losses[~np.isfinite(losses)] = np.inf
+        self.n_evals += len(losses)
+        return losses
+
+    def evaluate_mean(self, mean, *inputs):
+        '''
+            Returns the loss of the parameter vector mean. The population
+            loss is evaluated with every candidate set to mean, and the
+            candidate losses are averaged
+        '''
+        if self.batch_loss_fn is not None:
+            P = np.tile(mean, (self.pop_size, 1))
+        else:
+            P = mean[None, :]
+        return self.evaluate(P, *inputs).mean()
+
+    def start_pool(self):
+        '''
+            Creates the pool of worker processes, if the candidates are
+            evaluated in parallel. The workers are forked with a copy of this
+            optimizer (and its compiled loss function)
+        '''
+        global _worker_optimizer
+        if self.batch_loss_fn is None and self.n_workers > 1:
+            _worker_optimizer = self
+            self.pool = mp.get_context('fork').Pool(self.n_workers)
+
+    def stop_pool(self):
+        global _worker_optimizer
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            _worker_optimizer = None
+
+    def init_cma(self, n):
+        ''' Initializes the strategy parameters for CMA-ES'''
+        lmbda = self.pop_size
+        mu = max(1, int(self.elite_frac*lmbda))
+        w = np.log(mu + 0.5) - np.log(np.arange(1, mu + 1))
+        w /= w.sum()
+        mueff = 1.0/(w**2).sum()
+        cs = (mueff + 2)/(n + mueff + 5)
+        cc = (4 + mueff/n)/(n + 4 + 2*mueff/n)
+        c1 = 2/((n + 1.3)**2 + mueff)
+        cmu = min(1 - c1, 2*(mueff - 2 + 1/mueff)/((n + 2)**2 + mueff))
+        damps = 1 + 2*max(0, np.sqrt((mueff - 1)/(n + 1)) - 1) + cs
+        chiN = np.sqrt(n)*(1 - 1/(4.0*n) + 1/(21.0*n**2))
+        self.cma = dict(w=w, mueff=mueff, cs=cs, cc=cc, c1=c1, cmu=cmu,
+                        damps=damps, chiN=chiN, C=np.eye(n), pc=np.zeros(n),
+                        ps=np.zeros(n), gen=0)
+
+    def sample(self, mean, std, rng):
+        '''
+            Samples a population around mean. For CMA-ES, std is the global
+            step size, and the shape of the distribution is given by the
+            adapted covariance matrix
+        '''
+        n = mean.size
+        Z = rng.standard_normal((self.pop_size, n))
+        if self.method == 'CMA':
+            C = self.cma['C']
+            d, B = np.linalg.eigh(C)
+            d = np.sqrt(np.maximum(d, 1e-20))
+            self.cma['B'], self.cma['d'] = B, d
+            Y = (Z*d).dot(B.T)
+            return mean + std*Y, Y
+        Y = Z*std
+        # keep the current mean in the population
+        Y[0] = 0
+        return mean + Y, Y
+
+    def update(self, mean, std, P, Y, losses):
+        '''
+            Updates the search distribution with the sorted population
+        '''
+        idx = np.argsort(losses)
+        if self.method == 'CEM':
+            n_elite = max(1, int(self.elite_frac*len(losses)))
+            elite = P[idx[:n_elite]]
+            a = self.smoothing
+            mean = a*mean + (1 - a)*elite.mean(0)
+            std = a*std + (1 - a)*elite.std(0)
+            return mean, np.maximum(std, self.min_std)
+
+        cma = self.cma
+        w, mueff, cs, cc = cma['w'], cma['mueff'], cma['cs'], cma['cc']
+        c1, cmu, B, d = cma['c1'], cma['cmu'], cma['B'], cma['d']
+        n = mean.size
+        Y_el = Y[idx[:w.size]]
+        y_w = w.dot(Y_el)
+        mean = mean + std*y_w
+        # step size evolution path (using C^-1/2 y_w)
+        invsqrtC_yw = B.dot(B.T.dot(y_w)/d)
+        cma['ps'] = (1 - cs)*cma['ps'] +\
+            np.sqrt(cs*(2 - cs)*mueff)*invsqrtC_yw
+        cma['gen'] += 1
+        norm_ps = np.linalg.norm(cma['ps'])
+        hsig = norm_ps/np.sqrt(1 - (1 - cs)**(2*cma['gen']))/cma['chiN'] <\
+            1.4 + 2.0/(n + 1)
+        # covariance evolution path and rank-one + rank-mu updates
+        cma['pc'] = (1 - cc)*cma['pc'] +\
+            hsig*np.sqrt(cc*(2 - cc)*mueff)*y_w
+        C = cma['C']
+        C = (1 - c1 - cmu)*C +\
+            c1*(np.outer(cma['pc'], cma['pc']) +
+                (1 - hsig)*cc*(2 - cc)*C) +\
+            cmu*(Y_el.T*w).dot(Y_el)
+        cma['C'] = 0.5*(C + C.T)
+        std = std*np.exp((cs/cma['damps'])*(norm_ps/cma['chiN'] - 1))
+        return mean, max(std, self.min_std)
+
+    def minimize(self, *inputs, **kwargs):
+        '''
+            @param inputs python variables to pass as inputs to the compiled
+                   theano function for the loss
+        '''
+        self.callback = kwargs.get('callback')
+        utils.print_with_stamp('Optimizing parameters with %s' % (
+            self.method), self.name)
+        rng = np.random.RandomState(lasagne.random.get_rng().randint(2**31))
+        p0 = [p.get_value() for p in self.params]
+        mean = utils.wrap_params(p0).astype(np.float64)
+        if self.method == 'CMA':
+            self.init_cma(mean.size)
+            std = self.init_std*max(mean.std(), 1e-3)
+        else:
+            std = self.init_std*np.concatenate([
+                np.full(p.size, p.std() if p.std() > 0 else 1.0)
+                for p in p0])
+
+        self.n_evals = 0
+        self.best_p = [np.inf, p0, 0]
+        start_time = time.time()
+        generation = 0
+        self.start_pool()
+        try:
+            while self.n_evals < self.max_evals:
+                P, Y = self.sample(mean, std, rng)
+                losses = self.evaluate(P, *inputs)
+                best = np.argmin(losses)
+                if losses[best] < self.best_p[0]:
+                    self.best_p = [
+                        losses[best],
+                        utils.unwrap_params(P[best], self.p_shapes),
+                        self.n_evals]
+                mean, std = self.update(mean, std, P, Y, losses)
+                generation += 1
+                msg = 'Generation: %d, best loss: %s, mean loss: %s, '
+                msg += 'Total evaluations: %d, '
+                msg += 'Avg. time per generation: %f\t'
+                utils.print_with_stamp(
+                    msg % (generation, str(self.best_p[0]),
+                           str(losses[np.isfinite(losses)].mean()),
+                           self.n_evals,
+                           (time.time() - start_time)/generation),
+                    self.name, True)
+                if callable(self.callback):
+                    self.callback(self.best_p[1], self.best_p[0], None)
+        finally:
+            self.stop_pool()
+        print('')
+
+        # the losses of the candidates are noisy, so the result is the mean
+        # of the search distribution, rather than the best sample
+        v = self.evaluate_mean(mean, *inputs)
+
+        # set the final parameters
+        p = utils.unwrap_params(mean, self.p_shapes)
+        self.set_params(mean)
+        self.best_p = [v, p, self.n_evals]
+        msg = 'Done training. New loss [%f] iter: [%d]'
+        utils.print_with_stamp(msg % (v, self.n_evals), self.name)
+        return v
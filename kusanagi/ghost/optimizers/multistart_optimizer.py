@@ -0,0 +1,179 @@
+# pylint: disable=C0103
+import lasagne
+import multiprocessing as mp
+import numpy as np
+import time
+
+from kusanagi import utils
+
+# optimizer being run by the worker processes. It is set before creating the
+# process pool, so that the forked workers get a copy of it (and of the
+# compiled functions and models it depends on)
+_worker_optimizer = None
+
+
+def get_optimizer_state(optimizer):
+    '''
+        Returns a list with the values of the variables that define the state
+        of the optimizer (the parameters, plus any internal variables like
+        the moment estimates of adaptive SGD methods)
+    '''
+    state_vars = getattr(optimizer, 'optimizer_state', None)
+    if state_vars is None:
+        state_vars = optimizer.params
+    return [s.get_value(return_internal_type=False, borrow=False)
+            for s in state_vars]
+
+
+def set_optimizer_state(optimizer, state):
+    state_vars = getattr(optimizer, 'optimizer_state', None)
+    if state_vars is None:
+        state_vars = optimizer.params
+    for s, st in zip(state_vars, state):
+        s.set_value(st)
+
+
+def _run_worker(args):
+    '''
+        Runs the optimizer for a number of evaluations, starting from the
+        given state. Executed in the worker processes.
+    '''
+    start_idx, state, max_evals, seed, inputs, kwargs = args
+    optimizer = _worker_optimizer
+    # use a different seed for the random samples used by every start
+    np.random.seed(seed)
+    lasagne.random.get_rng().seed(seed)
+    utils.get_mrng().seed(seed)
+
+    set_optimizer_state(optimizer, state)
+    optimizer.max_evals = max_evals
+    loss = optimizer.minimize(*inputs, **kwargs)
+    return start_idx, loss, get_optimizer_state(optimizer)
+
+
+class MultiStartOptimizer(object):
+    '''
+        Runs several instances of a policy optimizer (SGDOptimizer or
+        ScipyOptimizer), from different initial parameters and random seeds,
+        in parallel worker processes. The starts are pruned with a successive
+        halving schedule: after every round, only the best 1/eta fraction of
+        the starts is kept and the evaluation budget per start is multiplied
+        by eta. The parameters of the best start are set on the original
+        shared variables at the end of minimize.
+        The worker processes are forked when minimize is called, so they
+        operate on a frozen copy of the models (e.g. the dynamics model)
+        used to build the objective. This requires the 'fork' start method
+        and the compiled functions to run on the cpu.
+        @param optimizer the optimizer instance to be run by every worker
+        @param n_starts number of initial parameter vectors
+        @param n_workers number of worker processes. Defaults to the number
+                         of cpus
+        @param eta reduction factor for successive halving
+        @param init_std scale of the perturbations applied to the parameters
+                        of every start (except the first one), relative to
+                        the standard deviation of each parameter
+        @param init_fn function with signature init_fn(i, params) that
+                       returns the initial parameter values for start i, to
+                       use instead of the random perturbations
+    '''
+    def __init__(self, optimizer, n_starts=8, n_workers=None, eta=2,
+                 init_std=0.1, init_fn=None, name='MultiStartOptimizer',
+                 **kwargs):
+        self.optimizer = optimizer
+        self.n_starts = n_starts
+        self.n_workers = n_workers
+        self.eta = eta
+        self.init_std = init_std
+        self.init_fn = init_fn
+        self.name = name
+        self.best_p = [None, None, 0]
+
+    def __getattr__(self, attr):
+        # delegate everything else (e.g. loss_fn, max_evals) to the
+        # underlying optimizer
+        if attr == 'optimizer':
+            raise AttributeError(attr)
+        return getattr(self.optimizer, attr)
+
+    def set_objective(self, *args, **kwargs):
+        return self.optimizer.set_objective(*args, **kwargs)
+
+    def get_initial_state(self, i, rng):
+        '''
+            Returns the initial optimizer state for start i
+        '''
+        set_optimizer_state(self.optimizer, self.state0)
+        params0 = [p.get_value() for p in self.optimizer.params]
+        if i > 0:
+            if callable(self.init_fn):
+                params0 = self.init_fn(i, params0)
+            else:
+                params0 = [
+                    p + self.init_std*(p.std() if p.std() > 0 else 1.0) *
+                    rng.standard_normal(p.shape).astype(p.dtype)
+                    for p in params0]
+        for p, v in zip(self.optimizer.params, params0):
+            p.set_value(v)
+        state = get_optimizer_state(self.optimizer)
+        set_optimizer_state(self.optimizer, self.state0)
+        return state
+
+    def minimize(self, *inputs, **kwargs):
+        '''
+            @param inputs python variables to pass as inputs to the compiled
+                          theano functions for the loss and gradients
+        '''
+        global _worker_optimizer
+        # the callbacks are not executed in the worker processes
+        kwargs.pop('callback', None)
+        n_workers = self.n_workers or mp.cpu_count()
+        max_evals = self.optimizer.max_evals
+        eta = self.eta
+
+        # successive halving schedule
+        n_rounds = int(np.ceil(np.log(self.n_starts)/np.log(eta))) + 1
+        budget = max(1, int(max_evals*(eta - 1)/(eta**n_rounds - 1)))
+
+        rng = np.random.RandomState(lasagne.random.get_rng().randint(2**31))
+        self.state0 = get_optimizer_state(self.optimizer)
+        starts = dict(
+            (i, self.get_initial_state(i, rng)) for i in range(self.n_starts))
+        seeds = dict((i, rng.randint(1, 2**31-1)) for i in starts)
+
+        msg = 'Running %d starts in %d processes, %d rounds'
+        utils.print_with_stamp(
+            msg % (self.n_starts, n_workers, n_rounds), self.name)
+        start_time = time.time()
+        _worker_optimizer = self.optimizer
+        ctx = mp.get_context('fork')
+        pool = ctx.Pool(min(n_workers, self.n_starts))
+        try:
+            for r in range(n_rounds):
+                tasks = [(i, starts[i], budget, seeds[i] + r, inputs, kwargs)
+                         for i in sorted(starts)]
+                results = pool.map(_run_worker, tasks, chunksize=1)
+                results = sorted(results, key=lambda res: res[1])
+                msg = 'Round %d, budget: %d, losses: %s'
+                utils.print_with_stamp(
+                    msg % (r, budget, str([(i, float(l))
+                                          for i, l, s in results])),
+                    self.name)
+                # keep the best 1/eta fraction of the starts
+                n_keep = max(1, int(np.ceil(len(results)/float(eta))))
+                if r == n_rounds - 1:
+                    n_keep = 1
+                starts = dict((i, s) for i, l, s in results[:n_keep])
+                best_idx, best_loss = results[0][:2]
+                budget *= eta
+        finally:
+            pool.close()
+            pool.join()
+            _worker_optimizer = None
+
+        # push back the best parameters
+        set_optimizer_state(self.optimizer, starts[best_idx])
+        self.best_p = [best_loss, starts[best_idx], best_idx]
+        msg = 'Done training. Best start [%d], loss [%f], time [%f s]'
+        utils.print_with_stamp(
+            msg % (best_idx, best_loss, time.time() - start_time), self.name)
+        return best_loss
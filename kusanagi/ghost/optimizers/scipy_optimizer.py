@@ -3,6 +3,7 @@ import numpy as np
 import theano
 import time
 from kusanagi import utils
+from kusanagi.ghost.optimizers.base_optimizer import BaseOptimizer
 from scipy.optimize import minimize
 from theano.updates import OrderedUpdates
 import traceback
@@ -10,22 +11,20 @@ import traceback
 SCIPY_MIN_METHODS = ['L-BFGS-B', 'TNC', 'BFGS', 'SLSQP', 'CG']
 
 
-class ScipyOptimizer(object):
+class ScipyOptimizer(BaseOptimizer):
     def __init__(self, min_method='L-BFGS-B',
                  max_evals=150,
                  conv_thr=1e-12,
-                 name='ScipyOptimizer'):
+                 name='ScipyOptimizer', filename=None):
+        BaseOptimizer.__init__(self, name=name, filename=filename)
         self.min_method = min_method
         self.max_evals = max_evals
         self.conv_thr = conv_thr
-        self.name = name
 
         self.loss_fn = None
         self.grads_fn = None
-        self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
-        self.best_p = [None, None, self.n_evals]
         self.params = None
         self.callback = None
 
@@ -47,7 +46,7 @@ class ScipyOptimizer(object):
 
     def set_objective(self, loss, params, inputs=None, updts=None,
                       outputs=[], grads=None,
-                      compilation_mode=None, **kwargs):
+                      compilation_mode=None, engine=None, **kwargs):
         '''
             Changes the objective function to be optimized
             @param loss theano graph representing the loss to be optimized
@@ -59,6 +58,10 @@ class ScipyOptimizer(object):
                          after every evaluation of the loss function
             @param grads gradients of the loss function. If not provided, will
                          be computed here
+            @param engine if not None, a RolloutEngine (see
+                          algorithms.engine) whose compiled function is used
+                          to evaluate the loss and the gradients, instead of
+                          compiling them here
         '''
         if inputs is None:
             inputs = []
@@ -66,56 +69,119 @@ class ScipyOptimizer(object):
         if updts is not None:
             updts = OrderedUpdates(updts)
 
-        if grads is None or len(grads) == 0:
-            utils.print_with_stamp('Building computation graph for gradients',
-                                   self.name)
-            grads = theano.grad(loss, params)
+        if engine is not None:
+            # the loss and gradients are evaluated with the compiled function
+            # of the engine
+            engine.compile(grads=True, params=params,
+                           compilation_mode=compilation_mode)
+            n_inps = len(engine.inps)
+            updts = OrderedUpdates(engine.updts)
 
-        utils.print_with_stamp('Compiling function for loss', self.name)
+            def grads_fn(*inputs):
+                return engine(*inputs[:n_inps], return_intermediate=False,
+                              return_grads=True)
 
-        self.loss_fn = theano.function(
-            inputs, loss, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
-        utils.print_with_stamp('Compiling function for loss+gradients',
-                               self.name)
-        self.grads_fn = theano.function(
-            inputs, [loss, ]+grads, updates=updts, allow_input_downcast=True,
-            mode=compilation_mode)
+            def loss_fn(*inputs):
+                return engine(*inputs[:n_inps], return_intermediate=False)[0]
+            self.grads_fn = grads_fn
+        else:
+            if grads is None or len(grads) == 0:
+                utils.print_with_stamp(
+                    'Building computation graph for gradients', self.name)
+                grads = theano.grad(loss, params)
+
+            # a single function is compiled for the loss and gradients; the
+            # gradient computations are skipped (via output_subset) when
+            # only the loss is needed
+            utils.print_with_stamp('Compiling function for loss+gradients',
+                                   self.name)
+            self.grads_fn = theano.function(
+                inputs, [loss, ]+grads, updates=updts,
+                allow_input_downcast=True, mode=compilation_mode)
+            grads_fn = self.grads_fn
+
+            def loss_fn(*inputs):
+                return grads_fn(*inputs, output_subset=[0])[0]
+        self.loss_fn = loss_fn
 
         self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
         self.params = params
+        # the quasi-newton methods are restarted on every call to minimize,
+        # so the state only consists of the parameters and the variables
+        # updated by the loss
+        self.optimizer_state = list(params)
+        if updts is not None:
+            self.optimizer_state += list(updts.keys())
+        self.restore_state()
+
+    def init_param_buffer(self):
+        '''
+            Allocates a flat, contiguous buffer for the parameters, whose
+            (reshaped) slices are set as the values of the shared variables,
+            and a flat buffer for the gradients. If the shared variables
+            alias the buffer (i.e. they are stored in host memory), the
+            parameters are updated by writing the scipy evaluation point into
+            the buffer, without any intermediate copies or set_value calls.
+            @return the initial values of the parameters, as a flat array
+        '''
+        floatX = theano.config.floatX
+        p0 = [p.get_value(borrow=True) for p in self.params]
+        self.p_shapes = [p.shape for p in p0]
+        sizes = [int(np.prod(shape)) for shape in self.p_shapes]
+        offsets = np.cumsum([0] + sizes)
+        self.p_slices = [slice(o, o + n) for o, n in zip(offsets, sizes)]
+        self.p_buffer = np.empty(offsets[-1], dtype=floatX)
+        self.g_buffer = np.empty(offsets[-1], dtype=np.float64)
+        self.p_views = []
+        self.zero_copy = True
+        for sp, p, sl, shape in zip(self.params, p0, self.p_slices,
+                                    self.p_shapes):
+            view = self.p_buffer[sl].reshape(shape)
+            view[...] = p
+            sp.set_value(view, borrow=True)
+            self.p_views.append(view)
+            value = sp.get_value(borrow=True, return_internal_type=True)
+            self.zero_copy &= np.may_share_memory(value, self.p_buffer)
+        if not self.zero_copy:
+            utils.print_with_stamp(
+                'Parameters are not stored in host memory; copying them on '
+                'every evaluation', self.name)
+        return self.p_buffer.astype(np.float64)
 
-    def loss_wrapper(self, p, p_shapes, *inputs):
+    def set_flat_params(self, p):
+        '''
+            Sets the values of the parameters from the flat array p
+        '''
+        self.p_buffer[:] = p
+        if not self.zero_copy:
+            for sp, view in zip(self.params, self.p_views):
+                sp.set_value(view)
+
+    def loss_wrapper(self, p, *inputs):
         '''
             Loss function wrapper compatible with scipy optimize
             @param p numpy array with the current evaluation point for the loss
-            @param p_shapes array with the shapes of every parameter
         '''
-        # transform flattened parameter vector into array of parameters
-        p = utils.unwrap_params(p, p_shapes)
-
         # set new parameter values
-        for i in range(len(self.params)):
-            self.params[i].set_value(p[i])
+        self.set_flat_params(p)
 
         # compute value + derivatives
         ret = self.grads_fn(*inputs)
-        loss, dloss = ret[0], ret[1:]
-
-        # flatten gradients
-        dloss = utils.wrap_params(dloss)
 
         # cast value and gradients as double precision floats
-        # (required by fmin_l_bfgs_b)
-        loss, dloss = (np.array(loss).astype(np.float64),
-                       np.array(dloss).astype(np.float64))
+        # (required by fmin_l_bfgs_b), writing the gradients in the flat
+        # buffer
+        loss = np.float64(ret[0])
+        for sl, g in zip(self.p_slices, ret[1:]):
+            self.g_buffer[sl] = np.asarray(g).ravel()
 
         # update internal state variables
         self.n_evals += 1
+        self.total_evals += 1
         if loss < self.best_p[0]:
-            self.best_p = [loss, p, self.n_evals]
+            self.best_p = [loss, np.array(p, dtype=np.float64), self.n_evals]
         end_time = time.time()
         iter_time_upt = ((end_time - self.start_time) - self.iter_time)
         iter_time_upt /= self.n_evals
@@ -127,10 +193,14 @@ class ScipyOptimizer(object):
         self.start_time = time.time()
 
         if callable(self.callback):
-            self.callback(p, loss, dloss)
+            # the parameter views and gradient buffer are overwritten at
+            # every evaluation, so the callback gets copies
+            self.callback([v.copy() for v in self.p_views], loss,
+                          self.g_buffer.copy())
 
-        # return loss+gradients
-        return loss, dloss
+        # return loss+gradients. The gradient is copied, since the scipy
+        # line searches may keep references to the previous gradients
+        return loss, self.g_buffer.copy()
 
     def minimize(self, *inputs, **kwargs):
         '''
@@ -143,13 +213,10 @@ class ScipyOptimizer(object):
         # set initial loss and parameters
         loss0 = self.loss_fn(*inputs)
         utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
-        p0 = [p.get_value() for p in self.params]
+        p0 = self.init_param_buffer()
         self.best_p = [loss0, p0, 0]
 
-        # get parameter shapes
-        p_shapes = [p.shape for p in p0]
-        mloss = utils.MemoizeJac(self.loss_wrapper,
-                                 args=(p_shapes,)+inputs)
+        mloss = utils.MemoizeJac(self.loss_wrapper, args=inputs)
 
         # keep on trying to optimize with all the methods, until one succeeds,
         # or we go through all of them
@@ -160,7 +227,7 @@ class ScipyOptimizer(object):
             try:
                 utils.print_with_stamp("Using %s optimizer" % (min_method),
                                        self.name)
-                p0_wrapped = utils.wrap_params(p0)
+                p0_wrapped = p0
                 opts = {'maxiter': self.max_evals,
                         'ftol': 1e5*np.finfo(float).eps,
                         'gtol': 1.0e-7}
@@ -175,9 +242,7 @@ class ScipyOptimizer(object):
                                    tol=self.conv_thr,
                                    options=opts)
                 # set params to new values
-                popt = utils.unwrap_params(opt_res.x, p_shapes)
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_flat_params(opt_res.x)
                 # break the loop since we succeeded
                 break
             except (ValueError, np.linalg.LinAlgError):
@@ -188,12 +253,12 @@ class ScipyOptimizer(object):
                 utils.print_with_stamp(msg % (self.min_method),
                                        self.name)
                 loss, popt = self.best_p[:2]
-                for i in range(len(self.params)):
-                    self.params[i].set_value(popt[i])
+                self.set_flat_params(popt)
         print('')
         v, p, i = self.best_p
-        for sp_i, p_i in zip(self.params, p):
-            sp_i.set_value(p_i)
+        self.set_flat_params(p)
         v = self.loss_fn(*inputs)
+        self.n_minimize += 1
         msg = 'Done training. New loss [%f] iter: [%d]'
         utils.print_with_stamp(msg % (v, i), self.name)
+        return v
@@ -8,6 +8,7 @@ import time
 from collections import OrderedDict
 from theano.updates import OrderedUpdates
 from kusanagi import utils
+from kusanagi.ghost.optimizers.base_optimizer import BaseOptimizer
 
 floatX = theano.config.floatX
 
@@ -24,23 +25,25 @@ LASAGNE_MIN_METHODS = {'sgd': lasagne.updates.sgd,
                        }
 
 
-class SGDOptimizer(object):
+class SGDOptimizer(BaseOptimizer):
     def __init__(self, min_method='ADAM',
                  max_evals=1000,
                  conv_thr=1e-12,
-                 name='SGDOptimizer', **kwargs):
+                 name='SGDOptimizer', filename=None, warm_start=False,
+                 **kwargs):
+        BaseOptimizer.__init__(self, name=name, filename=filename,
+                               warm_start=warm_start)
         self.min_method = min_method
         self.max_evals = max_evals
-        self.name = name
 
         self.loss_fn = None
         self.grads_fn = None
-        self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
-        self.best_p = [None, None, self.n_evals]
         self.params = None
         self.callback = None
+        self.sample_size_adapter = None
+        self.loss_estimator = None
 
     @property
     def min_method(self):
@@ -53,7 +56,8 @@ class SGDOptimizer(object):
     def set_objective(self, loss, params, inputs=None, updts=None,
                       outputs=[], output_grads=False, grads=None,
                       polyak_averaging=None, clip=None, trust_input=True,
-                      compilation_mode=None, **kwargs):
+                      compilation_mode=None, sample_size_adapter=None,
+                      loss_estimator=None, engine=None, **kwargs):
         '''
             Changes the objective function to be optimized
             @param loss theano graph representing the loss to be optimized
@@ -68,6 +72,26 @@ class SGDOptimizer(object):
                                 callbacks
             @param grads gradients of the loss function. If not provided, will
                          be computed here
+            @param sample_size_adapter object with compile and adapt methods
+                                       (e.g. mc_pilco.ParticleCountAdapter),
+                                       used to change the number of samples
+                                       of a stochastic loss every
+                                       sample_size_adapter.adapt_every
+                                       iterations of minimize
+            @param loss_estimator object with reset and after_update methods,
+                                  called at the start of minimize and after
+                                  every iteration (e.g.
+                                  mc_pilco.RolloutReuse)
+            @param engine if not None, a RolloutEngine (see
+                          algorithms.engine) whose compiled function is used
+                          to evaluate the loss and the gradients, instead of
+                          compiling them here. Only the parameter update
+                          rules are compiled, taking the gradients as inputs.
+                          The first len(engine.inps) inputs are passed to the
+                          engine; the rest (e.g. the learning rate) can only
+                          be used by the update rules. With polyak averaging,
+                          the reported loss is the loss at the current
+                          parameters
             @param kwargs arguments to pass to the lasagne.updates function
         '''
         if inputs is None:
@@ -75,8 +99,22 @@ class SGDOptimizer(object):
 
         if updts is not None:
             updts = OrderedUpdates(updts)
-
-        if grads is None:
+        loss_updts = updts
+
+        if engine is not None:
+            engine.compile(grads=True, params=params,
+                           compilation_mode=compilation_mode)
+            # the gradients are inputs of the update rules
+            engine_grads = [g.type() for g in engine.grads]
+            grads = engine_grads
+            if clip is not None:
+                utils.print_with_stamp(
+                    "Clipping gradients to norm %s" % (str(clip)), self.name)
+                grads = lasagne.updates.total_norm_constraint(grads, clip)
+            # the updates of the loss are applied by the engine
+            loss_updts = OrderedUpdates(engine.updts)
+            updts = None
+        elif grads is None:
             utils.print_with_stamp('Building computation graph for gradients',
                                    self.name)
             grads = theano.grad(loss, params)
@@ -94,7 +132,8 @@ class SGDOptimizer(object):
         outputs = [loss] + outputs
         if output_grads:
             outputs += grads
-        grad_updates = grad_updates+updts
+        if updts is not None:
+            grad_updates = grad_updates+updts
         if polyak_averaging and polyak_averaging > 0.0:
             # create copy of params
             params_avg = [
@@ -115,7 +154,9 @@ class SGDOptimizer(object):
                 replace_dict[p] = pp
             grad_updates[t] = t+1
 
-            outputs[0] = theano.clone(loss, replace=replace_dict, strict=True)
+            if engine is None:
+                outputs[0] = theano.clone(loss, replace=replace_dict,
+                                          strict=True)
             self.params_avg = params_avg
 
         else:
@@ -129,30 +170,90 @@ class SGDOptimizer(object):
                                            name=inp.name) for inp in inputs]
 
         givens_dict = dict(zip(inputs, self.shared_inpts))
-        self.loss_fn = theano.function(
-            [], loss, updates=updts,
-            on_unused_input='ignore',
-            allow_input_downcast=True,
-            givens=givens_dict,
-            mode=compilation_mode)
-        self.loss_fn.trust_input = trust_input
-
-        utils.print_with_stamp("Compiling parameter updates", self.name)
-
-        self.update_params_fn = theano.function(
-            [], outputs,
-            updates=grad_updates,
-            on_unused_input='ignore',
-            allow_input_downcast=True,
-            givens=givens_dict,
-            mode=compilation_mode)
-        self.update_params_fn.trust_input = trust_input
+        if engine is not None:
+            utils.print_with_stamp("Compiling parameter updates", self.name)
+            self.apply_updates_fn = theano.function(
+                engine_grads, [],
+                updates=grad_updates,
+                on_unused_input='ignore',
+                allow_input_downcast=True,
+                givens=givens_dict,
+                mode=compilation_mode)
+            self.set_engine(engine, len(outputs) > 1, output_grads)
+        else:
+            self.loss_fn = theano.function(
+                [], loss, updates=updts,
+                on_unused_input='ignore',
+                allow_input_downcast=True,
+                givens=givens_dict,
+                mode=compilation_mode)
+            self.loss_fn.trust_input = trust_input
+
+            utils.print_with_stamp("Compiling parameter updates", self.name)
+
+            self.update_params_fn = theano.function(
+                [], outputs,
+                updates=grad_updates,
+                on_unused_input='ignore',
+                allow_input_downcast=True,
+                givens=givens_dict,
+                mode=compilation_mode)
+            self.update_params_fn.trust_input = trust_input
+
+        self.loss_estimator = loss_estimator
+        self.sample_size_adapter = sample_size_adapter
+        if sample_size_adapter is not None:
+            sample_size_adapter.compile(params, givens=givens_dict,
+                                        mode=compilation_mode)
 
         self.n_evals = 0
         self.start_time = 0
         self.iter_time = 0
         self.params = params
         self.optimizer_state = [s for s in grad_updates.keys()]
+        # internal variables of the update rules (e.g. moment estimates and
+        # polyak averages), excluding the parameters and the variables
+        # updated by the loss
+        fixed_ids = set(id(s) for s in params)
+        if loss_updts is not None:
+            fixed_ids.update(id(s) for s in loss_updts.keys())
+        self.init_accumulators([s for s in self.optimizer_state
+                                if id(s) not in fixed_ids])
+        if updts is None and loss_updts is not None:
+            # the variables updated by the engine are also part of the state
+            self.optimizer_state += list(loss_updts.keys())
+        self.restore_state()
+
+    def set_engine(self, engine, output_intermediate=False,
+                   output_grads=False):
+        '''
+            Sets the loss and update functions to evaluate the loss and
+            gradients with the compiled function of the engine, with the
+            current values of the shared inputs. The gradients are then
+            passed to the compiled update rules.
+        '''
+        n_inps = len(engine.inps)
+        shared_inpts = self.shared_inpts[:n_inps]
+
+        def engine_inputs():
+            return [s.get_value(borrow=True) for s in shared_inpts]
+
+        def loss_fn():
+            return engine(*engine_inputs(), return_intermediate=False)[0]
+
+        def update_params_fn():
+            ret = engine(*engine_inputs(),
+                         return_intermediate=output_intermediate,
+                         return_grads=True)
+            n_outs = len(ret) - len(engine.grads)
+            grads = ret[n_outs:]
+            self.apply_updates_fn(*grads)
+            # the returned loss and gradients correspond to the parameters
+            # BEFORE the update
+            return ret[:n_outs] + grads if output_grads else ret[:n_outs]
+
+        self.loss_fn = loss_fn
+        self.update_params_fn = update_params_fn
 
     def minibatch_minimize(self, X, Y, *inputs, **kwargs):
         callback = kwargs.get('callback', None)
@@ -164,6 +265,8 @@ class SGDOptimizer(object):
         self.n_evals = 0
         utils.print_with_stamp('Optimizing parameters via mini batches',
                                self.name)
+        if not self.warm_start:
+            self.reset_accumulators()
         # set values for shared inputs
         self.shared_inpts[0].set_value(X[-batch_size:])
         self.shared_inpts[1].set_value(Y[-batch_size:])
@@ -209,6 +312,7 @@ class SGDOptimizer(object):
                     callback(*ret)
 
                 self.n_evals += 1
+                self.total_evals += 1
                 if self.n_evals >= self.max_evals:
                     should_exit = True
                     break
@@ -237,6 +341,7 @@ class SGDOptimizer(object):
                 p_i.set_value(pp_i.get_value())
 
         v = self.loss_fn()
+        self.n_minimize += 1
         msg = 'Done training. New loss [%f] iter: [%d]'
         utils.print_with_stamp(msg % (v, i), self.name)
 
@@ -244,23 +349,40 @@ class SGDOptimizer(object):
         '''
             @param inputs python variables to pass as inputs to the compiled
                           theano functions for the loss and gradients
+            @param checkpoint_every if set, the optimizer state is saved
+                                    (via self.save) every checkpoint_every
+                                    iterations. If a state saved in the middle
+                                    of an optimization is loaded, minimize
+                                    continues from the saved iteration
         '''
         callback = kwargs.get('callback')
         return_best = kwargs.get('return_best', False)
+        checkpoint_every = kwargs.get('checkpoint_every')
+        start_iter = self.curr_iter + 1
         self.iter_time = 0
         self.start_time = time.time()
-        self.n_evals = 0
-        utils.print_with_stamp('Optimizing parameters', self.name)
+        self.n_evals = start_iter - 1
+        if self.loss_estimator is not None:
+            self.loss_estimator.reset()
         # set values for shared inputs
         for s, i in zip(self.shared_inpts, inputs):
             s.set_value(np.array(i).astype(s.dtype))
         # set initial loss and parameters
         state0 = [s.get_value(return_internal_type=True, borrow=False)
                   for s in self.optimizer_state]
-        ret = self.update_params_fn()
+        if start_iter > 1:
+            utils.print_with_stamp(
+                'Resuming optimization from iteration %d' % (start_iter),
+                self.name)
+        else:
+            utils.print_with_stamp('Optimizing parameters', self.name)
+            if not self.warm_start:
+                self.reset_accumulators()
+            ret = self.update_params_fn()
         loss0 = self.loss_fn()
         utils.print_with_stamp('Initial loss [%s]' % (loss0), self.name)
-        self.best_p = [loss0, state0, 0]
+        if start_iter == 1 or self.best_p[1] is None:
+            self.best_p = [loss0, state0, start_iter - 1]
 
         # training loop
         if return_best:
@@ -268,7 +390,8 @@ class SGDOptimizer(object):
             out_str += ', Avg. time per updt: %f'
         else:
             out_str = 'Curr loss: %E, n_evals: %d, Avg. time per updt: %f'
-        for i in range(1, self.max_evals):
+        i = start_iter - 1
+        for i in range(start_iter, self.max_evals):
             start_time = time.time()
 
             # evaluate current policy and update parameters
@@ -285,6 +408,15 @@ class SGDOptimizer(object):
             if callable(callback):
                 callback(*ret)
             self.n_evals += 1
+            self.total_evals += 1
+
+            if self.loss_estimator is not None:
+                self.loss_estimator.after_update()
+
+            adapter = self.sample_size_adapter
+            if adapter is not None and i % adapter.adapt_every == 0:
+                print('')
+                adapter.adapt()
 
             end_time = time.time()
             dt = end_time - start_time
@@ -297,7 +429,14 @@ class SGDOptimizer(object):
                 str_params = (loss, self.n_evals, self.iter_time)
             utils.print_with_stamp(out_str % str_params, self.name, True)
 
+            if checkpoint_every and i % checkpoint_every == 0:
+                print('')
+                self.curr_iter = i
+                self.save()
+
         print('')
+        self.curr_iter = 0
+        self.n_minimize += 1
 
         if return_best:
             v, s, i = self.best_p
@@ -314,3 +453,4 @@ class SGDOptimizer(object):
 
         msg = 'Done training. New loss [%f] iter: [%d]'
         utils.print_with_stamp(msg % (v, i), self.name)
+        return v
@@ -86,7 +86,7 @@ class BNN(BaseRegressor):
                  heteroscedastic=True, name='BNN',
                  filename=None, network=None, network_spec=None,
                  likelihood=objectives.gaussian_log_likelihood,
-                 **kwargs):
+                 analytic_moments=False, **kwargs):
         self.D = idims
         self.E = odims
         self.name = name
@@ -94,6 +94,9 @@ class BNN(BaseRegressor):
         self.trained = False
         self.heteroscedastic = heteroscedastic
         self.likelihood = likelihood
+        # whether to propagate input distributions through the network via
+        # moment matching, instead of sampling
+        self.analytic_moments = analytic_moments
 
         sn = (np.ones((self.E,))*1e-3).astype(floatX)
         sn = np.log(np.exp(sn)-1)
@@ -126,6 +129,9 @@ class BNN(BaseRegressor):
         self.iXs = None
         self.Ym = None
         self.Ys = None
+        # sufficient statistics of the dataset (count, mean, scatter matrix)
+        self.X_stats = None
+        self.Y_stats = None
 
         # filename for saving
         fname = '%s_%d_%d_%s_%s' % (self.name, self.D, self.E,
@@ -145,7 +151,8 @@ class BNN(BaseRegressor):
 
         # register theano shared variables for saving
         self.register_types([tt.sharedvar.SharedVariable])
-        self.register(['sn', 'network_params', 'network_spec'])
+        self.register(['sn', 'network_params', 'network_spec',
+                       'X_stats', 'Y_stats'])
 
     def load(self, output_folder=None, output_filename=None):
         n_samples = self.n_samples.get_value()
@@ -156,9 +163,17 @@ class BNN(BaseRegressor):
             self.network_params = {}
 
         if self.network_spec is not None:
+            # building the network draws new dropout masks, so we keep a
+            # copy of the saved ones
+            noise_samples = dict(
+                (name, p['noise_samples'].get_value())
+                for name, p in self.network_params.items()
+                if isinstance(p.get('noise_samples'),
+                              tt.sharedvar.SharedVariable))
             self.build_network(self.network_spec,
                                params=self.network_params,
                                name=self.name)
+            self.set_noise_samples(noise_samples)
         if hasattr(self, 'unconstrained_sn'):
             eps = np.finfo(np.__dict__[floatX]).eps
             self.sn = tt.nnet.softplus(self.unconstrained_sn) + eps
@@ -182,13 +197,15 @@ class BNN(BaseRegressor):
                 ret += l.get_intermediate_outputs()
         return list(set(ret))
 
-    def set_dataset(self, X_dataset, Y_dataset, **kwargs):
+    def set_dataset(self, X_dataset, Y_dataset, update_statistics=True,
+                    **kwargs):
         # set dataset
         super(BNN, self).set_dataset(X_dataset.astype(floatX),
                                      Y_dataset.astype(floatX))
 
         # extra operations when setting the dataset (specific to this class)
-        self.update_dataset_statistics(X_dataset, Y_dataset)
+        if update_statistics:
+            self.update_dataset_statistics(X_dataset, Y_dataset)
 
         if not self.trained:
             # default log of measurement noise variance is set to 2.5% of
@@ -198,19 +215,39 @@ class BNN(BaseRegressor):
             self.unconstrained_sn.set_value(s)
 
     def append_dataset(self, X_dataset, Y_dataset):
+        if self.X is None or self.X_stats is None or self.Y_stats is None:
+            # nothing to append to
+            X_ = X_dataset if self.X is None else np.vstack(
+                (self.X.get_value(), X_dataset.astype(floatX)))
+            Y_ = Y_dataset if self.Y is None else np.vstack(
+                (self.Y.get_value(), Y_dataset.astype(floatX)))
+            self.set_dataset(X_, Y_)
+            return
+
         # set dataset
         super(BNN, self).append_dataset(X_dataset.astype(floatX),
-                                        Y_dataset.astype(floatX))
+                                        Y_dataset.astype(floatX),
+                                        update_statistics=False)
 
         # extra operations when setting the dataset (specific to this class)
-        self.update_dataset_statistics(self.X.get_value(), self.Y.get_value())
-
-    def update_dataset_statistics(self, X_dataset, Y_dataset):
-        # add small amount of noise for smoothing
-        X_dataset += 1e-6*np.random.randn(*X_dataset.shape)
-        Xm = np.atleast_1d(X_dataset.mean(0).astype(floatX))
-        Xc = np.atleast_2d(
-            (np.cov(X_dataset-Xm, rowvar=False, ddof=1).astype(floatX)))
+        # only the new samples are used to update the statistics
+        self.update_dataset_statistics(X_dataset, Y_dataset, append=True)
+
+    def update_dataset_statistics(self, X_dataset, Y_dataset, append=False):
+        ''' Updates the sufficient statistics (sample count, mean and scatter
+        matrix) of the dataset, and the whitening parameters derived from them.
+        If append is True, X_dataset and Y_dataset are treated as new samples,
+        so the cost of this operation does not depend on the dataset size'''
+        if not append or self.X_stats is None or self.Y_stats is None:
+            self.X_stats = (0, None, None)
+            self.Y_stats = (0, None, None)
+        self.X_stats = utils.update_moments(*(self.X_stats + (X_dataset,)))
+        self.Y_stats = utils.update_moments(*(self.Y_stats + (Y_dataset,)))
+
+        n, Xm, Xc = self.X_stats
+        Xm = np.atleast_1d(Xm.astype(floatX))
+        # small amount of jitter for smoothing
+        Xc = np.atleast_2d(Xc/(n-1)) + 1e-12*np.eye(Xm.size)
         iXs = np.linalg.cholesky(
             np.linalg.inv(Xc)).astype(floatX)
         if self.Xm is None:
@@ -220,9 +257,9 @@ class BNN(BaseRegressor):
             self.Xm.set_value(Xm)
             self.iXs.set_value(iXs)
 
-        Ym = np.atleast_1d(Y_dataset.mean(0).astype(floatX))
-        Yc = np.atleast_2d(
-            np.cov(Y_dataset-Ym, rowvar=False, ddof=1).astype(floatX))
+        n, Ym, Yc = self.Y_stats
+        Ym = np.atleast_1d(Ym.astype(floatX))
+        Yc = np.atleast_2d(Yc/(n-1))
 
         Ys = np.linalg.cholesky(Yc).T.astype(floatX)
 
@@ -315,6 +352,72 @@ class BNN(BaseRegressor):
             self.network = network
         self.update()
 
+    def prune(self, snr_threshold=1.0):
+        ''' Removes the hidden units whose multiplicative noise has a signal
+        to noise ratio lower than snr_threshold (only for layers that provide
+        the snr attribute, e.g. layers.DenseLogNormalDropoutLayer). The
+        corresponding columns of the previous layer weights and rows of the
+        next layer weights are removed, and a smaller network is built.
+        Any compiled functions that use this network (e.g. a policy
+        optimization loss) need to be rebuilt after calling this method.
+        Returns the number of units that were removed.'''
+        all_layers = lasagne.layers.get_all_layers(self.network)
+        if all_layers[0].__class__ is not self.network_spec[0][0]:
+            # the network spec does not include the input layer
+            all_layers = all_layers[1:]
+        # get the current parameter values for every layer
+        params = dict(
+            (l.name, dict((p.name.split('>')[-1], p.get_value())
+                          for p in l.get_params()
+                          if p.name.split('>')[-1] != 'noise_samples'))
+            for l in all_layers)
+        network_spec = [(layer_class, dict(layer_args))
+                        for layer_class, layer_args in self.network_spec]
+
+        n_pruned = 0
+        for i in range(1, len(all_layers)):
+            layer, prev = all_layers[i], all_layers[i-1]
+            if not hasattr(layer, 'snr')\
+               or not isinstance(prev, lasagne.layers.DenseLayer):
+                continue
+            snr = layer.snr.eval()
+            n_in = prev.num_units
+            snr = np.broadcast_to(snr, (n_in,))
+            keep = np.nonzero(snr >= snr_threshold)[0]
+            if keep.size == 0:
+                keep = np.array([snr.argmax()])
+            if keep.size == n_in:
+                continue
+            n_pruned += n_in - keep.size
+
+            # remove the outputs of the previous layer
+            prev_params = params[prev.name]
+            W_shape = prev_params['W'].shape
+            for pname, value in prev_params.items():
+                if value.shape == W_shape:
+                    prev_params[pname] = value[:, keep]
+                elif pname == 'b':
+                    prev_params[pname] = value[keep]
+            network_spec[i-1][1]['num_units'] = keep.size
+
+            # remove the inputs of this layer
+            layer_params = params[layer.name]
+            for pname, value in layer_params.items():
+                if pname != 'b' and value.ndim > 0 and value.shape[0] == n_in:
+                    layer_params[pname] = value[keep]
+
+        if n_pruned > 0:
+            msg = 'Pruned %d units with SNR < %f'
+            utils.print_with_stamp(msg % (n_pruned, snr_threshold),
+                                   self.name)
+            for layer_class, layer_args in network_spec:
+                layer_args.pop('noise_samples', None)
+            # force recompiling the functions that depend on the network
+            self.update_fn = None
+            self.optimizer.loss_fn = None
+            self.build_network(network_spec, params=params, name=self.name)
+        return n_pruned
+
     def get_loss(self):
         ''' initializes the loss function for training '''
         # build the network
@@ -390,11 +493,16 @@ class BNN(BaseRegressor):
 
     def predict(self, mx, Sx=None, deterministic=False,
                 iid_per_eval=False, return_samples=False,
-                whiten_inputs=True, whiten_outputs=True, **kwargs):
+                whiten_inputs=True, whiten_outputs=True,
+                analytic_moments=None, get_output=None, **kwargs):
         ''' returns symbolic expressions for the evaluations of this objects
         neural network. If Sx is specified, the output will correspond to the
         mean, covariance and input-output covariance of the network
-        predictions'''
+        predictions. If analytic_moments is True (defaults to
+        self.analytic_moments), these are computed by propagating the input
+        moments through the network layers, instead of sampling. If
+        get_output is not None, it replaces lasagne.layers.get_output to
+        evaluate the network on the (whitened) input samples'''
         # build the network if nedded
         if self.network is None:
             params = self.network_params\
@@ -403,6 +511,12 @@ class BNN(BaseRegressor):
             self.build_network(self.network_spec,
                                params=params,
                                name=self.name)
+        if analytic_moments is None:
+            analytic_moments = getattr(self, 'analytic_moments', False)
+        if Sx is not None and analytic_moments and not return_samples:
+            return self.predict_moments(mx, Sx, deterministic=deterministic,
+                                        whiten_inputs=whiten_inputs,
+                                        whiten_outputs=whiten_outputs)
         if Sx is not None:
             # generate random samples from input (assuming gaussian
             # distributed inputs)
@@ -420,9 +534,10 @@ class BNN(BaseRegressor):
             x = (x - self.Xm).dot(self.iXs)
         # unless we set the shared_axes parameter on the dropout layers,
         # the noise samples should be different per input sample
-        ret = lasagne.layers.get_output(self.network, x,
-                                        deterministic=deterministic,
-                                        fixed_noise_samples=not iid_per_eval)
+        if get_output is None:
+            get_output = lasagne.layers.get_output
+        ret = get_output(self.network, x, deterministic=deterministic,
+                         fixed_noise_samples=not iid_per_eval)
         y = ret[:, :self.E]
         sn = (0.1*tt.nnet.sigmoid(ret[:, self.E:])
               if self.heteroscedastic
@@ -455,22 +570,89 @@ class BNN(BaseRegressor):
                 C = tt.zeros((self.D, self.E))
             return [M, S, C]
 
+    def predict_moments(self, mx, Sx, deterministic=False,
+                        whiten_inputs=True, whiten_outputs=True, **kwargs):
+        ''' returns symbolic expressions for the mean, covariance and
+        input-output covariance of the network predictions, given a gaussian
+        input distribution N(mx, Sx). The moments are propagated analytically
+        through the network layers (see layers.get_output_moments), so no
+        samples are drawn. The full input covariance is propagated, so the
+        correlations between the inputs (and between the outputs) are taken
+        into account.'''
+        m = mx[None, :]
+        # covariance between the inputs and the (whitened) network inputs
+        C = Sx
+        S = Sx
+        if (whiten_inputs and hasattr(self, 'Xm') and self.Xm is not None):
+            m = (m - self.Xm).dot(self.iXs)
+            C = Sx.dot(self.iXs)
+            S = self.iXs.T.dot(C)
+
+        m, S, C = layers.get_output_moments(
+            self.network, m, S, C, deterministic=deterministic,
+            full_cov=True)
+        M = m[0, :self.E]
+        S = S[:self.E, :self.E]
+        C = C[:, :self.E]
+        sn = (0.1*tt.nnet.sigmoid(m[0, self.E:])
+              if self.heteroscedastic
+              else self.sn)
+        # fudge factor
+        sn += 1e-6
+        if whiten_outputs and hasattr(self, 'Ym') and self.Ym is not None:
+            # scale and center outputs
+            M = M.dot(self.Ys) + self.Ym
+            S = self.Ys.T.dot(S).dot(self.Ys)
+            C = C.dot(self.Ys)
+            # rescale variances
+            sn = sn*tt.diag(self.Ys)
+        # noise
+        S += tt.diag(sn**2)
+        return [M, S, C]
+
+    def get_noise_samples(self):
+        ''' Returns a copy of the current dropout masks, indexed by layer
+        name'''
+        if self.network is None:
+            return {}
+        return dict((l.name, l.noise.get_value())
+                    for l in lasagne.layers.get_all_layers(self.network)
+                    if hasattr(l, 'noise'))
+
+    def set_noise_samples(self, noise_samples):
+        ''' Restores the dropout masks returned by get_noise_samples (e.g.
+        after building new graphs, which resample them)'''
+        if self.network is None:
+            return
+        for l in lasagne.layers.get_all_layers(self.network):
+            if hasattr(l, 'noise') and l.name in noise_samples:
+                l.noise.set_value(noise_samples[l.name])
+
     def update(self, n_samples=None):
-        ''' Updates the dropout masks'''
+        ''' Updates the dropout masks. The masks of the layers that provide
+        the sample_noise_np method are drawn with numpy, with the appropriate
+        shape for the current number of samples; i.e. changing the number of
+        samples does not require building or compiling any new functions.'''
         if n_samples is not None:
             if isinstance(n_samples, tt.sharedvar.SharedVariable):
                 self.n_samples = n_samples
                 self.update_fn = None
             else:
                 self.n_samples.set_value(n_samples)
+        if self.network is None:
+            return
+        n_samples = int(self.n_samples.get_value())
+
+        other_layers = []
+        for l in lasagne.layers.get_all_layers(self.network):
+            if hasattr(l, 'sample_noise_np'):
+                # draw samples from the networks
+                l.noise.set_value(l.sample_noise_np(n_samples))
+            elif hasattr(l, 'get_updates'):
+                other_layers.append(l)
 
-            # increase the size of the masks
-            updts = self.get_updates()
-            for v, updt in updts.items():
-                v_shape = v.shape.eval()
-                if v_shape[0] != n_samples:
-                    v_shape[0] = n_samples
-                    v.set_value(np.zeros(v_shape, dtype=v.dtype))
+        if len(other_layers) == 0:
+            return
 
         if not hasattr(self, 'update_fn') or self.update_fn is None:
             # get prediction with non deterministic samples
@@ -479,7 +661,9 @@ class BNN(BaseRegressor):
 
             # create a function to update the masks manually. Here the dropout
             # masks should be shared variables
-            updts = self.get_updates()
+            updts = theano.updates.OrderedUpdates()
+            for l in other_layers:
+                updts += l.get_updates()
             # compile optimmized
             mode = theano.compile.mode.get_mode('FAST_RUN')
             self.update_fn = theano.function([], [], updates=updts,
@@ -240,9 +240,42 @@ class DenseDropoutLayer(lasagne.layers.DenseLayer):
 
         return noise
 
+    def get_noise_shape(self, n_samples):
+        ''' returns the shape of the noise samples for n_samples inputs '''
+        noise_shape = list(self.noise.get_value(borrow=True).shape)
+        if 0 not in self.shared_axes:
+            noise_shape[0] = n_samples
+        return noise_shape
+
+    def sample_noise_np(self, n_samples):
+        ''' returns new values for the shared noise samples, drawn with
+            numpy (so the number of samples can change without compiling
+            new theano functions) '''
+        noise_shape = self.get_noise_shape(n_samples)
+        retain_prob = 1 - self.p
+        return get_rng().binomial(1, retain_prob, noise_shape).astype(floatX)
+
     def apply_noise(self, input, noise):
         return input * noise
 
+    def noise_moments(self):
+        ''' returns the mean and variance of the multiplicative noise
+            applied to the inputs of this layer '''
+        retain_prob = 1 - self.p
+        return retain_prob, retain_prob*(1 - retain_prob)
+
+    def get_output_moments_for(self, m, v, C=None, deterministic=False,
+                               full_cov=False, **kwargs):
+        ''' returns the mean, variance and input-output covariance of the
+            outputs of this layer, given the mean m and variance v of its
+            inputs (see dense_moments) '''
+        if deterministic:
+            return dense_moments(m, v, C, self.W, self.b, self.nonlinearity,
+                                 full_cov=full_cov)
+        mn, vn = self.noise_moments()
+        return dense_moments(m, v, C, self.W, self.b, self.nonlinearity,
+                             mn, vn, full_cov=full_cov)
+
     def get_output_for(self, input, deterministic=False,
                        fixed_noise_samples=False, **kwargs):
         num_leading_axes = self.num_leading_axes
@@ -352,12 +385,19 @@ class DenseGaussianDropoutLayer(DenseDropoutLayer):
 
         return noise
 
+    def sample_noise_np(self, n_samples, mean=0, std=1):
+        noise_shape = self.get_noise_shape(n_samples)
+        return get_rng().normal(mean, std, noise_shape).astype(floatX)
+
     def apply_noise(self, input, noise):
         # scale noise by alpha.
         # alpha is shared across mini batch samples
         sq_alpha = (tt.exp(0.5*self.log_alpha))
         return input*(1 + sq_alpha * noise)
 
+    def noise_moments(self):
+        return 1, tt.exp(self.log_alpha)
+
 
 class DenseAdditiveGaussianDropoutLayer(DenseGaussianDropoutLayer):
     '''
@@ -440,6 +480,27 @@ class DenseAdditiveGaussianDropoutLayer(DenseGaussianDropoutLayer):
 
         return noise
 
+    def get_output_moments_for(self, m, v, C=None, deterministic=False,
+                               full_cov=False, **kwargs):
+        W = self.W + 1e-6
+        m_act = m.dot(W)
+        if full_cov:
+            v_act = W.T.dot(v).dot(W)
+            v = tt.diag(v)[None, :]
+        else:
+            v_act = v.dot(W**2)
+        if not (deterministic or self.p == 0):
+            # the additive noise has zero mean and its variance depends on
+            # the second moment of the inputs (the noise of different
+            # units is independent)
+            v_noise = (v + m**2).dot(tt.exp(self.log_sigma2)+1e-6)
+            v_act += tt.diag(v_noise[0]) if full_cov else v_noise
+        C_act = C.dot(W) if C is not None else None
+        if self.b is not None:
+            m_act = m_act + self.b
+        return nonlinearity_moments(self.nonlinearity, m_act, v_act, C_act,
+                                    full_cov)
+
     def get_output_for(self, input, deterministic=False,
                        fixed_noise_samples=False, **kwargs):
         num_leading_axes = self.num_leading_axes
@@ -485,6 +546,108 @@ def inv_phi(y):
     return -tt.sqrt(2)*tt.erfcinv(2*y)
 
 
+def normal_pdf(x):
+    return tt.exp(-0.5*x**2)/np.sqrt(2*np.pi).astype(floatX)
+
+
+def nonlinearity_moments(nonlinearity, m, v, C=None, full_cov=False):
+    ''' Given the mean m and variance v of the (independent, gaussian)
+        pre-activations of a layer, returns the mean and variance of the
+        layer outputs via moment matching. If C, the covariance between the
+        network inputs and the pre-activations, is provided, the covariance
+        between the network inputs and the outputs is also returned (via
+        Stein's lemma, i.e. C times the expected slope of the nonlinearity).
+        If full_cov is True, v is the covariance matrix of the
+        pre-activations of a single input (m has shape [1, D]), and the
+        covariance matrix of the outputs is returned. Its diagonal is
+        computed as above, while the covariances between different units are
+        scaled by the expected slopes of the nonlinearity (i.e. they are
+        exact for jointly gaussian pre-activations and a linear
+        nonlinearity, and a first order approximation otherwise)
+    '''
+    if full_cov:
+        S = v
+        v = tt.diag(S)[None, :]
+    if nonlinearity in (None, nonlinearities.linear, nonlinearities.identity):
+        return m, (S if full_cov else v), C
+    elif nonlinearity is nonlinearities.rectify:
+        s = tt.sqrt(v + 1e-12)
+        z = m/s
+        cdf_z = phi(z)
+        pdf_z = normal_pdf(z)
+        m_out = m*cdf_z + s*pdf_z
+        m2_out = (m**2 + v)*cdf_z + m*s*pdf_z
+        v_out = tt.maximum(m2_out - m_out**2, 1e-12)
+        C_out = C*cdf_z if C is not None else None
+        if full_cov:
+            S_out = S*tt.outer(cdf_z[0], cdf_z[0])
+            v_out = S_out - tt.diag(tt.diag(S_out)) + tt.diag(v_out[0])
+        return m_out, v_out, C_out
+    else:
+        msg = 'Moment propagation is not implemented for %s'
+        raise NotImplementedError(msg % (str(nonlinearity)))
+
+
+def dense_moments(m, v, C, W, b=None, nonlinearity=None, mn=1, vn=0,
+                  full_cov=False):
+    ''' Moment propagation through a dense layer whose inputs are
+        multiplied by independent noise with mean mn and variance vn.
+        m and v are the mean and variance of the inputs; C is the covariance
+        between the network inputs and the inputs of this layer (can be
+        None). If full_cov is True, v is the covariance matrix of the inputs (see
+        nonlinearity_moments)
+    '''
+    # moments of the noisy inputs
+    m2 = m**2
+    m_in = m*mn
+    if full_cov:
+        # the noise is independent of the inputs, so it only adds to the
+        # variances
+        mn_ = (tt.ones_like(m)*mn)[0]
+        vn_ = (tt.ones_like(m)*vn)[0]
+        S_in = v*tt.outer(mn_, mn_) + tt.diag((tt.diag(v) + m2[0])*vn_)
+    else:
+        v_in = (v + m2)*(vn + mn**2) - m2*mn**2
+
+    # moments of the pre-activations
+    m_act = m_in.dot(W)
+    if b is not None:
+        m_act = m_act + b
+    v_act = W.T.dot(S_in).dot(W) if full_cov else v_in.dot(W**2)
+    C_act = (C*mn).dot(W) if C is not None else None
+
+    return nonlinearity_moments(nonlinearity, m_act, v_act, C_act, full_cov)
+
+
+def get_output_moments(network, m, v, C=None, deterministic=False,
+                       full_cov=False, **kwargs):
+    ''' Propagates the input mean m and (diagonal) variance v through a
+        feedforward network, layer by layer, assuming that the activations
+        are independent and gaussian distributed. Returns the output mean,
+        variance and the covariance between the network inputs and outputs
+        (if C, the covariance of the inputs with themselves, is provided).
+        If full_cov is True, v is the full covariance matrix of a single
+        input (m has shape [1, D]), which is propagated through the layers
+        (see nonlinearity_moments), and the covariance matrix of the outputs
+        is returned
+    '''
+    for layer in lasagne.layers.get_all_layers(network):
+        if isinstance(layer, lasagne.layers.InputLayer):
+            continue
+        if hasattr(layer, 'get_output_moments_for'):
+            m, v, C = layer.get_output_moments_for(
+                m, v, C, deterministic=deterministic, full_cov=full_cov,
+                **kwargs)
+        elif isinstance(layer, lasagne.layers.DenseLayer):
+            m, v, C = dense_moments(
+                m, v, C, layer.W, layer.b, layer.nonlinearity,
+                full_cov=full_cov)
+        else:
+            msg = 'Moment propagation is not implemented for %s'
+            raise NotImplementedError(msg % (layer.__class__.__name__))
+    return m, v, C
+
+
 class DenseLogNormalDropoutLayer(DenseDropoutLayer):
     def __init__(self, incoming, num_units, W=init.GlorotUniform(),
                  b=init.Constant(0.), nonlinearity=nonlinearities.rectify,
@@ -566,12 +729,9 @@ class DenseLogNormalDropoutLayer(DenseDropoutLayer):
         self.phi_alpha = phi(self.alpha)
         self.Z = phi(self.beta) - self.phi_alpha
 
-        # compute SNR
-        # Z1 = phi(sigma-alpha) - phi(sigma-beta)
-        # Z2 = phi(2*sigma-alpha) - phi(2*sigma-beta)
-        # Enoise = (Z1)/tt.sqrt(Z)
-        # Varnoise = tt.sqrt(tt.exp(sigma**2)*Z2 - Z1**2)
-        # snr = Enoise/Varnoise
+        # compute the signal to noise ratio of the noise for each input unit
+        mn, vn = self.noise_moments()
+        self.snr = mn/tt.sqrt(vn)
 
     def get_intermediate_outputs(self):
         ''' returns variables that do not depend on the input;
@@ -582,6 +742,10 @@ class DenseLogNormalDropoutLayer(DenseDropoutLayer):
         return [self.mu, self.sigma, self.alpha, self.beta,
                 self.phi_alpha, self.Z]
 
+    def sample_noise_np(self, n_samples, a=1e-5, b=1-1e-5):
+        noise_shape = self.get_noise_shape(n_samples)
+        return get_rng().uniform(a, b, noise_shape).astype(floatX)
+
     def sample_noise(self, input, a=1e-5, b=1-1e-5):
         # get noise_shape
         noise_shape = input.shape
@@ -616,6 +780,16 @@ class DenseLogNormalDropoutLayer(DenseDropoutLayer):
         # only keep neurons with high signal to noise ratio
         return input*noise
 
+    def noise_moments(self):
+        # moments of exp(x), where x is a truncated normal random variable
+        # with parameters mu, sigma in the interval [a, b]
+        mu, sigma = self.mu, self.sigma
+        Z1 = phi(self.beta - sigma) - phi(self.alpha - sigma)
+        Z2 = phi(self.beta - 2*sigma) - phi(self.alpha - 2*sigma)
+        mn = tt.exp(mu + 0.5*sigma**2)*Z1/self.Z
+        m2n = tt.exp(2*mu + 2*sigma**2)*Z2/self.Z
+        return mn, m2n - mn**2
+
 
 class DenseConcreteDropoutLayer(DenseDropoutLayer):
     '''
@@ -673,6 +847,11 @@ class DenseConcreteDropoutLayer(DenseDropoutLayer):
         self.logp = tt.log(p_bin + eps)
         self.log1mp = tt.log(1.0 - p_bin + eps)
 
+    def sample_noise_np(self, n_samples, a=0, b=1):
+        eps = np.finfo(np.__dict__[floatX]).eps
+        noise_shape = self.get_noise_shape(n_samples)
+        return get_rng().uniform(a+eps, b-eps, noise_shape).astype(floatX)
+
     def sample_noise(self, input, a=0, b=1):
         # get noise_shape
         noise_shape = input.shape
@@ -693,6 +872,11 @@ class DenseConcreteDropoutLayer(DenseDropoutLayer):
 
         return noise
 
+    def noise_moments(self):
+        # approximate the relaxed noise with the bernoulli distribution
+        retain_prob = 1 - self.p
+        return retain_prob, retain_prob*(1 - retain_prob)
+
     def apply_noise(self, input, noise):
         concrete_p = self.logp - self.log1mp + tt.log(noise) - tt.log(1-noise)
         concrete_noise = tt.nnet.sigmoid(concrete_p/self.temp)
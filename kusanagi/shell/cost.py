@@ -92,6 +92,67 @@ def quadratic_saturating_loss(mx, Sx, target, Q, *args, **kwargs):
         return 1.0 + m_cost, s_cost
 
 
+def quadratic_saturating_loss_widths(mx, Sx, target, Q, cw=[1],
+                                     *args, **kwargs):
+    '''
+        Evaluates quadratic_saturating_loss for all the widths c in cw (i.e.
+        with Q/c**2) at once. The outputs have one entry per width in their
+        last axis. In the moment matching case, Q must be a numpy array; it
+        is factorized as Q = P.dot(P.T) with numpy, and all the widths share
+        a single eigendecomposition of M = P.T.dot(Sx).dot(P), from which
+        the inverses and determinants of I + Sx.dot(Q)/c**2 are obtained.
+        The gradients with respect to M are computed from the same
+        decomposition (via a first order expansion), without
+        differentiating through the eigendecomposition, which is unstable
+        for repeated eigenvalues.
+    '''
+    cw2 = np.array(cw, dtype=theano.config.floatX)**2
+    if Sx is None:
+        # deterministic case
+        if mx.ndim == 1:
+            mx = mx[None, :]
+        delta = mx - target[None, :]
+        dist = tt.batched_dot(delta.dot(Q), delta)
+        return 1.0 - tt.exp(-0.5*dist[:, None]/cw2)
+    else:
+        # stochastic case (moment matching)
+        q, U = np.linalg.eigh(Q)
+        keep = q > 1e-12*max(q.max(), 0)
+        P = (U[:, keep]*np.sqrt(q[keep])).astype(theano.config.floatX)
+        p = (mx - target).dot(P)
+        M = P.T.dot(Sx).dot(P)
+        M = 0.5*(M + M.T)
+
+        no_grad = theano.gradient.disconnected_grad
+        lam, V = tt.nlinalg.eigh(no_grad(M))
+        lam = tt.maximum(lam, 0)
+        y = V.T.dot(no_grad(p))
+        # zero valued perturbations, used to propagate the gradients
+        dp = p - no_grad(p)
+        dMV = V.T.dot(M - no_grad(M)).dot(V)
+
+        def quad_logdet(a):
+            ''' returns p^T (c^2 I + a M)^-1 p and log|I + a M/c^2| '''
+            den = cw2[:, None] + a*lam[None, :]
+            Ay = y[None, :]/den
+            quad = (y[None, :]*Ay).sum(1)
+            logdet = tt.log1p(a*lam[None, :]/cw2[:, None]).sum(1)
+            # first order terms
+            quad += 2*(Ay.dot(V.T)*dp[None, :]).sum(1)
+            quad -= a*(Ay.dot(dMV)*Ay).sum(1)
+            logdet += a*(tt.diagonal(dMV)[None, :]/den).sum(1)
+            return quad, logdet
+
+        quad1, logdet1 = quad_logdet(1)
+        quad2, logdet2 = quad_logdet(2)
+        # mean
+        m_cost = -tt.exp(-0.5*quad1 - 0.5*logdet1)
+        # var
+        s_cost = tt.exp(-quad2 - 0.5*logdet2) - m_cost**2
+
+        return 1.0 + m_cost, s_cost
+
+
 def huber_loss(mx, Sx, target, Q, width=1.0, *args, **kwargs):
     '''
         Huber loss
@@ -236,20 +297,31 @@ def distance_based_cost(mx, Sx, target, Q,
 
     if not isinstance(cw, list):
         cw = [cw]
+    # all the widths are evaluated at once, if possible
+    vectorized = loss_func is quadratic_saturating_loss and (
+        Sx is None or isinstance(Q, np.ndarray))
     if Sx is None:
         # deterministic case
+        if vectorized:
+            return quadratic_saturating_loss_widths(
+                mx, None, target, Q, cw).mean(-1)
         cost = []
         # total cost is the sum of costs with different widths
-        # TODO this can be vecotrized
         for c in cw:
             cost_c = loss_func(mx, None, target, Q/(c**2), *args, **kwargs)
             cost.append(cost_c)
         return sum(cost)/len(cw)
     else:
+        if vectorized:
+            M_cost, S_cost = quadratic_saturating_loss_widths(
+                mx, Sx, target, Q, cw)
+            # add UCB  exploration term
+            if expl is not None and expl != 0.0:
+                M_cost += expl*tt.sqrt(S_cost)
+            return M_cost.mean(), S_cost.sum()/(len(cw)**2)
         M_cost = []
         S_cost = []
         # total cost is the sum of costs with different widths
-        # TODO this can be vectorized
         for c in cw:
             m_cost, s_cost = loss_func(mx, Sx, target, Q/c**2, *args, **kwargs)
             # add UCB  exploration term
@@ -1,5 +1,6 @@
 import numpy as np
 
+from functools import partial
 from lasagne import nonlinearities
 from matplotlib import pyplot as plt
 
@@ -13,14 +14,32 @@ def plot_rollout(rollout_fn, exp, *args, **kwargs):
     axarr = kwargs.get('axarr', None)
     name = kwargs.get('name', 'Rollout')
     n_exp = kwargs.get('n_exp', 0)
-    ret = rollout_fn(*args)
-    trajectories = m_states = None
-    if len(ret) == 3:
-        loss, costs, trajectories = ret
-        n_samples, T, dims = trajectories.shape
+    recorder = kwargs.get('recorder', None)
+    max_points = kwargs.get('max_points', 200)
+    n_blocks = kwargs.get('n_blocks', 1)
+    if recorder is None:
+        recorder = utils.recorder.TrajectoryRecorder(output_folder=None)
+    particles, m_states = True, None
+    if n_blocks > 1:
+        # the particles are rolled out in blocks, which are streamed into
+        # the recorder as they are computed
+        recorder.record_rollouts(rollout_fn, args, n_blocks)
+        T, dims = recorder.shape[1:]
+        t, m_traj, _, q_traj = recorder.summary(max_points=max_points)
     else:
-        loss, m_costs, s_costs, m_states, s_states = ret
-        T, dims = m_states.shape
+        ret = rollout_fn(*args)
+        particles = len(ret) != 5
+        if particles:
+            loss, costs, trajectories = ret[:3]
+            n_samples, T, dims = trajectories.shape
+            # stream the particles into the recorder, and plot its summaries
+            recorder.new_iteration(n_samples, T, dims)
+            recorder.record(trajectories, costs)
+            recorder.flush()
+            t, m_traj, _, q_traj = recorder.summary(max_points=max_points)
+        else:
+            loss, m_costs, s_costs, m_states, s_states = ret
+            T, dims = m_states.shape
 
     if fig is None or axarr is None:
         utils.print_with_stamp("Creating fig and axes", "plot_rollout")
@@ -29,15 +48,18 @@ def plot_rollout(rollout_fn, exp, *args, **kwargs):
     exp_states = np.array(exp.states)
     for d in range(dims):
         axarr[d].clear()
-        if trajectories is not None:
-            st = trajectories[:, :, d]
-            # plot predictive distribution
-            for i in range(n_samples):
+        if particles:
+            # plot predictive distribution (quantile bands, from the
+            # outermost to the innermost)
+            n_q = q_traj.shape[0]
+            for i in range(n_q//2):
+                axarr[d].fill_between(
+                    t, q_traj[i, :, d], q_traj[n_q-1-i, :, d],
+                    color='steelblue', alpha=0.2, linewidth=0)
+            if n_q % 2 == 1:
                 axarr[d].plot(
-                    np.arange(T), st[i, :], color='steelblue',
-                    alpha=10.0/n_samples)
-            axarr[d].plot(
-                np.arange(T), st[:, :].mean(0), color='blue', linewidth=2)
+                    t, q_traj[n_q//2, :, d], color='steelblue', linewidth=1)
+            axarr[d].plot(t, m_traj[:, d], color='blue', linewidth=2)
         if m_states is not None:
             axarr[d].plot(
                 np.arange(T), m_states[:, d], color='steelblue',
@@ -80,6 +102,15 @@ def gTrig(state, angle_dims=[]):
     return utils.gTrig_np(state, angle_dims).flatten()
 
 
+def save_checkpoint(*objs):
+    ''' Saves the state of the given objects. Their state is marked as
+    changed first, since updating the values of their shared variables
+    (e.g. parameters or dropout masks) does not set the flag'''
+    for obj in objs:
+        obj.state_changed = True
+        obj.save()
+
+
 def setup_pilco_experiment(params, pol=None, dyn=None):
     # initial state distribution
     p0 = params['state0_dist']
@@ -146,8 +177,11 @@ def setup_mc_pilco_experiment(params, pol=None, dyn=None):
     # create experience dataset
     exp = ExperienceDataset()
 
-    # init policy optimizer
-    polopt = optimizers.SGDOptimizer(**params['optimizer'])
+    # init policy optimizer. The moment estimates are kept across learning
+    # iterations, since the policy changes little between iterations
+    polopt_params = dict(warm_start=True)
+    polopt_params.update(params['optimizer'])
+    polopt = optimizers.SGDOptimizer(**polopt_params)
 
     # module where get_loss and build_rollout are defined
     # (can also be a class)
@@ -160,10 +194,45 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
                          params=None, loss_kwargs={}, polopt_kwargs={},
                          extra_inps=[], extra_opt_params=[], step_cb=None,
                          minimize_cb=None, learning_iteration_cb=None,
-                         max_dataset_size=0, render=False, debug_plot=0):
+                         max_dataset_size=0, render=False, debug_plot=0,
+                         checkpoint=False, checkpoint_every=None,
+                         resume=False):
+    '''
+        Runs the learning loop of a pilco-like algorithm: collects initial
+        experience, then alternates between training the dynamics model,
+        optimizing the policy and applying it to the environment.
+        @param checkpoint whether to save the experience, dynamics model,
+                          policy and policy optimizer state at the end of
+                          every learning iteration
+        @param checkpoint_every if set, the policy optimizer state is also
+                                saved every checkpoint_every optimization
+                                iterations (only supported by SGDOptimizer),
+                                and the dropout masks of the models are
+                                saved before every optimization
+        @param resume whether to restore the state saved by a previous run
+                      (with checkpoint=True) and continue from its last
+                      learning iteration (or optimization checkpoint)
+    '''
     # setup experiment
     exp_objs = exp_setup(params)
     p0, pol, dyn, exp, polopt, learner = exp_objs
+    # learning iterations completed by a previous run
+    n_done = 0
+    resume = resume and exp.load()
+    noise_samples = None
+    if resume:
+        utils.print_with_stamp('Resuming experiment', 'experiment_utils')
+        dyn.load()
+        pol.load()
+        # the dropout masks saved with the models; building the rollout
+        # graphs below resamples them
+        noise_samples = [m.get_noise_samples() for m in (dyn, pol)
+                         if hasattr(m, 'get_noise_samples')]
+    n_starts = params.get('n_starts', 1)
+    if n_starts > 1:
+        # optimize multiple policy initializations in parallel
+        polopt = optimizers.MultiStartOptimizer(
+            polopt, n_starts, **params.get('multistart', {}))
     n_rnd = params.get('n_rnd', 1)
     n_init = params.get('n_init', 0)
     if n_rnd == 0:
@@ -174,6 +243,8 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
     H = params.get('min_steps', 100)
     gamma = params.get('discount', 1.0)
     angle_dims = params.get('angle_dims', [])
+    # hold each command for action_repeat steps, as in the rollouts
+    action_repeat = loss_kwargs.get('action_repeat', 1)
     minimize_cb_state = [0, None, None]
 
     # init callbacks
@@ -197,10 +268,10 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
                 p0 = params['state0_dist']
                 m0, S0 = p0.mean, p0.cov
                 progress_fig, progress_axarr = plot_rollout(
-                    rollout_fn, exp, m0, S0, H, gamma,
+                    plot_engine, exp, m0, S0, H, gamma,
                     fig=progress_fig, axarr=progress_axarr,
-                    n_exp=min(10, exp.n_episodes()),
-                    name='Rollout during optimization')
+                    n_exp=min(10, exp.n_episodes()), n_blocks=n_blocks,
+                    recorder=recorder, name='Rollout during optimization')
                 plt.waitforbuttonpress(0.01)
             counter += 1
             minimize_cb_state[0] = counter
@@ -214,47 +285,147 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
     def gTrig(state):
         return utils.gTrig_np(state, angle_dims).flatten()
 
-    # collect experience with random controls
-    randpol = control.RandPolicy(maxU=pol.maxU)
-    for i in range(n_rnd):
-        exp.new_episode()
-        utils.print_with_stamp('Executing uniformly-random controls')
-        apply_controller(env, randpol, H,
-                         preprocess=gTrig,
-                         callback=step_cb_internal)
-
-    for i in range(n_init):
-        exp.new_episode()
-        utils.print_with_stamp('Executing initial policy')
-        apply_controller(env, pol, H,
-                         preprocess=gTrig,
-                         callback=step_cb_internal)
-
-    # 1. train dynamics once
-    train_dynamics(
-        dyn, exp, angle_dims=angle_dims, max_dataset_size=max_dataset_size)
-
-    # build loss function
-    loss, inps, updts = learner.get_loss(
-        pol, dyn, cost, angle_dims, **loss_kwargs)
+    if exp.n_episodes() > 0:
+        # the dynamics model was trained at the end of the last completed
+        # iteration
+        n_done = max(0, exp.n_episodes() - n_rnd - n_init)
+    else:
+        # collect experience with random controls
+        randpol = control.RandPolicy(maxU=pol.maxU)
+        for i in range(n_rnd):
+            exp.new_episode()
+            utils.print_with_stamp('Executing uniformly-random controls')
+            apply_controller(env, randpol, H,
+                             preprocess=gTrig,
+                             callback=step_cb_internal)
+
+        for i in range(n_init):
+            exp.new_episode()
+            utils.print_with_stamp('Executing initial policy')
+            apply_controller(env, pol, H,
+                             preprocess=gTrig,
+                             callback=step_cb_internal,
+                             action_repeat=action_repeat)
+
+        # 1. train dynamics once
+        train_dynamics(
+            dyn, exp, angle_dims=angle_dims,
+            max_dataset_size=max_dataset_size)
+        if checkpoint:
+            save_checkpoint(pol, dyn, exp)
+
+    # if set, the rollouts for the diagnostics are computed in blocks of
+    # plot_block_size particles, which are streamed to disk by the recorder
+    # (only for particle based learners). The blocks use independent noise
+    # samples and dropout masks resampled at every step. This engine is
+    # built first, since building a graph resizes the dropout masks of the
+    # models to its number of particles. A separate engine is also used
+    # with checkpointed rollouts, which only return the states at the end of
+    # every segment; it is evaluated without its updates, so it uses the
+    # common random numbers of the loss without advancing them
+    plot_block_size = params.get('plot_block_size')
+    n_samples = loss_kwargs.get('n_samples', 100)
+    plot_engine, n_blocks = None, 1
+    plot_kwargs = None
+    if debug_plot > 0 and plot_block_size and learner is algorithms.mc_pilco\
+            and plot_block_size < n_samples:
+        plot_kwargs = dict(
+            (k, v) for k, v in loss_kwargs.items()
+            if k not in ('adaptive_samples', 'reuse_rollouts',
+                         'multiple_shooting', 'n_init_dists', 'checkpoint'))
+        plot_kwargs.update(n_samples=plot_block_size, crn=False,
+                           resample_dyn=True)
+        n_blocks = int(np.ceil(n_samples/float(plot_block_size)))
+    elif debug_plot > 0 and loss_kwargs.get('checkpoint', False):
+        plot_kwargs = dict(
+            (k, v) for k, v in loss_kwargs.items() if k != 'checkpoint')
+    if plot_kwargs is not None:
+        plot_engine = learner.build_rollout(
+            pol, dyn, cost, angle_dims, **plot_kwargs)
+        if n_blocks == 1:
+            plot_engine = partial(plot_engine, update=False)
+
+    # gradient free optimizers evaluate the candidates of every generation
+    # with a single rollout (see mc_pilco.get_population_loss). Its graph is
+    # built last, so the fixed dropout masks have the size of the
+    # population; the rollouts for the diagnostics resample the masks
+    population = isinstance(polopt, optimizers.ESOptimizer) and\
+        polopt.batched and hasattr(learner, 'get_population_loss')
+    engine_kwargs = loss_kwargs
+    if population:
+        engine_kwargs = dict(loss_kwargs, resample_dyn=True)
+
+    # build the rollout engine, whose compiled function evaluates the loss
+    # and gradients for the policy optimizer and the trajectories for the
+    # diagnostics
+    rollout_engine = learner.build_rollout(
+        pol, dyn, cost, angle_dims, **engine_kwargs)
+    loss = rollout_engine.loss
+    inps = rollout_engine.inps + extra_inps
 
-    outs = []
-    if isinstance(loss, list):
-        loss, outs = loss[0], loss[1:]
+    # set objective of policy optimizer
+    polopt_kwargs = dict(polopt_kwargs)
+    if population:
+        polopt_kwargs['population'] = learner.get_population_loss(
+            pol, dyn, cost, polopt.pop_size, angle_dims, **loss_kwargs)
+    else:
+        polopt_kwargs['engine'] = rollout_engine
+    if loss_kwargs.get('adaptive_samples') is not None:
+        polopt_kwargs['sample_size_adapter'] = loss_kwargs['adaptive_samples']
+    if loss_kwargs.get('reuse_rollouts') is not None:
+        if not crn_dropout:
+            # the importance weights are only valid for the dropout masks
+            # used to sample the cached rollouts
+            msg = 'Reusing rollouts requires fixed dropout masks during'
+            msg += ' the policy optimization (crn_dropout=True)'
+            raise ValueError(msg)
+        polopt_kwargs['loss_estimator'] = loss_kwargs['reuse_rollouts']
+    multiple_shooting = loss_kwargs.get('multiple_shooting')
+    if multiple_shooting is not None:
+        # the start distributions of the segments are optimized along with
+        # the policy
+        extra_opt_params = extra_opt_params + multiple_shooting.params
+    polopt.set_objective(loss, pol.get_params(symbolic=True)+extra_opt_params,
+                         inps, rollout_engine.updts, **polopt_kwargs)
+    # the optimizer wrapped by MultiStartOptimizer holds the final state
+    base_polopt = getattr(polopt, 'optimizer', polopt)
+    can_checkpoint = isinstance(base_polopt, optimizers.BaseOptimizer)
+    if resume and can_checkpoint:
+        # restore the moments, averages, counters and random states of the
+        # policy optimizer (and the parameters, if saved during an
+        # optimization)
+        base_polopt.load()
+        if base_polopt.curr_iter > 0:
+            # an interrupted optimization continues with the dropout masks
+            # it was using
+            models = [m for m in (dyn, pol)
+                      if hasattr(m, 'set_noise_samples')]
+            for m, samples in zip(models, noise_samples):
+                m.set_noise_samples(samples)
+    minimize_kwargs = {}
+    if checkpoint_every:
+        if base_polopt is polopt and can_checkpoint:
+            minimize_kwargs['checkpoint_every'] = checkpoint_every
+        else:
+            msg = 'checkpoint_every is not supported by %s; the optimizer'
+            msg += ' state will only be saved after every learning iteration'
+            utils.print_with_stamp(msg % (polopt.__class__.__name__),
+                                   'experiment_utils')
 
     rollout_fn = None
+    recorder = None
     if debug_plot > 0:
-        # build rollout function for plotting
-        loss_kwargs['mm_state'] = False
-        rollout_fn = learner.build_rollout(
-            pol, dyn, cost, angle_dims, **loss_kwargs)
+        recorder = utils.recorder.TrajectoryRecorder()
+        # the diagnostics evaluate the rollouts of the loss (i.e. with the
+        # same configuration, e.g. mm_state), but without the updates of its
+        # graph, so they don't advance the common random numbers or random
+        # states, or write the cache of reused rollouts, used by the policy
+        # optimizer
+        rollout_fn = partial(rollout_engine, update=False)
+        if plot_engine is None:
+            plot_engine = rollout_fn
         fig, axarr = None, None
 
-    # set objective of policy optimizer
-    inps += extra_inps
-    polopt.set_objective(loss, pol.get_params(symbolic=True)+extra_opt_params,
-                         inps, updts, outs, **polopt_kwargs)
-
     # initial call so that the user gets the state before
     # the first learrning iteration
     if callable(learning_iteration_cb):
@@ -266,15 +437,25 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
     else:
         utils.print_with_stamp(
             'resampling weights for dyn and pol', 'experiment_utils')
-    for i in range(n_opt):
+    for i in range(n_done, n_opt):
         total_exp = sum([len(st) for st in exp.states])
         msg = '==== Iteration [%d], experience: [%d steps] ===='
         utils.print_with_stamp(msg % (i+1, total_exp))
-        if crn_dropout:
+        # an optimization interrupted at a checkpoint continues with the
+        # dropout masks it was using, which were restored after building
+        # the rollout graphs
+        resume_opt = can_checkpoint and base_polopt.curr_iter > 0
+        if crn_dropout and not resume_opt:
             if hasattr(dyn, 'update'):
                 dyn.update()
             if hasattr(pol, 'update'):
                 pol.update()
+            if checkpoint and 'checkpoint_every' in minimize_kwargs:
+                save_checkpoint(pol, dyn)
+        elif resume_opt:
+            msg = 'Resuming policy optimization from iteration %d'
+            utils.print_with_stamp(msg % (base_polopt.curr_iter),
+                                   'experiment_utils')
 
         # get initial state distribution (assumed gaussian)
         x0 = np.array([st[0] for st in exp.states])
@@ -284,7 +465,10 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
 
         # 2. optimize policy
         minimize_args = [m0, S0, H, gamma]
-        if isinstance(polopt, optimizers.SGDOptimizer):
+        if multiple_shooting is not None:
+            multiple_shooting.init_states(*minimize_args)
+        if isinstance(getattr(polopt, 'optimizer', polopt),
+                      optimizers.SGDOptimizer):
             # check if we have a learning rate parameter
             lr = params.get('learning_rate', 1e-4)
             if callable(lr):
@@ -293,24 +477,33 @@ def run_pilco_experiment(env, cost, exp_setup=setup_mc_pilco_experiment,
 
         polopt.minimize(*minimize_args,
                         callback=minimize_cb_internal,
-                        return_best=return_best)
+                        return_best=return_best, **minimize_kwargs)
 
         # 3. apply controller
         exp.new_episode(
             policy_params=pol.get_params(symbolic=False, ignore_fixed=False))
         apply_controller(env, pol, H,
-                         preprocess=gTrig, callback=step_cb_internal)
+                         preprocess=gTrig, callback=step_cb_internal,
+                         action_repeat=action_repeat)
         # 4. train dynamics once
         train_dynamics(dyn, exp, angle_dims=angle_dims,
                        max_dataset_size=max_dataset_size)
 
+        if checkpoint:
+            # the experience is saved last, since it determines the number
+            # of completed iterations when resuming
+            if can_checkpoint:
+                base_polopt.save()
+            save_checkpoint(pol, dyn, exp)
+
         if callable(learning_iteration_cb):
             # user callback
             learning_iteration_cb(exp, dyn, pol, polopt, params, rollout_fn)
 
         if debug_plot > 0:
             fig, axarr = plot_rollout(
-                rollout_fn, exp, m0, S0, H, gamma, fig=fig, axarr=axarr)
+                plot_engine, exp, m0, S0, H, gamma, fig=fig, axarr=axarr,
+                recorder=recorder, n_blocks=n_blocks)
     env.close()
 
 
@@ -1,3 +1,5 @@
 from . import updates
 from . import distributions
+from . import sampling
+from . import recorder
 from .utils_ import *
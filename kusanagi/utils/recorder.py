@@ -0,0 +1,155 @@
+import numpy as np
+import os
+
+from kusanagi.utils.utils_ import get_run_output_dir, print_with_stamp
+
+
+class TrajectoryRecorder(object):
+    '''
+        Streams the outputs of a rollout (particle trajectories and costs)
+        into on-disk memory mapped arrays, while updating the mean and
+        variance per time step and dimension incrementally. The particles can
+        be recorded in blocks, so the full set of trajectories does not need
+        to be kept in memory, and the summaries can be used for plotting
+        instead of the individual particles. The same files are overwritten
+        at every iteration.
+        The quantiles can't be merged across blocks, so they are computed
+        exactly from the stored particles, a few time steps at a time, when
+        the summaries are requested.
+        @param output_folder folder where the memory mapped files are stored.
+                             If None, the particles are stored in memory.
+                             Defaults to
+                             utils.get_run_output_dir()/rollouts
+        @param quantiles quantiles to compute for the summaries
+    '''
+    def __init__(self, output_folder='', quantiles=(0.05, 0.25, 0.5, 0.75,
+                                                    0.95),
+                 name='TrajectoryRecorder'):
+        if output_folder == '':
+            output_folder = os.path.join(get_run_output_dir(), 'rollouts')
+        self.output_folder = output_folder
+        self.quantiles = np.array(quantiles, dtype=np.float64)
+        self.name = name
+        self.iteration = -1
+        self.trajectories = None
+        self.costs = None
+        self.n = 0
+
+    def allocate(self, key, shape):
+        ''' Returns the store for the given key and shape '''
+        if self.output_folder is None:
+            return np.empty(shape, dtype=np.float32)
+        path = os.path.join(self.output_folder, '%s_%s.dat' % (
+            self.name, key))
+        print_with_stamp('Recording %s to %s' % (key, path), self.name)
+        return np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+
+    def new_iteration(self, n_samples, H, D):
+        '''
+            Allocates the stores for the rollouts of a new iteration, with
+            n_samples trajectories of H steps and D dimensions, and resets
+            the summaries. The stores of the previous iteration are
+            overwritten.
+        '''
+        self.iteration += 1
+        self.shape = (n_samples, H, D)
+        self.n = 0
+        self.stats = dict(
+            (k, [0, np.zeros(shape), np.zeros(shape)])
+            for k, shape in (('trajectories', (H, D)), ('costs', (H,))))
+        # release the previous stores before reopening their files
+        self.trajectories = self.costs = None
+        if self.output_folder is not None and\
+                not os.path.isdir(self.output_folder):
+            os.makedirs(self.output_folder)
+        self.trajectories = self.allocate('trajectories', (n_samples, H, D))
+        self.costs = self.allocate('costs', (n_samples, H))
+
+    def update_stats(self, key, X):
+        n, mean, var = self.stats[key]
+        n_b = X.shape[0]
+        mean_b = X.mean(0)
+        var_b = X.var(0)
+        n_ab = n + n_b
+        delta = mean_b - mean
+        w = float(n_b)/n_ab
+        mean_ab = mean + delta*w
+        var_ab = (1 - w)*var + w*var_b + w*(1 - w)*delta**2
+        self.stats[key] = [n_ab, mean_ab, var_ab]
+
+    def get_quantiles(self, key, t, max_size=2**24):
+        '''
+            Returns the quantiles of the recorded particles at the time
+            indices t, reading at most max_size values from the store at a
+            time.
+        '''
+        n = self.stats[key][0]
+        store = getattr(self, key)[:n]
+        step_size = max(1, np.prod(store.shape[2:], dtype=int)*n)
+        chunk = max(1, max_size//step_size)
+        q = np.empty((len(self.quantiles), len(t)) + store.shape[2:])
+        for i in range(0, len(t), chunk):
+            q[:, i:i+chunk] = np.percentile(
+                store[:, t[i:i+chunk]], 100*self.quantiles, axis=0)
+        return q
+
+    def record(self, trajectories, costs=None):
+        '''
+            Records a block of particles, with shapes [n, H, D] for the
+            trajectories and [n, H] for the costs
+        '''
+        trajectories = np.asarray(trajectories)
+        if self.iteration < 0 or self.n + trajectories.shape[0] >\
+                self.shape[0]:
+            self.new_iteration(trajectories.shape[0],
+                               *trajectories.shape[1:])
+        idx = slice(self.n, self.n + trajectories.shape[0])
+        self.trajectories[idx] = trajectories
+        self.update_stats('trajectories', trajectories)
+        if costs is not None and np.ndim(costs) == 2:
+            self.costs[idx] = costs
+            self.update_stats('costs', np.asarray(costs))
+        self.n += trajectories.shape[0]
+
+    def record_rollouts(self, rollout_fn, inputs, n_blocks):
+        '''
+            Evaluates the rollout function n_blocks times (e.g. a rollout
+            compiled for a block of particles, with independent samples at
+            every call), writing the trajectories and costs of every block
+            to the stores as soon as it is computed; i.e. only one block of
+            particles is kept in memory.
+            @param rollout_fn function that returns (loss, costs,
+                              trajectories), with shapes [n, H] and
+                              [n, H, D] for the costs and trajectories of a
+                              block of n particles
+            @param inputs inputs for rollout_fn
+            @return the loss of every block
+        '''
+        losses = []
+        for b in range(n_blocks):
+            loss, costs, trajectories = rollout_fn(*inputs)[:3]
+            if b == 0:
+                self.new_iteration(n_blocks*trajectories.shape[0],
+                                   *trajectories.shape[1:])
+            self.record(trajectories, costs)
+            losses.append(loss)
+            del costs, trajectories
+        self.flush()
+        return losses
+
+    def flush(self):
+        for store in (self.trajectories, self.costs):
+            if isinstance(store, np.memmap):
+                store.flush()
+
+    def summary(self, key='trajectories', max_points=200):
+        '''
+            Returns the time indices, mean, standard deviation and quantiles
+            of the recorded trajectories (or costs), decimated to at most
+            max_points time steps.
+        '''
+        n, mean, var = self.stats[key]
+        H = mean.shape[0]
+        step = int(np.ceil(H/float(max_points)))
+        t = np.arange(0, H, step)
+        return t, mean[t], np.sqrt(var[t]), self.get_quantiles(key, t)
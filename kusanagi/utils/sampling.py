@@ -0,0 +1,158 @@
+import lasagne
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from scipy.special import ndtri
+from theano.sandbox.rng_mrg import MRG_RandomStreams, mrg_uniform
+from kusanagi.utils.utils_ import get_mrng
+
+floatX = theano.config.floatX
+
+SAMPLING_METHODS = ['iid', 'antithetic', 'lhs', 'sobol']
+
+
+def inv_phi(y):
+    return -tt.sqrt(2)*tt.erfcinv(2*y)
+
+
+def clip_uniform(u):
+    eps = np.finfo(np.__dict__[floatX]).eps
+    return u.clip(eps, 1-eps)
+
+
+def sobol_points(n, d, seed=None):
+    '''
+        Returns n points of a scrambled Sobol sequence, in the d-dimensional
+        unit hypercube
+    '''
+    from scipy.stats import qmc
+    seed = lasagne.random.get_rng().randint(1, 2147462579)\
+        if seed is None else seed
+    return qmc.Sobol(d, scramble=True, seed=seed).random(n)
+
+
+def normal_samples(shape, method='iid', rng=None):
+    '''
+        Draws standard normal samples with the given shape, using numpy.
+        The last two axes of shape correspond to the number of samples n and
+        their dimension d. The variance reduction method is applied over the
+        n samples, independently for every index of the leading axes.
+        @param method one of 'iid', 'antithetic' (pairs of samples with
+                      opposite signs), 'lhs' (latin hypercube) or 'sobol'
+                      (scrambled Sobol points mapped through the inverse
+                      normal cdf)
+    '''
+    rng = lasagne.random.get_rng() if rng is None else rng
+    shape = tuple(shape)
+    lead, (n, d) = shape[:-2], shape[-2:]
+    if method == 'iid':
+        z = rng.normal(size=shape)
+    elif method == 'antithetic':
+        z = rng.normal(size=lead + (int(np.ceil(n/2.0)), d))
+        z = np.concatenate([z, -z], axis=-2)[..., :n, :]
+    elif method == 'lhs':
+        perm = rng.uniform(size=shape).argsort(axis=-2)
+        u = (perm + rng.uniform(size=shape))/n
+        z = ndtri(clip_uniform(u))
+    elif method == 'sobol':
+        u = np.empty((int(np.prod(lead)), n, d))
+        for i in range(u.shape[0]):
+            u[i] = sobol_points(n, d, seed=rng.randint(1, 2147462579))
+        z = ndtri(clip_uniform(u.reshape(shape)))
+    else:
+        msg = 'Unknown sampling method %s. Valid options are %s'
+        raise ValueError(msg % (method, str(SAMPLING_METHODS)))
+    return z.astype(floatX)
+
+
+def symbolic_normal_samples(shape, method='iid', m_rng=None):
+    '''
+        Returns a symbolic expression for standard normal samples with the
+        given shape (see normal_samples). New samples are drawn at every
+        evaluation of the graph. The dimension d (the last entry of shape)
+        must be a python integer, while the number of samples n can be a
+        symbolic scalar, except for the 'sobol' method. For the 'sobol'
+        method, a fixed set of scrambled Sobol points is randomized by a
+        uniform random shift (modulo 1) at every evaluation.
+    '''
+    m_rng = get_mrng() if m_rng is None else m_rng
+    shape = list(shape)
+    lead, (n, d) = shape[:-2], shape[-2:]
+    axis = len(shape) - 2
+    if method == 'iid':
+        z = m_rng.normal(shape)
+    elif method == 'antithetic':
+        z = m_rng.normal(lead + [(n + 1)//2, d])
+        z = tt.concatenate([z, -z], axis=axis)
+        z = z[(slice(None),)*axis + (slice(0, n),)]
+    elif method == 'lhs':
+        perm = tt.argsort(m_rng.uniform(shape), axis=axis)
+        u = (perm + m_rng.uniform(shape))/tt.cast(n, floatX)
+        z = inv_phi(clip_uniform(u))
+    elif method == 'sobol':
+        pts = sobol_points(n, d).astype(floatX)
+        shift = m_rng.uniform(lead + [1, d])
+        u = (tt.constant(pts) + shift) % 1
+        z = inv_phi(clip_uniform(u))
+    else:
+        msg = 'Unknown sampling method %s. Valid options are %s'
+        raise ValueError(msg % (method, str(SAMPLING_METHODS)))
+    return z.astype(floatX)
+
+
+class FixedRandomStreams(object):
+    '''
+        Random streams that store the state of the random number generator,
+        instead of the generated samples. Every call to uniform or normal
+        (counted from the last call to reset) uses its own rstate shared
+        variable, which is only advanced via the updates returned by
+        get_updates. Hence, graphs built after calling reset (with the same
+        sequence of calls) will reproduce the same samples, whatever their
+        size; e.g. to implement common random numbers without storing the
+        samples.
+    '''
+    def __init__(self, seed=None, n_streams=60*256):
+        seed = lasagne.random.get_rng().randint(1, 2147462579)\
+            if seed is None else seed
+        self.m_rng = MRG_RandomStreams(seed)
+        self.n_streams = n_streams
+        self.rstates = []
+        self.reset()
+
+    def reset(self):
+        '''
+            Restarts the sequence of calls, so that a new graph reuses the
+            rstates of the previous one
+        '''
+        self.new_rstates = []
+
+    def uniform(self, size, dtype=floatX):
+        i = len(self.new_rstates)
+        if i == len(self.rstates):
+            rstates = self.m_rng.get_substream_rstates(self.n_streams, dtype)
+            self.rstates.append(theano.shared(
+                rstates, name='FixedRandomStreams>rstate_%d' % (i)))
+        size = tt.as_tensor_variable(size)
+        ndim = theano.tensor.get_vector_length(size)
+        new_rstate, u = mrg_uniform.new(self.rstates[i], ndim, dtype, size)
+        self.new_rstates.append(new_rstate)
+        return u
+
+    def normal(self, size, dtype=floatX):
+        return inv_phi(clip_uniform(self.uniform(size, dtype)))
+
+    def get_updates(self, condition=None):
+        '''
+            Returns the updates that advance the rstates used since the last
+            call to reset. If condition is not None, the rstates will only be
+            advanced when it evaluates to True.
+        '''
+        updts = theano.updates.OrderedUpdates()
+        for rstate, new_rstate in zip(self.rstates, self.new_rstates):
+            if condition is None:
+                updts[rstate] = new_rstate
+            else:
+                updts[rstate] = theano.ifelse.ifelse(
+                    condition, new_rstate, rstate)
+        return updts
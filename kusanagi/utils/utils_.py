@@ -110,6 +110,119 @@ def fast_jacobian(expr, wrt, chunk_size=16, func=None):
     return jac
 
 
+def checkpointed_scan(fn, sequences, outputs_info, non_sequences, n_steps,
+                      save_every=None, every_step=None,
+                      name='checkpointed_scan', **kwargs):
+    '''
+    Equivalent to theano.scan(fn, sequences, outputs_info, non_sequences,
+    n_steps), where the loop is split into segments of save_every steps
+    (an outer scan over segments, and an inner scan over the steps of each
+    segment). The outer scan only carries the recurrent states at the start
+    of every segment, and the intermediate values of each segment are
+    recomputed when backpropagating through it; the gradients are exact.
+    Only the outputs selected by every_step are returned for every step; the
+    other ones are only returned for the last step of every segment (with
+    shape [n_segments, ...]). By default, the recurrent outputs (e.g. the
+    rollout states) are only returned at the segment boundaries, so they
+    are stored for O(n_steps/save_every + save_every) steps; i.e.
+    O(sqrt(n_steps)) with the default save_every.
+    Only taps of -1 are supported for the recurrent outputs, and all the
+    sequences must have at least n_steps elements. The shared variables
+    used by fn must be passed in non_sequences.
+    @param save_every number of steps per segment. Defaults to
+                      ceil(sqrt(n_steps))
+    @param every_step list with one boolean per output of fn, indicating
+                      whether the output is returned for every step.
+                      Defaults to True for the non recurrent outputs (whose
+                      values for every step are stored) and False for the
+                      recurrent ones
+    @param kwargs additional arguments for theano.scan. allow_gc is only
+                  used for the outer scan, so that the buffers of the inner
+                  scans can be freed between segments
+    @return Returns a tuple (outputs, updates), as theano.scan
+    '''
+    n_steps = tt.as_tensor_variable(n_steps).astype('int64')
+    if save_every is None:
+        save_every = tt.ceil(tt.sqrt(n_steps)).astype('int64')
+    save_every = tt.maximum(
+        tt.as_tensor_variable(save_every).astype('int64'), 1)
+    n_segments = ((n_steps + save_every - 1)//save_every).astype('int64')
+    n_padded = n_segments*save_every
+    inner_kwargs = dict(
+        (k, v) for k, v in kwargs.items() if k != 'allow_gc')
+    outer_kwargs = dict(
+        (k, v) for k, v in kwargs.items()
+        if k in ('strict', 'mode', 'allow_gc'))
+
+    # pad the sequences (repeating their last value) so that they can be
+    # reshaped to [n_segments, save_every, ...]
+    outer_seqs = [tt.arange(n_segments)]
+    for seq in sequences:
+        seq = seq[:n_steps]
+        pad = tt.repeat(seq[-1:], n_padded - n_steps, axis=0)
+        seq = tt.concatenate([seq, pad], axis=0)
+        shape = tt.concatenate(
+            [tt.stack([n_segments, save_every]), seq.shape[1:]])
+        outer_seqs.append(seq.reshape(shape, ndim=seq.ndim+1))
+    is_recurrent = [o is not None for o in outputs_info]
+    n_rec = sum(is_recurrent)
+    if every_step is None:
+        every_step = [not rec for rec in is_recurrent]
+    # outputs of the outer scan, besides the recurrent states
+    n_extra = sum(every or not rec
+                  for every, rec in zip(every_step, is_recurrent))
+
+    def segment(k, *args):
+        seqs = args[:len(sequences)]
+        prev = iter(args[len(sequences):len(sequences)+n_rec])
+        inner_info = [next(prev) if rec else None for rec in is_recurrent]
+        seg_len, total = args[-2:]
+        # the last segment only runs over the remaining steps
+        n_k = tt.minimum(seg_len, total - k*seg_len)
+        outs, updts = theano.scan(
+            fn=fn, sequences=list(seqs), outputs_info=inner_info,
+            non_sequences=non_sequences, n_steps=n_k,
+            name=name+'_segment', **inner_kwargs)
+        if not isinstance(outs, list):
+            outs = [outs]
+        # last state of the segment, followed by the outputs for every step
+        # (padded with zeros to save_every steps) or for the last step
+        last = [o[-1] for o, rec in zip(outs, is_recurrent) if rec]
+        extra = []
+        for o, rec, every in zip(outs, is_recurrent, every_step):
+            if every:
+                pad_shape = tt.concatenate(
+                    [tt.stack([seg_len - n_k]), o.shape[1:]])
+                extra.append(
+                    tt.concatenate([o, tt.zeros(pad_shape, dtype=o.dtype)]))
+            elif not rec:
+                extra.append(o[-1])
+        return last + extra, updts
+
+    init = [o for o in outputs_info if o is not None]
+    outs, updts = theano.scan(
+        fn=segment, sequences=outer_seqs,
+        outputs_info=init + [None]*n_extra,
+        non_sequences=list(non_sequences) + [save_every, n_steps],
+        name=name, **outer_kwargs)
+    if not isinstance(outs, list):
+        outs = [outs]
+    states, extra = iter(outs[:n_rec]), iter(outs[n_rec:])
+
+    outputs = []
+    for rec, every in zip(is_recurrent, every_step):
+        o = next(states) if rec else None
+        if every:
+            # flatten the segments and remove the padding
+            o = next(extra)
+            shape = tt.concatenate([tt.stack([n_padded]), o.shape[2:]])
+            o = o.reshape(shape, ndim=o.ndim-1)[:n_steps]
+        elif not rec:
+            o = next(extra)
+        outputs.append(o)
+    return outputs, updts
+
+
 def print_with_stamp(message, name=None, same_line=False, use_log=True):
     '''
     Helper function to print with a current time stamp.
@@ -404,6 +517,31 @@ def unwrap_params(P, parameter_shapes):
     return p
 
 
+def update_moments(n, mean, scatter, X):
+    '''
+    Merges the sufficient statistics (sample count, mean and scatter matrix)
+    of a dataset with the statistics of the new samples X; i.e. the
+    parallel version of Welford's algorithm. This costs O(k*D^2) for k new
+    samples of dimension D, independently of the size of the dataset.
+    Returns the updated (n, mean, scatter)
+    '''
+    X = np.asarray(X, dtype=np.float64)
+    if X.ndim == 1:
+        X = X[:, None]
+    n_b = X.shape[0]
+    mean_b = X.mean(0)
+    delta_b = X - mean_b
+    scatter_b = delta_b.T.dot(delta_b)
+    if n == 0 or mean is None:
+        return n_b, mean_b, scatter_b
+
+    n_ab = n + n_b
+    delta = mean_b - mean
+    mean_ab = mean + delta*(float(n_b)/n_ab)
+    scatter_ab = scatter + scatter_b + np.outer(delta, delta)*(n*n_b/n_ab)
+    return n_ab, mean_ab, scatter_ab
+
+
 class MemoizeJac(object):
     def __init__(self, fun, args=()):
         self.fun = fun
@@ -412,19 +550,23 @@ class MemoizeJac(object):
         self.args = tuple(args)
 
     def _compute(self, x, *args):
-        self.x = np.asarray(x).copy()
+        x = np.asarray(x)
+        if self.x is None or self.x.shape != x.shape:
+            self.x = np.empty_like(x)
+        # keep a copy of the evaluation point (without reallocating it)
+        self.x[...] = x
         args += self.args
         self.value, self.jac = self.fun(x, *args)
 
     def __call__(self, x, *args):
-        if self.value is not None and np.alltrue(x == self.x):
+        if self.value is not None and np.array_equal(x, self.x):
             return self.value
         else:
             self._compute(x, *args)
             return self.value
 
     def derivative(self, x, *args):
-        if self.jac is not None and np.alltrue(x == self.x):
+        if self.jac is not None and np.array_equal(x, self.x):
             return self.jac
         else:
             self._compute(x, *args)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.base import apply_controller
+from kusanagi.ghost.algorithms import mc_pilco, pilco
+from kusanagi.ghost.regression import BNN
+
+floatX = theano.config.floatX
+D, E, H = 2, 1, 10
+
+
+def linear_bnn(idims, odims, W, name):
+    ''' Deterministic BNN with a single linear layer with weights W'''
+    bnn = BNN(idims, odims, heteroscedastic=False, analytic_moments=True,
+              name=name,
+              network_spec=dict(hidden_dims=[], p=0.0, p_input=0.0,
+                                W_init=[W.astype(floatX)],
+                                b_init=[np.zeros(odims, dtype=floatX)]))
+    bnn.unconstrained_sn.set_value(
+        np.full(odims, np.log(np.expm1(1e-8)), dtype=floatX))
+    return bnn
+
+
+class LinearEnv(object):
+    ''' x_{t+1} = x_t + [x_t, u_t] W, where the command u_t is a function
+    of the state at the time it was computed; i.e. the trajectory depends on
+    when the policy is evaluated'''
+    def __init__(self, W, x0):
+        self.W, self.x0 = W, x0
+
+    def reset(self):
+        self.x = self.x0.copy()
+        self.states = [self.x]
+        return self.x
+
+    def step(self, u):
+        self.x = self.x + np.concatenate([self.x, u]).dot(self.W)
+        self.states.append(self.x)
+        return self.x, 0.0, False, {}
+
+
+def linear_system():
+    rng = np.random.RandomState(0)
+    W_dyn = 0.1*rng.standard_normal((D+E, D))
+    W_dyn[D:] = 0.5
+    K = rng.standard_normal((D, E))
+    x0 = rng.standard_normal(D)
+    return W_dyn, K, x0
+
+
+def run_env(W_dyn, K, x0, action_repeat=3):
+    ''' Returns the states visited when applying the linear policy x K to
+    the linear system, with apply_controller'''
+    env = LinearEnv(W_dyn, x0)
+    apply_controller(env, lambda x, t=None: x.dot(K), H,
+                     action_repeat=action_repeat)
+    return np.array(env.states)
+
+
+def build_models(W_dyn, K):
+    dyn = linear_bnn(D+E, D, W_dyn, 'dyn')
+    pol = linear_bnn(D, E, K, 'pol')
+    return dyn, pol
+
+
+def test_mc_pilco_rollout_matches_apply_controller():
+    W_dyn, K, x0 = linear_system()
+    states = run_env(W_dyn, K, x0)
+    # the trajectory depends on when the policy is evaluated
+    assert not np.allclose(states, run_env(W_dyn, K, x0, action_repeat=1))
+    dyn, pol = build_models(W_dyn, K)
+
+    def cost(x, *args, **kwargs):
+        return tt.square(x).sum(-1)
+    x0 = tt.matrix('x0')
+    n = 4
+    z = tt.zeros((2, H+1, n, D))
+    (costs, trajectories), _ = mc_pilco.rollout(
+        x0, H, 1.0, pol, dyn, cost, z=z, mm_state=False, mm_cost=False,
+        noisy_policy_input=False, noisy_cost_input=False, action_repeat=3)
+    fn = theano.function([x0], trajectories, allow_input_downcast=True)
+    trajectories = fn(np.tile(states[0], (n, 1)))
+    for traj in trajectories:
+        np.testing.assert_allclose(traj, states, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('checkpoint', [False, True])
+def test_pilco_rollout_matches_apply_controller(checkpoint):
+    W_dyn, K, x0 = linear_system()
+    states = run_env(W_dyn, K, x0)
+    dyn, pol = build_models(W_dyn, K)
+
+    def cost(mx, Sx):
+        return tt.square(mx).sum(), tt.zeros(())
+    mx0, Sx0 = tt.vector('mx0'), tt.matrix('Sx0')
+    outs, _ = pilco.rollout(mx0, Sx0, H, 1.0, pol, dyn, cost,
+                            checkpoint=checkpoint, action_repeat=3)
+    mean_states = outs[2]
+    fn = theano.function([mx0, Sx0], mean_states, allow_input_downcast=True)
+    mean_states = fn(states[0], 1e-6*np.eye(D))
+    # the mean states are returned at the end of the checkpointed segments
+    idx = np.arange(1, H+1)
+    if checkpoint:
+        k = int(np.ceil(np.sqrt(H)))
+        idx = np.minimum(np.arange(k, H + k, k), H)
+    np.testing.assert_allclose(mean_states, states[idx], rtol=1e-4,
+                               atol=1e-5)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi import utils
+
+floatX = theano.config.floatX
+
+
+def build_rollouts(save_every=None, every_step=None, seed=0):
+    ''' Returns a function that computes the loss and gradients of the same
+    recurrence with theano.scan and utils.checkpointed_scan'''
+    rng = np.random.RandomState(seed)
+    W = theano.shared(
+        (0.5*rng.standard_normal((3, 3))).astype(floatX), name='W')
+    b = theano.shared(rng.standard_normal(3).astype(floatX), name='b')
+    x0 = tt.vector('x0')
+    seq = tt.matrix('seq')
+    H = tt.iscalar('H')
+
+    def step(u, x, W, b):
+        x_next = tt.tanh(x.dot(W) + u) + b
+        c = tt.square(x_next).sum()
+        return c, x_next
+
+    kwargs = dict(sequences=[seq], outputs_info=[None, x0],
+                  non_sequences=[W, b], strict=True, allow_gc=False)
+    (c, x), _ = theano.scan(step, n_steps=H, **kwargs)
+    (c_ck, x_ck), _ = utils.checkpointed_scan(
+        step, n_steps=H, save_every=save_every, every_step=every_step,
+        **kwargs)
+
+    outs = []
+    for costs, states in [(c, x), (c_ck, x_ck)]:
+        loss = costs.sum() + states[-1].sum()
+        outs += [loss, costs, states] + theano.grad(loss, [W, b, x0])
+    fn = theano.function([x0, seq, H], outs, allow_input_downcast=True)
+    return fn, rng
+
+
+@pytest.mark.parametrize('every_step', [None, [True, True]])
+@pytest.mark.parametrize('save_every', [None, 1, 3, 4])
+@pytest.mark.parametrize('H', [1, 3, 7, 9, 10])
+def test_matches_scan(H, save_every, every_step):
+    fn, rng = build_rollouts(save_every, every_step)
+    x0 = rng.standard_normal(3)
+    seq = rng.standard_normal((12, 3))
+    ret = fn(x0, seq, H)
+    n = len(ret)//2
+    if every_step is None:
+        # the recurrent states are only returned at the end of every segment
+        k = save_every or int(np.ceil(np.sqrt(H)))
+        idx = np.minimum(np.arange(k, H + k, k), H) - 1
+        assert ret[n+2].shape[0] == len(idx)
+        ret[2] = ret[2][idx]
+    for v, v_ck in zip(ret[:n], ret[n:]):
+        np.testing.assert_allclose(v_ck, v, rtol=1e-5, atol=1e-6)
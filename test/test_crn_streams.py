@@ -0,0 +1,23 @@
+import gc
+
+from kusanagi.ghost.algorithms import mc_pilco
+
+
+class Model(object):
+    def __init__(self, name='Model'):
+        self.name = name
+
+
+def test_streams_are_per_model_instance():
+    pol1, pol2, dyn = Model(), Model(), Model()
+    rng1 = mc_pilco.get_crn_stream(pol1, dyn, 10)
+    assert mc_pilco.get_crn_stream(pol1, dyn, 10) is rng1
+    assert mc_pilco.get_crn_stream(pol1, dyn, 20) is not rng1
+    # models with the same name do not share their random numbers
+    assert mc_pilco.get_crn_stream(pol2, dyn, 10) is not rng1
+
+    # the streams are released with the models
+    n_streams = len(mc_pilco.crn_streams)
+    del pol1
+    gc.collect()
+    assert len(mc_pilco.crn_streams) == n_streams - 1
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.shell import cost
+
+floatX = theano.config.floatX
+CW = [0.25, 0.5, 1.0, 2.0]
+
+
+def per_width_cost(mx, Sx, target, Q, cw, expl=None):
+    ''' Reference implementation, with one quadratic_saturating_loss per
+    width'''
+    if Sx is None:
+        costs = [cost.quadratic_saturating_loss(mx, None, target, Q/c**2)
+                 for c in cw]
+        return sum(costs)/len(cw)
+    M_cost, S_cost = [], []
+    for c in cw:
+        m_cost, s_cost = cost.quadratic_saturating_loss(
+            mx, Sx, target, Q/c**2)
+        if expl is not None:
+            m_cost += expl*tt.sqrt(s_cost)
+        M_cost.append(m_cost)
+        S_cost.append(s_cost)
+    return sum(M_cost)/len(cw), sum(S_cost)/len(cw)**2
+
+
+def random_Q(D, rng, singular=False):
+    if singular:
+        # repeated (zero and one) eigenvalues, as in most of our scenarios
+        return np.diag(rng.randint(0, 2, D)).astype(floatX)
+    A = rng.standard_normal((D, D))
+    return A.dot(A.T).astype(floatX)
+
+
+@pytest.mark.parametrize('singular', [False, True])
+def test_deterministic_matches_per_width_loop(singular):
+    D = 5
+    rng = np.random.RandomState(0)
+    Q = random_Q(D, rng, singular)
+    target = rng.standard_normal(D).astype(floatX)
+
+    mx = tt.matrix('mx')
+    c = cost.distance_based_cost(mx, None, target, Q, cw=CW)
+    c_ref = per_width_cost(mx, None, target, Q, CW)
+    outs = [c, c_ref] + theano.grad(c.sum(), [mx])
+    outs += theano.grad(c_ref.sum(), [mx])
+    fn = theano.function([mx], outs, allow_input_downcast=True)
+
+    c, c_ref, dmx, dmx_ref = fn(rng.standard_normal((20, D)))
+    np.testing.assert_allclose(c, c_ref, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(dmx, dmx_ref, rtol=1e-4, atol=1e-7)
+
+
+@pytest.mark.parametrize('expl', [None, 0.5])
+@pytest.mark.parametrize('singular', [False, True])
+def test_moment_matching_matches_per_width_loop(singular, expl):
+    D = 5
+    rng = np.random.RandomState(1)
+    Q = random_Q(D, rng, singular)
+    target = rng.standard_normal(D).astype(floatX)
+
+    mx = tt.vector('mx')
+    Sx = tt.matrix('Sx')
+    M, S = cost.distance_based_cost(mx, Sx, target, Q, cw=CW, expl=expl)
+    M_ref, S_ref = per_width_cost(mx, Sx, target, Q, CW, expl)
+    outs = [M, S, M_ref, S_ref]
+    for m, s in [(M, S), (M_ref, S_ref)]:
+        outs += theano.grad(m + s, [mx, Sx])
+    fn = theano.function([mx, Sx], outs, allow_input_downcast=True)
+
+    A = rng.standard_normal((D, D))
+    Sx = 0.1*A.dot(A.T) + 0.01*np.eye(D)
+    M, S, M_ref, S_ref, dmx, dSx, dmx_ref, dSx_ref = fn(
+        rng.standard_normal(D), Sx)
+    np.testing.assert_allclose(M, M_ref, rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(S, S_ref, rtol=1e-4, atol=1e-7)
+    assert np.all(np.isfinite(dSx))
+    np.testing.assert_allclose(dmx, dmx_ref, rtol=1e-4, atol=1e-6)
+    # Sx is symmetric, so only the symmetric part of its gradient matters
+    np.testing.assert_allclose(0.5*(dSx + dSx.T), 0.5*(dSx_ref + dSx_ref.T),
+                               rtol=1e-4, atol=1e-6)
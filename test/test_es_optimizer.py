@@ -0,0 +1,91 @@
+import lasagne
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi import utils
+from kusanagi.ghost.algorithms import mc_pilco
+from kusanagi.ghost.control import NNPolicy
+from kusanagi.ghost.optimizers import ESOptimizer
+
+floatX = theano.config.floatX
+
+
+def quadratic_objective(noise_std=0.0):
+    ''' Returns a parameter vector and a (noisy) quadratic loss with its
+    minimum at 1'''
+    p = theano.shared(np.zeros(4, dtype=floatX), name='p')
+    noise = utils.get_mrng().normal((1,), std=noise_std).sum()
+    loss = tt.square(p - 1).sum() + noise
+    return p, loss
+
+
+@pytest.mark.parametrize('method', ['CEM', 'CMA'])
+def test_returns_the_search_mean(method):
+    lasagne.random.get_rng().seed(0)
+    p, loss = quadratic_objective(noise_std=0.1)
+    opt = ESOptimizer(method, max_evals=2000, pop_size=20, init_std=1.0,
+                      batched=False)
+    opt.set_objective(loss, [p])
+    v = opt.minimize()
+    np.testing.assert_allclose(p.get_value(), 1.0, atol=0.2)
+    # the returned loss is an evaluation at the final parameters, not the
+    # (optimistically biased) minimum over the noisy candidate losses
+    assert v == opt.best_p[0]
+    np.testing.assert_array_equal(opt.best_p[1][0], p.get_value())
+    assert abs(v) < 0.5
+
+
+def test_seeded_from_lasagne_rng():
+    p, loss = quadratic_objective()
+    opt = ESOptimizer(max_evals=200, pop_size=10, batched=False)
+    opt.set_objective(loss, [p])
+    results = []
+    for i in range(2):
+        p.set_value(np.zeros(4, dtype=floatX))
+        lasagne.random.get_rng().seed(1)
+        np.random.seed(i)
+        results.append((opt.minimize(), p.get_value()))
+    assert results[0][0] == results[1][0]
+    np.testing.assert_array_equal(results[0][1], results[1][1])
+
+
+def test_unsupported_arguments():
+    p, loss = quadratic_objective()
+    opt = ESOptimizer(batched=False)
+    with pytest.raises(ValueError):
+        opt.set_objective(loss, [p], sample_size_adapter=object())
+
+
+@pytest.mark.parametrize('iid_per_eval', [False, True])
+def test_population_policy_matches_candidates(iid_per_eval):
+    D, pop_size, n = 3, 4, 5
+    pol = NNPolicy(D, maxU=[1.0, 2.0], name='pol',
+                   network_spec=dict(hidden_dims=[8], p=0.2, p_input=0.1))
+    params = pol.get_params(symbolic=True)
+    rng = np.random.RandomState(0)
+    p0 = utils.wrap_params([p.get_value() for p in params])
+    P = p0 + 0.1*rng.standard_normal((pop_size, p0.size))
+    x = rng.standard_normal((pop_size*n, D)).astype(floatX)
+
+    pop_pol = mc_pilco.PopulationPolicy(pol, pop_size)
+    # the dense layers are evaluated in batch, without cloning the graph
+    assert pop_pol.batched_layers() is not None
+    pop_pol.update(pop_size*n)
+    X = tt.matrix('X')
+    # without noise in the dropout masks, when sampled at every evaluation
+    u, sn = pop_pol.predict(X, iid_per_eval=iid_per_eval,
+                            deterministic=iid_per_eval, return_samples=True)
+    u = theano.function([pop_pol.P, X], u, allow_input_downcast=True)(P, x)
+    assert u.shape == (pop_size*n, 2)
+
+    u_c, sn_c = pol.predict(X, iid_per_eval=iid_per_eval,
+                            deterministic=iid_per_eval, return_samples=True)
+    u_c = theano.function([X], u_c, allow_input_downcast=True)
+    shapes = [p.get_value().shape for p in params]
+    for i in range(pop_size):
+        for p, p_i in zip(params, utils.unwrap_params(P[i], shapes)):
+            p.set_value(p_i)
+        np.testing.assert_allclose(u[i*n:(i+1)*n], u_c(x[i*n:(i+1)*n]),
+                                   rtol=1e-4, atol=1e-5)
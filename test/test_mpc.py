@@ -0,0 +1,69 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.control import MPCPolicy
+from kusanagi.ghost.regression import BNN
+
+floatX = theano.config.floatX
+D, E, H = 2, 1, 4
+
+
+def build_policy(sn=0.05, **kwargs):
+    ''' MPC over a linear model, where the control moves the first state
+    dimension (x_{t+1} = x_t + [u_t, 0] + noise), with the cost of the
+    distance of the first dimension to 1'''
+    W = np.zeros((D+E, D), dtype=floatX)
+    W[D, 0] = 1.0
+    dyn = BNN(D+E, D, heteroscedastic=False, name='dyn',
+              network_spec=dict(hidden_dims=[], p=0.0, p_input=0.0,
+                                W_init=[W], b_init=[np.zeros(D)]))
+    dyn.unconstrained_sn.set_value(
+        np.full(D, np.log(np.expm1(sn)), dtype=floatX))
+
+    def cost(x, *args):
+        return tt.square(x[:, 0] - 1)
+    return MPCPolicy(dyn, cost, D, H=H, maxU=[0.5], n_candidates=50,
+                     n_elite=5, n_particles=8, **kwargs)
+
+
+def test_candidates_share_noise():
+    pol = build_policy()
+    pol.compile()
+    x0 = np.zeros(D)
+    U = np.tile(0.1*np.ones((H, E)), (pol.n_candidates, 1, 1))
+    costs = pol.eval_fn(x0, U)
+    # identical control sequences have the same cost
+    np.testing.assert_allclose(costs, costs[0], rtol=1e-6)
+    # and new noise samples are drawn at every evaluation
+    assert not np.allclose(pol.eval_fn(x0, U), costs)
+
+
+def test_plan_applies_the_refit_mean():
+    np.random.seed(0)
+    pol = build_policy(max_iters=5, time_budget=None)
+    x0 = np.zeros(D)
+    u = pol(x0, t=0)
+    assert pol.n_iters == 5
+    # moving towards the target as fast as possible is optimal
+    assert u[0] > 0.3
+    np.testing.assert_array_equal(u, pol.u_mean[0])
+
+    U, c = pol.plan(x0)
+    assert c is not None
+    assert U.shape == (H, E)
+    assert np.all(np.abs(U) <= 0.5)
+    np.testing.assert_array_equal(U, pol.u_mean)
+
+
+def test_time_budget():
+    pol = build_policy(max_iters=5, time_budget=0.0)
+    x0 = np.zeros(D)
+    pol.compile()
+    assert pol.iter_time > 0
+    mean = pol.u_mean.copy()
+    # no iteration fits in the budget, so the warm start solution is used
+    U, c = pol.plan(x0)
+    assert pol.n_iters == 0
+    assert c is None
+    np.testing.assert_array_equal(U, mean)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.control import NNPolicy
+from kusanagi.ghost.control.saturation import tanhSat, sigmoidSat, maxSat
+
+floatX = theano.config.floatX
+D = 3
+
+
+def build_policy(sat_func):
+    ''' NNPolicy with dropout, and non trivial input and output whitening'''
+    rng = np.random.RandomState(0)
+    pol = NNPolicy(D, maxU=[1.0, 2.0], minU=[-1.0, -0.5], sat_func=sat_func,
+                   name='pol', network_spec=dict(hidden_dims=[16, 16],
+                                                 p=0.2, p_input=0.1))
+    pol.update_dataset_statistics(2*rng.standard_normal((50, D)) + 1,
+                                  rng.standard_normal((50, 2)))
+    # a single set of dropout masks
+    pol.build_network(pol.network_spec, name=pol.name)
+    pol.update(1)
+    return pol, rng
+
+
+@pytest.mark.parametrize('deterministic', [False, True])
+@pytest.mark.parametrize('sat_func', [tanhSat, sigmoidSat, maxSat])
+def test_matches_theano_predict(sat_func, deterministic):
+    pol, rng = build_policy(sat_func)
+    x = tt.vector('x')
+    u = pol.predict(x, deterministic=deterministic, iid_per_eval=False)[0]
+    u_fn = theano.function([x], u, allow_input_downcast=True)
+    # the dropout masks of the numpy policy are the ones used by theano
+    mask_index = None if deterministic else 0
+    pol_np = pol.export_numpy(mask_index, deterministic)
+
+    for i in range(5):
+        x_i = 2*rng.standard_normal(D)
+        np.testing.assert_allclose(pol_np(x_i), u_fn(x_i),
+                                   rtol=1e-4, atol=1e-5)
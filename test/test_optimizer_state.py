@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.optimizers import SGDOptimizer
+
+floatX = theano.config.floatX
+TARGET = np.array([1.0, -2.0, 3.0])
+
+
+def build_optimizer(size=3, max_evals=20, warm_start=False):
+    ''' Adam optimizer for a quadratic loss with minimum at x'''
+    w = theano.shared(np.zeros(size, dtype=floatX), name='w')
+    x = tt.vector('x')
+    loss = tt.square(w - x).sum()
+    opt = SGDOptimizer('ADAM', max_evals=max_evals, warm_start=warm_start)
+    opt.set_objective(loss, [w], [x], learning_rate=0.1)
+    return opt, w
+
+
+def test_save_load_round_trip(tmpdir, monkeypatch):
+    monkeypatch.setenv('KUSANAGI_OUTPUT', str(tmpdir))
+    opt, w = build_optimizer()
+    opt.minimize(TARGET)
+    state = opt.get_state()
+    # the adam moments have been updated
+    assert all(np.any(s != s0) for s, s0 in zip(
+        opt.get_state(opt.accumulators), opt.accumulators0))
+    opt.save()
+    assert opt.state_values is None
+
+    # restoring after setting the objective
+    opt2, w2 = build_optimizer()
+    assert opt2.load()
+    for s, s2 in zip(state, opt2.get_state()):
+        np.testing.assert_allclose(s, s2)
+    np.testing.assert_allclose(w2.get_value(), w.get_value())
+    assert opt2.n_minimize == opt.n_minimize == 1
+    assert opt2.total_evals == opt.total_evals
+    assert opt2.curr_iter == 0
+
+    # restoring before setting the objective
+    opt3 = SGDOptimizer('ADAM', max_evals=20)
+    assert opt3.load()
+    w3 = theano.shared(np.zeros(3, dtype=floatX), name='w')
+    x = tt.vector('x')
+    opt3.set_objective(tt.square(w3 - x).sum(), [w3], [x],
+                       learning_rate=0.1)
+    for s, s3 in zip(state, opt3.get_state()):
+        np.testing.assert_allclose(s, s3)
+    assert opt3.state_values is None
+
+
+def test_restore_skips_mismatched_shapes(tmpdir, monkeypatch):
+    monkeypatch.setenv('KUSANAGI_OUTPUT', str(tmpdir))
+    opt, w = build_optimizer()
+    opt.minimize(TARGET)
+    state = opt.get_state()
+    opt.save()
+
+    # the variables are matched by position; the ones with a different
+    # shape keep their values
+    opt2, w2 = build_optimizer(size=4)
+    state0 = opt2.get_state()
+    assert opt2.load()
+    for s, s0, s2 in zip(state, state0, opt2.get_state()):
+        if s.shape == s2.shape:
+            np.testing.assert_allclose(s2, s)
+        else:
+            np.testing.assert_allclose(s2, s0)
+    np.testing.assert_allclose(w2.get_value(), 0)
+
+
+def test_resume_from_checkpoint(tmpdir, monkeypatch):
+    monkeypatch.setenv('KUSANAGI_OUTPUT', str(tmpdir))
+    opt, w = build_optimizer()
+    opt.minimize(TARGET, checkpoint_every=5)
+    w_final = w.get_value()
+    total_evals = opt.total_evals
+
+    # the last checkpoint was saved in the middle of the optimization
+    opt2, w2 = build_optimizer()
+    assert opt2.load()
+    assert opt2.curr_iter == 15
+    opt2.minimize(TARGET)
+    assert opt2.curr_iter == 0
+    assert opt2.total_evals == total_evals
+    np.testing.assert_allclose(w2.get_value(), w_final, rtol=1e-5)
+
+
+@pytest.mark.parametrize('warm_start', [False, True])
+def test_warm_start(warm_start):
+    opt, w = build_optimizer(warm_start=warm_start)
+    opt.minimize(TARGET)
+    acc = opt.get_state(opt.accumulators)
+    # the moment estimates are only kept for a new objective with warm_start
+    # (which is enabled for the policy optimizer of the experiments, but not
+    # by default)
+    x = tt.vector('x')
+    opt.set_objective(tt.square(w - x).sum(), [w], [x], learning_rate=0.1)
+    expected = acc if warm_start else opt.accumulators0
+    for s, s2 in zip(expected, opt.get_state(opt.accumulators)):
+        np.testing.assert_allclose(s2, s)
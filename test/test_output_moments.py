@@ -0,0 +1,123 @@
+import lasagne
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from lasagne import nonlinearities
+from kusanagi.ghost.regression import layers, BNN
+
+floatX = theano.config.floatX
+N_MC = 200000
+
+
+def input_distribution(D, seed=0, correlated=False):
+    ''' Mean and covariance of a gaussian input distribution'''
+    rng = np.random.RandomState(seed)
+    m = rng.standard_normal(D).astype(floatX)
+    if correlated:
+        A = rng.standard_normal((D, D))
+        S = 0.3*A.dot(A.T) + 0.1*np.eye(D)
+    else:
+        S = np.diag(rng.uniform(0.1, 1.0, D))
+    return m, S.astype(floatX), rng
+
+
+def mc_moments(out_fn, m, S, rng, n=N_MC):
+    ''' Monte Carlo estimates of the output mean, covariance and input-output
+    covariance, drawing a different noise sample for every input sample'''
+    z = rng.standard_normal((n, m.size))
+    x = (m + z.dot(np.linalg.cholesky(S).T)).astype(floatX)
+    y = out_fn(x)
+    dx = x - x.mean(0)
+    dy = y - y.mean(0)
+    return y.mean(0), dy.T.dot(dy)/(n-1), dx.T.dot(dy)/(n-1)
+
+
+def assert_moments_close(moments, mc, S_in, full_cov=True):
+    ''' compares the analytic moments with the Monte Carlo estimates, with
+    a tolerance of a few standard errors. If full_cov is False, only the
+    output variances are compared'''
+    M, V, C = moments
+    M_mc, V_mc, C_mc = mc
+    v_mc = np.diag(V_mc)
+    np.testing.assert_allclose(M, M_mc, atol=5*np.sqrt(v_mc.max()/N_MC))
+    if V.ndim == 2:
+        if full_cov:
+            np.testing.assert_allclose(V, V_mc, rtol=2e-2,
+                                       atol=2e-2*v_mc.max())
+        V = np.diag(V)
+    np.testing.assert_allclose(V, v_mc, rtol=2e-2, atol=1e-4)
+    np.testing.assert_allclose(
+        C, C_mc, atol=5*np.sqrt(np.diag(S_in).max()*v_mc.max()/N_MC))
+
+
+# the pre-activations of a dropout layer are not gaussian, so the moments
+# after a rectifier are only exact for deterministic layers
+@pytest.mark.parametrize('layer_class, p, nonlinearity', [
+    (lasagne.layers.DenseLayer, None, nonlinearities.linear),
+    (lasagne.layers.DenseLayer, None, nonlinearities.rectify),
+    (layers.DenseDropoutLayer, 0.0, nonlinearities.rectify),
+    (layers.DenseDropoutLayer, 0.2, nonlinearities.linear),
+    (layers.DenseDropoutLayer, 0.5, nonlinearities.linear)])
+@pytest.mark.parametrize('correlated', [False, True])
+def test_single_layer_matches_monte_carlo(layer_class, p, nonlinearity,
+                                          correlated):
+    D, E = 4, 3
+    m, S, rng = input_distribution(D, correlated=correlated)
+    kwargs = dict(num_units=E, nonlinearity=nonlinearity,
+                  b=lasagne.init.Uniform(0.5))
+    if p is not None:
+        kwargs['p'] = p
+    net = layer_class(lasagne.layers.InputLayer((None, D)), **kwargs)
+
+    # the moments are exact for a single layer with gaussian inputs
+    mx, Sx = tt.vector('mx'), tt.matrix('Sx')
+    if correlated:
+        M, V, C = layers.get_output_moments(
+            net, mx[None, :], Sx, Sx, full_cov=True)
+        V = V[None, :, :]
+    else:
+        # the diagonal of the covariance is propagated
+        M, V, C = layers.get_output_moments(
+            net, mx[None, :], tt.diag(Sx)[None, :], Sx)
+    moments_fn = theano.function([mx, Sx], [M[0], V[0], C],
+                                 allow_input_downcast=True)
+
+    X = tt.matrix('X')
+    out_fn = theano.function(
+        [X], lasagne.layers.get_output(net, X, deterministic=False),
+        allow_input_downcast=True)
+
+    # the covariances between the outputs of a rectifier are approximate
+    full_cov = nonlinearity is nonlinearities.linear
+    assert_moments_close(moments_fn(m, S), mc_moments(out_fn, m, S, rng), S,
+                         full_cov)
+
+
+@pytest.mark.parametrize('correlated', [False, True])
+def test_bnn_predict_moments_matches_monte_carlo(correlated):
+    D, E = 4, 2
+    m, Sx0, rng = input_distribution(D, seed=1, correlated=correlated)
+    spec = dict(hidden_dims=[], p_input=0.2,
+                output_nonlinearity=nonlinearities.linear)
+    bnn = BNN(D, E, heteroscedastic=False, network_spec=spec)
+
+    mx, Sx = tt.vector('mx'), tt.matrix('Sx')
+    M, S, C = bnn.predict(mx, Sx, analytic_moments=True)
+    moments_fn = theano.function([mx, Sx], [M, S, C, bnn.sn],
+                                 allow_input_downcast=True)
+    M, S, C, sn = moments_fn(m, Sx0)
+
+    # samples of the same network, with a new dropout mask per sample
+    X = tt.matrix('X')
+    out_fn = theano.function(
+        [X], lasagne.layers.get_output(bnn.network, X, deterministic=False),
+        allow_input_downcast=True)
+    mc = mc_moments(out_fn, m, Sx0, rng)
+
+    # the output noise is added to the predictive variance. The network
+    # outputs are correlated, through the inputs and the dropout masks
+    S = S - np.diag((sn + 1e-6)**2)
+    assert np.abs(S - np.diag(np.diag(S))).max() > 1e-3
+    assert_moments_close((M, S, C), mc, Sx0)
@@ -0,0 +1,163 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.algorithms import pddp
+from kusanagi.ghost.control import LocalLinearPolicy
+from kusanagi.ghost.regression import BNN
+
+floatX = theano.config.floatX
+
+
+def lq_problem(H=6, Nz=3, Nu=2, seed=0):
+    ''' Linear dynamics z_{t+1} = A z_t + B u_t and quadratic cost
+    sum_t 0.5*z_{t+1}^T Q z_{t+1} + q^T z_{t+1}, expanded around a random
+    nominal trajectory'''
+    rng = np.random.RandomState(seed)
+    A = np.eye(Nz) + 0.3*rng.standard_normal((Nz, Nz))
+    B = rng.standard_normal((Nz, Nu))
+    W = rng.standard_normal((Nz, Nz))
+    Q = W.dot(W.T) + 0.1*np.eye(Nz)
+    q = rng.standard_normal(Nz)
+    z0 = rng.standard_normal(Nz)
+    U = rng.standard_normal((H, Nu))
+
+    def rollout(U, I=None, L=None, Z_nom=None):
+        z, Z, U_ = z0, [z0], []
+        for t in range(H):
+            u = U[t]
+            if I is not None:
+                u = u + I[t] + L[t].dot(z - Z_nom[t])
+            z = A.dot(z) + B.dot(u)
+            Z.append(z)
+            U_.append(u)
+        Z = np.array(Z)
+        cost = sum(0.5*z.dot(Q).dot(z) + q.dot(z) for z in Z[1:])
+        return cost, Z, np.array(U_)
+
+    cost, Z, _ = rollout(U)
+    fz = np.tile(A, (H, 1, 1))
+    fu = np.tile(B, (H, 1, 1))
+    lz = Z[1:].dot(Q) + q
+    lzz = np.tile(Q, (H, 1, 1))
+    return (fz, fu, lz, lzz), (A, B, Q, q, z0), U, Z, cost, rollout
+
+
+def optimal_controls(A, B, Q, q, z0, H):
+    ''' Solves the LQ problem directly, as a least squares problem over the
+    stacked controls'''
+    Nz, Nu = B.shape
+    G = np.zeros((H*Nz, H*Nu))
+    h = np.zeros(H*Nz)
+    for t in range(H):
+        h[t*Nz:(t+1)*Nz] = np.linalg.matrix_power(A, t+1).dot(z0)
+        for k in range(t+1):
+            G[t*Nz:(t+1)*Nz, k*Nu:(k+1)*Nu] = \
+                np.linalg.matrix_power(A, t-k).dot(B)
+    Qb = np.kron(np.eye(H), Q)
+    qb = np.tile(q, H)
+    U = -np.linalg.solve(G.T.dot(Qb).dot(G), G.T.dot(Qb.dot(h) + qb))
+    return U.reshape(H, Nu)
+
+
+def test_backward_pass_solves_lq_problem():
+    H = 6
+    expansion, lq, U, Z, cost, rollout = lq_problem(H)
+    I, L, dV = pddp.backward_pass(*expansion)
+    assert I.shape == U.shape
+    assert L.shape == (H, U.shape[1], Z.shape[1])
+
+    # a full step gives the optimal controls, and the predicted change in
+    # cost is exact
+    new_cost, _, U_new = rollout(U, I, L, Z)
+    U_opt = optimal_controls(*(lq + (H,)))
+    np.testing.assert_allclose(U_new, U_opt, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(new_cost - cost, dV[0] + dV[1], rtol=1e-6)
+    assert dV[0] < 0
+
+
+def test_backward_pass_matches_lqr_gains():
+    # the feedback gains do not depend on the nominal trajectory, and match
+    # the textbook Riccati recursion
+    H = 6
+    expansion, (A, B, Q, q, z0), U, Z, cost, rollout = lq_problem(H)
+    I, L, dV = pddp.backward_pass(*expansion)
+    P = Q
+    for t in range(H-1, -1, -1):
+        K = -np.linalg.solve(B.T.dot(P).dot(B), B.T.dot(P).dot(A))
+        np.testing.assert_allclose(L[t], K, rtol=1e-6, atol=1e-8)
+        P = A.T.dot(P).dot(A + B.dot(K))
+        P = 0.5*(P + P.T) + Q
+
+
+def test_backward_pass_regularization():
+    H = 6
+    expansion, lq, U, Z, cost, rollout = lq_problem(H)
+    I, L, dV = pddp.backward_pass(*expansion)
+    # regularization shrinks the steps
+    I_mu, L_mu, dV_mu = pddp.backward_pass(*expansion, mu=1e3)
+    assert np.linalg.norm(I_mu) < np.linalg.norm(I)
+    assert dV[0] < dV_mu[0] < 0
+
+
+def test_backward_pass_fails_for_indefinite_hessian():
+    expansion = lq_problem()[0]
+    fz, fu, lz, lzz = expansion
+    assert pddp.backward_pass(fz, fu, lz, -lzz) is None
+
+
+def double_integrator(D=2, E=1, dt=0.1):
+    ''' BNN with a linear network for the dynamics of a double integrator
+    (the state is position and velocity), with analytic moment matching'''
+    W = np.zeros((D+E, D), dtype=floatX)
+    W[1, 0] = dt
+    W[2, 1] = dt
+    dyn = BNN(D+E, D, heteroscedastic=False, analytic_moments=True,
+              name='dyn', network_spec=dict(hidden_dims=[], p=0.0,
+                                            p_input=0.0, W_init=[W],
+                                            b_init=[np.zeros(D)]))
+    return dyn, W[D:].T
+
+
+def quadratic_cost(target=[1.0, 0.0], Q=[1.0, 0.1]):
+    ''' Expected quadratic cost, for a gaussian state distribution'''
+    target = np.array(target, dtype=floatX)
+    Q = np.diag(Q).astype(floatX)
+
+    def cost(mx, Sx):
+        d = mx - target
+        mcost = d.dot(Q).dot(d) + tt.sum(Q*Sx)
+        return mcost, tt.zeros_like(mcost)
+    return cost
+
+
+def test_pddp_decreases_cost():
+    np.random.seed(0)
+    H, D = 15, 2
+    m0, S0 = np.zeros(D), 0.01*np.eye(D)
+    dyn, B = double_integrator()
+    cost = quadratic_cost()
+    pol = LocalLinearPolicy(H, 1, m0, S0, maxU=[5.0])
+    opt = pddp.PDDP(pol, dyn, cost, max_iters=20)
+    opt.compile()
+
+    # the mean of the next state is linear in the controls
+    U_nom, Z_nom, I, L = pol.get_params()
+    Z, U, c0 = opt.forward_pass(m0, S0, Z_nom, U_nom, I, L)
+    assert Z.shape == (H + 1, D + D*(D+1)//2)
+    fz, fu, lz, lzz = opt.linearize_fn(Z[:-1], U, Z[1:])
+    assert fz.shape == (H, Z.shape[1], Z.shape[1])
+    np.testing.assert_allclose(fu[:, :D], np.tile(B, (H, 1, 1)), atol=1e-5)
+
+    # every accepted step of the line search decreases the cost
+    costs = []
+    c = opt.minimize(callback=lambda Z, U, c: costs.append(c))
+    assert len(costs) > 0
+    assert np.all(np.diff([c0] + costs) < 0)
+    assert c == costs[-1]
+    assert c < 0.5*c0
+
+    # the optimized policy reproduces the final trajectory
+    U_nom, Z_nom, I, L = pol.get_params()
+    Z, U, c_pol = opt.forward_pass(m0, S0, Z_nom, U_nom, I, L)
+    np.testing.assert_allclose(c_pol, c, rtol=1e-5)
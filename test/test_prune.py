@@ -0,0 +1,61 @@
+import lasagne
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.regression import layers, BNN
+
+floatX = theano.config.floatX
+D, E, H = 3, 2, 8
+
+
+def build_bnn():
+    ''' BNN with a single hidden layer, whose outputs go through log normal
+    dropout'''
+    spec = dict(hidden_dims=[H], p=0.5, p_input=0.0,
+                dropout_class=layers.DenseLogNormalDropoutLayer)
+    bnn = BNN(D, E, heteroscedastic=False, name='bnn', network_spec=spec)
+    bnn.build_network(bnn.network_spec, name=bnn.name)
+    return bnn
+
+
+def predict_fn(bnn):
+    ''' Deterministic predictions and analytic moments of the predictions'''
+    X, mx, Sx = tt.matrix('X'), tt.vector('mx'), tt.matrix('Sx')
+    Y, _ = bnn.predict(X, deterministic=True, return_samples=True)
+    M, S, C = bnn.predict(mx, Sx, analytic_moments=True)
+    return theano.function([X, mx, Sx], [Y, M, S, C],
+                           allow_input_downcast=True)
+
+
+def test_prune_low_snr_units():
+    bnn = build_bnn()
+    out = lasagne.layers.get_all_layers(bnn.network)[-1]
+    assert out.input_shape[1] == H
+
+    # the last hidden units get a high noise level and don't contribute to
+    # the outputs
+    pruned = np.arange(H) >= H//2
+    std = np.where(pruned, 10.0, -10.0).astype(floatX)
+    out.logit_posterior_std.set_value(std)
+    W = out.W.get_value()
+    W[pruned] = 0
+    out.W.set_value(W)
+    snr = out.snr.eval()
+    assert snr[pruned].max() < snr[~pruned].min()
+    thr = 0.5*(snr[pruned].max() + snr[~pruned].min())
+
+    rng = np.random.RandomState(0)
+    X = rng.standard_normal((20, D))
+    m = rng.standard_normal(D)
+    A = rng.standard_normal((D, D))
+    S = 0.1*A.dot(A.T) + 0.01*np.eye(D)
+    ret = predict_fn(bnn)(X, m, S)
+
+    assert bnn.prune(thr) == H//2
+    out = lasagne.layers.get_all_layers(bnn.network)[-1]
+    assert out.input_shape[1] == H//2
+    np.testing.assert_allclose(out.snr.eval(), snr[~pruned], rtol=1e-5)
+    # the predictions of the smaller network are unchanged
+    for v_pruned, v in zip(predict_fn(bnn)(X, m, S), ret):
+        np.testing.assert_allclose(v_pruned, v, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,71 @@
+import numpy as np
+
+from kusanagi.utils.recorder import TrajectoryRecorder
+
+
+def test_record_rollouts_in_blocks(tmpdir):
+    rng = np.random.RandomState(0)
+    n, H, D = 25, 10, 3
+    blocks = []
+
+    def rollout_fn(m0):
+        costs = rng.uniform(size=(n, H))
+        trajectories = m0 + rng.standard_normal((n, H, D))
+        blocks.append((costs, trajectories))
+        return costs.mean(), costs, trajectories
+
+    recorder = TrajectoryRecorder(output_folder=str(tmpdir))
+    losses = recorder.record_rollouts(rollout_fn, [np.ones(D)], 4)
+    assert len(losses) == 4
+    assert recorder.n == 4*n
+
+    costs = np.concatenate([b[0] for b in blocks])
+    trajectories = np.concatenate([b[1] for b in blocks])
+    # every block was written to the memory mapped stores
+    np.testing.assert_allclose(recorder.trajectories, trajectories,
+                               rtol=1e-6)
+    np.testing.assert_allclose(recorder.costs, costs, rtol=1e-6)
+
+    # the merged mean and variance are exact
+    t, mean, std, q = recorder.summary()
+    np.testing.assert_allclose(mean, trajectories.mean(0)[t])
+    np.testing.assert_allclose(std, trajectories.std(0)[t])
+    t, mean, std, q = recorder.summary('costs')
+    np.testing.assert_allclose(mean, costs.mean(0)[t])
+
+    # the quantiles are computed from all the particles
+    t, mean, std, q = recorder.summary(max_points=4)
+    np.testing.assert_allclose(
+        q, np.percentile(trajectories, 100*recorder.quantiles, axis=0)[:, t],
+        rtol=1e-5)
+    # a few time steps at a time
+    q = recorder.get_quantiles('costs', np.arange(H), max_size=2*n)
+    np.testing.assert_allclose(
+        q, np.percentile(costs, 100*recorder.quantiles, axis=0), rtol=1e-5)
+
+
+def test_stores_are_reused(tmpdir):
+    rng = np.random.RandomState(0)
+    recorder = TrajectoryRecorder(output_folder=str(tmpdir))
+    for n in [10, 20, 5]:
+        recorder.new_iteration(n, 4, 2)
+        recorder.record(rng.standard_normal((n, 4, 2)),
+                        rng.standard_normal((n, 4)))
+        recorder.flush()
+    # only one set of files is kept
+    assert len(tmpdir.listdir()) == 2
+    assert recorder.trajectories.shape == (5, 4, 2)
+
+
+def test_in_memory_stores():
+    rng = np.random.RandomState(0)
+    recorder = TrajectoryRecorder(output_folder=None)
+    trajectories = rng.standard_normal((30, 6, 2))
+    recorder.new_iteration(30, 6, 2)
+    recorder.record(trajectories[:15])
+    recorder.record(trajectories[15:])
+    t, mean, std, q = recorder.summary()
+    np.testing.assert_allclose(mean, trajectories.mean(0))
+    np.testing.assert_allclose(
+        q, np.percentile(trajectories, 100*recorder.quantiles, axis=0),
+        rtol=1e-5)
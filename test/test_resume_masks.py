@@ -0,0 +1,67 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.algorithms import mc_pilco
+from kusanagi.ghost.control import NNPolicy
+from kusanagi.ghost.regression import BNN
+from kusanagi.shell.experiment_utils import save_checkpoint
+
+floatX = theano.config.floatX
+D, E = 2, 1
+
+
+def build_models():
+    rng = np.random.RandomState(0)
+    dyn = BNN(D+E, D, heteroscedastic=False, name='dyn',
+              network_spec=dict(hidden_dims=[16], p=0.1, p_input=0.0))
+    X = rng.standard_normal((30, D+E))
+    Y = 0.1*rng.standard_normal((30, D))
+    dyn.set_dataset(X, Y)
+    pol = NNPolicy(D, maxU=[1.0]*E, name='pol',
+                   network_spec=dict(hidden_dims=[16], p=0.1, p_input=0.0))
+    return dyn, pol
+
+
+def build_loss(dyn, pol):
+    ''' The loss of rollouts without measurement noise, from a (nearly)
+    deterministic initial state; i.e. it only depends on the dropout masks
+    '''
+    def cost(x, *args, **kwargs):
+        return tt.square(x).sum(-1)
+    loss, inps, updts = mc_pilco.get_loss(
+        pol, dyn, cost, n_samples=20, mm_state=False, mm_cost=False,
+        noisy_policy_input=False, noisy_cost_input=False, crn=False)
+    fn = theano.function(inps, loss, updates=updts,
+                         allow_input_downcast=True)
+    m0, S0 = np.ones(D), 1e-10*np.eye(D)
+    return lambda: fn(m0, S0, 10, 1.0)
+
+
+def test_resume_with_saved_masks(tmpdir, monkeypatch):
+    monkeypatch.setenv('KUSANAGI_OUTPUT', str(tmpdir))
+    dyn, pol = build_models()
+    loss_fn = build_loss(dyn, pol)
+    loss = loss_fn()
+    masks = [dyn.get_noise_samples(), pol.get_noise_samples()]
+    assert all(len(m) > 0 for m in masks)
+    save_checkpoint(dyn, pol)
+
+    # loading the models restores the masks
+    dyn2, pol2 = build_models()
+    dyn2.load()
+    pol2.load()
+    saved = [dyn2.get_noise_samples(), pol2.get_noise_samples()]
+    for m, m2 in zip(masks, saved):
+        assert sorted(m) == sorted(m2)
+        for name in m:
+            np.testing.assert_array_equal(m[name], m2[name])
+
+    # building the loss graph resamples the masks, so the objective changes
+    loss_fn2 = build_loss(dyn2, pol2)
+    assert not np.allclose(loss_fn2(), loss, rtol=1e-4)
+
+    # until the saved masks are written back
+    dyn2.set_noise_samples(saved[0])
+    pol2.set_noise_samples(saved[1])
+    np.testing.assert_allclose(loss_fn2(), loss, rtol=1e-4)
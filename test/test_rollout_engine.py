@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.algorithms import mc_pilco
+from kusanagi.ghost.control import NNPolicy
+from kusanagi.ghost.regression import BNN
+
+floatX = theano.config.floatX
+D, E = 2, 1
+
+
+def build_engine(crn=1):
+    rng = np.random.RandomState(0)
+    dyn = BNN(D+E, D, heteroscedastic=False, name='dyn',
+              network_spec=dict(hidden_dims=[16], p=0.1, p_input=0.0))
+    dyn.set_dataset(rng.standard_normal((30, D+E)),
+                    0.1*rng.standard_normal((30, D)))
+    pol = NNPolicy(D, maxU=[1.0]*E, name='pol',
+                   network_spec=dict(hidden_dims=[16], p=0.1, p_input=0.0))
+
+    def cost(x, *args, **kwargs):
+        return tt.square(x).sum(-1)
+    # the common random numbers are changed every crn evaluations
+    engine = mc_pilco.build_rollout(
+        pol, dyn, cost, n_samples=10, mm_state=False, mm_cost=False, crn=crn)
+    m0, S0 = np.ones(D), 0.1*np.eye(D)
+    return engine, (m0, S0, 5, 1.0), (dyn, pol)
+
+
+def test_diagnostics_do_not_apply_updates():
+    engine, inputs, models = build_engine()
+    loss, costs, trajectories = engine(*inputs, update=False)
+    assert costs.shape == (10, 5)
+    assert trajectories.shape == (10, 5, D)
+
+    # evaluating the diagnostics doesn't change the random numbers or the
+    # policy input statistics used by the loss
+    pol = models[1]
+    shared = [pol.Xm, pol.iXs] + list(engine.updts.keys())
+    values = [s.get_value() for s in shared]
+    loss2, costs2, trajectories2 = engine(*inputs, update=False)
+    for v, s in zip(values, shared):
+        np.testing.assert_array_equal(s.get_value(), v)
+    np.testing.assert_array_equal(trajectories2, trajectories)
+    assert loss2 == loss
+
+    # while the loss evaluations used by the optimizer do
+    engine(*inputs, return_intermediate=False)
+    loss3 = engine(*inputs, update=False, return_intermediate=False)[0]
+    assert loss3 != loss
+
+
+def test_diagnostics_do_not_compute_gradients():
+    engine, inputs, models = build_engine()
+    with pytest.raises(ValueError):
+        engine(*inputs, update=False, return_grads=True)
+
+
+def test_crn_advance_every_crn_evaluations():
+    crn = 3
+    engine, inputs, models = build_engine(crn)
+    trajectories = [engine(*inputs)[2] for i in range(2*crn + 1)]
+    for i in range(1, len(trajectories)):
+        changed = not np.allclose(trajectories[i], trajectories[i-1])
+        # the first crn evaluations use the same samples
+        assert changed == (i % crn == 0)
@@ -0,0 +1,73 @@
+import numpy as np
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.algorithms import mc_pilco
+
+floatX = theano.config.floatX
+
+
+class LinearPolicy(object):
+    ''' Deterministic linear policy, u = x.dot(W)'''
+    def __init__(self, D, E, rng):
+        self.E = E
+        self.maxU = np.ones(E)
+        self.W = theano.shared(
+            (0.5*rng.standard_normal((D, E))).astype(floatX), name='W')
+
+    def predict(self, x, iid_per_eval=False, return_samples=True):
+        return x.dot(self.W), None
+
+
+def build_reuse(n=200, H=10, D=3, E=2, action_std=0.5, seed=1):
+    rng = np.random.RandomState(seed)
+    pol = LinearPolicy(D, E, rng)
+    reuse = mc_pilco.RolloutReuse(ess_threshold=0.5, action_std=action_std)
+
+    X = tt.tensor3('X')
+    U = tt.tensor3('U')
+    Z = tt.tensor3('Z')
+    C = tt.matrix('C')
+    loss, updts = reuse.build(pol, C.mean(), C, X, U, Z)
+    loss_fn = theano.function([X, U, Z, C], loss, updates=updts,
+                              allow_input_downcast=True)
+
+    # a rollout sampled from the gaussian policy
+    x = rng.standard_normal((n, H, D)).astype(floatX)
+    z = rng.standard_normal((n, H, E)).astype(floatX)
+    u = x.dot(pol.W.get_value()) + action_std*z
+    c = rng.uniform(size=(n, H)).astype(floatX)
+    return pol, reuse, loss_fn, (x, u, z, c)
+
+
+def test_estimate_matches_fresh_loss():
+    pol, reuse, loss_fn, rollout = build_reuse()
+    c = rollout[-1]
+    # fresh rollout, fills the cache
+    fresh_loss = loss_fn(*rollout)
+    np.testing.assert_allclose(fresh_loss, c.mean(), rtol=1e-5)
+
+    # with unchanged parameters, all the weights are equal
+    reuse.use_cache.set_value(np.array(1, dtype='int8'))
+    iw_loss = loss_fn(*rollout)
+    np.testing.assert_allclose(iw_loss, fresh_loss, rtol=1e-4)
+    np.testing.assert_allclose(reuse.ess.get_value(), c.shape[0], rtol=1e-3)
+    assert reuse.after_update()
+
+
+def test_ess_decreases_with_parameter_change():
+    pol, reuse, loss_fn, rollout = build_reuse()
+    n = rollout[0].shape[0]
+    loss_fn(*rollout)
+    reuse.use_cache.set_value(np.array(1, dtype='int8'))
+
+    W0 = pol.W.get_value()
+    ess = [n]
+    for delta in [0.05, 0.2, 0.5]:
+        pol.W.set_value((W0 + delta).astype(floatX))
+        loss_fn(*rollout)
+        ess.append(float(reuse.ess.get_value()))
+    assert np.all(np.diff(ess) < 0)
+    # with a large change, a fresh rollout is triggered
+    assert ess[-1] < reuse.ess_threshold*n
+    assert not reuse.after_update()
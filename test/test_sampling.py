@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from scipy.special import ndtr
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+from kusanagi.utils import sampling
+
+floatX = theano.config.floatX
+
+
+def strata(z):
+    ''' Returns the index of the stratum (out of n equal probability
+    intervals) of each of the n samples in z, along the sample axis'''
+    n = z.shape[-2]
+    return np.floor(ndtr(z.astype(np.float64))*n).astype(int)
+
+
+def assert_stratified(z):
+    n = z.shape[-2]
+    idx = np.sort(strata(z), axis=-2)
+    expected = np.broadcast_to(np.arange(n)[:, None], idx.shape[-2:])
+    assert np.all(idx == expected)
+
+
+@pytest.mark.parametrize('method', sampling.SAMPLING_METHODS)
+@pytest.mark.parametrize('shape', [(16, 3), (2, 5, 15, 2)])
+def test_normal_samples_shape(method, shape):
+    z = sampling.normal_samples(shape, method, np.random.RandomState(0))
+    assert z.shape == shape
+    assert z.dtype == floatX
+    assert np.all(np.isfinite(z))
+
+
+@pytest.mark.parametrize('n', [10, 11])
+def test_antithetic_pairs(n):
+    z = sampling.normal_samples((4, n, 3), 'antithetic',
+                                np.random.RandomState(0))
+    h = n//2
+    np.testing.assert_allclose(z[:, n-h:], -z[:, :h])
+    if n % 2 == 0:
+        np.testing.assert_allclose(z.mean(1), 0, atol=1e-6)
+
+
+def test_lhs_is_stratified():
+    z = sampling.normal_samples((3, 50, 4), 'lhs', np.random.RandomState(0))
+    # exactly one sample per stratum, for every dimension and leading index
+    assert_stratified(z)
+
+
+def test_sobol_is_stratified():
+    # the one dimensional projections of 2^m sobol points are stratified
+    z = sampling.normal_samples((3, 64, 4), 'sobol', np.random.RandomState(0))
+    assert_stratified(z)
+    # with a different scrambling for every leading index
+    assert not np.allclose(z[0], z[1])
+
+
+@pytest.mark.parametrize('method', ['antithetic', 'lhs', 'sobol'])
+def test_variance_reduction(method):
+    # the estimates of E[z] and E[z^2] have lower variance than with iid
+    # samples
+    rng = np.random.RandomState(0)
+    shape = (200, 32, 2)
+    z_iid = sampling.normal_samples(shape, 'iid', rng)
+    z = sampling.normal_samples(shape, method, rng)
+    for f in [lambda x: x, lambda x: x**2]:
+        var_iid = f(z_iid).mean(1).var(0)
+        var = f(z).mean(1).var(0)
+        if method == 'antithetic' and f(-1) > 0:
+            # antithetic samples do not help with even functions
+            continue
+        assert np.all(var < 0.5*var_iid)
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        sampling.normal_samples((10, 2), 'halton')
+    with pytest.raises(ValueError):
+        sampling.symbolic_normal_samples((10, 2), 'halton')
+
+
+@pytest.mark.parametrize('method', sampling.SAMPLING_METHODS)
+def test_symbolic_normal_samples(method):
+    m_rng = MRG_RandomStreams(1234)
+    n = 64 if method == 'sobol' else tt.iscalar('n')
+    z = sampling.symbolic_normal_samples([3, n, 2], method, m_rng)
+    inputs = [] if method == 'sobol' else [n]
+    fn = theano.function(inputs, z, allow_input_downcast=True)
+    args = [] if method == 'sobol' else [64]
+
+    z1, z2 = fn(*args), fn(*args)
+    assert z1.shape == (3, 64, 2)
+    assert np.all(np.isfinite(z1))
+    # new samples are drawn at every evaluation
+    assert not np.allclose(z1, z2)
+    if method == 'antithetic':
+        np.testing.assert_allclose(z1[:, 32:], -z1[:, :32])
+    elif method == 'lhs':
+        assert_stratified(z1)
+    elif method == 'sobol':
+        # the randomly shifted points are still evenly spread
+        assert np.all(np.abs(z1.mean(1)) < 0.1)
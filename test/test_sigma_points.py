@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+from kusanagi.ghost.algorithms import pilco
+from kusanagi.ghost.regression import BNN
+
+floatX = theano.config.floatX
+D, E = 2, 1
+
+
+def linear_bnn(idims, odims, W, sn=None, heteroscedastic=False, name='bnn'):
+    ''' BNN with a single linear layer with weights W, with analytic moment
+    matching'''
+    bnn = BNN(idims, odims, heteroscedastic=heteroscedastic,
+              analytic_moments=True, name=name,
+              network_spec=dict(hidden_dims=[], p=0.0, p_input=0.0,
+                                W_init=[W.astype(floatX)],
+                                b_init=[np.zeros(W.shape[1], dtype=floatX)]))
+    if sn is not None:
+        bnn.unconstrained_sn.set_value(
+            np.full(odims, np.log(np.expm1(sn)), dtype=floatX))
+    return bnn
+
+
+def linear_system(sn=0.05):
+    ''' Linear dynamics delta_x = A x + B u, with a linear policy u = K x'''
+    rng = np.random.RandomState(0)
+    W_dyn = 0.3*rng.standard_normal((D+E, D))
+    K = rng.standard_normal((D, E))
+    dyn = linear_bnn(D+E, D, W_dyn, sn=sn, name='dyn')
+    pol = linear_bnn(D, E, K, name='pol')
+    return pol, dyn
+
+
+def input_distribution():
+    rng = np.random.RandomState(1)
+    A = rng.standard_normal((D, D))
+    m = rng.standard_normal(D).astype(floatX)
+    S = (0.3*A.dot(A.T) + 0.1*np.eye(D)).astype(floatX)
+    return m, S
+
+
+@pytest.mark.parametrize('propagation, ut_params', [
+    ('unscented', {}),
+    ('unscented', dict(kappa=1.0)),
+    ('unscented', dict(alpha=0.5, kappa=1.0)),
+    ('cubature', {})])
+def test_matches_moment_matching_for_linear_models(propagation, ut_params):
+    pol, dyn = linear_system()
+    mx, Sx = tt.vector('mx'), tt.matrix('Sx')
+    outs = []
+    for method in ['moment_matching', propagation]:
+        outs += pilco.propagate_belief(mx, Sx, pol, dyn, None, method,
+                                       ut_params)[0]
+    outs.append(pilco.propagate_mean(mx, pol, dyn))
+    fn = theano.function([mx, Sx], outs, allow_input_downcast=True)
+    m, S = input_distribution()
+    m_mm, S_mm, m_sp, S_sp, m_mean = fn(m, S)
+
+    # the moments of a linear gaussian system are exact for both methods,
+    # (up to the policy noise, which is ignored by the sigma points)
+    np.testing.assert_allclose(m_sp, m_mm, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(S_sp, S_mm, rtol=1e-4, atol=1e-5)
+    # and the mean of the next state is the prediction at the mean
+    np.testing.assert_allclose(m_mean, m_mm, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('ut_params', [{}, dict(kappa=1.0)])
+def test_heteroscedastic_noise_is_weighted(ut_params):
+    # zero dynamics, with a noise variance that depends on the state
+    W_dyn = np.zeros((D+E, 2*D))
+    W_dyn[0, D] = 2.0
+    W_dyn[1, D+1] = -1.0
+    dyn = linear_bnn(D+E, D, W_dyn, heteroscedastic=True, name='dyn')
+    pol = linear_bnn(D, E, np.zeros((D, E)), name='pol')
+
+    mx, Sx = tt.vector('mx'), tt.matrix('Sx')
+    (mx_next, Sx_next), _ = pilco.propagate_belief(
+        mx, Sx, pol, dyn, None, 'unscented', ut_params)
+    X, wm, wc = pilco.sigma_points(mx, Sx, 'unscented', **ut_params)
+    Xu = tt.concatenate([X, tt.zeros((X.shape[0], E))], axis=1)
+    _, Sdelta = pilco.predict_points(dyn, Xu)
+    fn = theano.function([mx, Sx], [mx_next, Sx_next, wm, Sdelta],
+                         allow_input_downcast=True)
+    m, S = input_distribution()
+    m_next, S_next, wm, Sdelta = fn(m, S)
+
+    np.testing.assert_allclose(wm.sum(), 1.0, rtol=1e-5)
+    if ut_params.get('kappa', 0.0) == 0.0:
+        # the central point gets zero weight with the default parameters
+        assert wm[0] == 0
+    np.testing.assert_allclose(m_next, m, rtol=1e-5, atol=1e-6)
+    # the expected noise variance is the weighted mean over the points
+    np.testing.assert_allclose(S_next, S + np.diag(wm.dot(Sdelta)),
+                               rtol=1e-4, atol=1e-7)
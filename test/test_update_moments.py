@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from kusanagi import utils
+from kusanagi.ghost.regression import BNN
+
+
+def batches(rng, sizes, D, offset=0.0):
+    return [offset + rng.standard_normal((k, D))*np.arange(1, D+1)
+            for k in sizes]
+
+
+@pytest.mark.parametrize('offset', [0.0, 1e6])
+@pytest.mark.parametrize('sizes', [[10], [1, 1, 1, 5], [7, 1, 30, 2, 100]])
+def test_incremental_matches_batch(sizes, offset):
+    rng = np.random.RandomState(0)
+    D = 3
+    X = batches(rng, sizes, D, offset)
+
+    stats = (0, None, None)
+    for Xb in X:
+        stats = utils.update_moments(*(stats + (Xb,)))
+    n, mean, scatter = stats
+
+    X = np.concatenate(X)
+    assert n == X.shape[0]
+    np.testing.assert_allclose(mean, X.mean(0), rtol=1e-12)
+    # the merged scatter matrix does not lose precision with large offsets
+    np.testing.assert_allclose(scatter, (X - X.mean(0)).T.dot(X - X.mean(0)),
+                               rtol=1e-8, atol=1e-8)
+    np.testing.assert_allclose(scatter/(n-1), np.cov(X.T), rtol=1e-8,
+                               atol=1e-8)
+
+
+def test_one_dimensional_samples():
+    rng = np.random.RandomState(1)
+    x = rng.standard_normal(20)
+    n, mean, scatter = utils.update_moments(0, None, None, x[:5])
+    n, mean, scatter = utils.update_moments(n, mean, scatter, x[5:])
+    assert n == 20
+    np.testing.assert_allclose(mean, [x.mean()])
+    np.testing.assert_allclose(scatter, [[x.var()*20]])
+
+
+def test_bnn_append_dataset_statistics():
+    rng = np.random.RandomState(2)
+    X = batches(rng, [20, 5, 15], 3)
+    Y = batches(rng, [20, 5, 15], 2, offset=3.0)
+
+    bnn = BNN(3, 2)
+    bnn.set_dataset(X[0], Y[0])
+    for Xb, Yb in zip(X[1:], Y[1:]):
+        bnn.append_dataset(Xb, Yb)
+
+    ref = BNN(3, 2)
+    ref.set_dataset(np.concatenate(X), np.concatenate(Y))
+
+    for s, s_ref in zip(bnn.X_stats + bnn.Y_stats, ref.X_stats + ref.Y_stats):
+        np.testing.assert_allclose(s, s_ref, rtol=1e-8)
+    for v in ['Xm', 'iXs', 'Ym', 'Ys']:
+        np.testing.assert_allclose(getattr(bnn, v).get_value(),
+                                   getattr(ref, v).get_value(), rtol=1e-4)